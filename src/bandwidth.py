@@ -0,0 +1,153 @@
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+
+MAX_SLEEP = 0.25  # seconds, so a changed limit applies almost at once
+DEFAULT_MAX_CONNECTIONS = 16
+
+
+def parse_schedule(entries):
+    """[{"start": "HH:MM", "end": "HH:MM", "kbps": n}, ...] -> minute ranges.
+
+    A window whose end is before its start runs over midnight.
+    """
+    windows = []
+    for entry in entries or []:
+        start_h, start_m = (int(part) for part in entry["start"].split(":"))
+        end_h, end_m = (int(part) for part in entry["end"].split(":"))
+        windows.append(
+            (start_h * 60 + start_m, end_h * 60 + end_m, float(entry["kbps"]))
+        )
+    return windows
+
+
+class BandwidthGovernor:
+    """Token bucket shared by every download of the process.
+
+    Downloads report the bytes they just received with consume(), which
+    sleeps while the budget is spent. The limit (kbit/s, 0 = unlimited) can
+    change at any time, schedule windows override it at their times of day.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit_kbps = 0.0
+        self.schedule = []
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.waited = 0.0
+        # Part of the limit this process may use, see share_bandwidth()
+        self.share = 1.0
+
+    def configure(self, limit_kbps=0, schedule=None):
+        windows = parse_schedule(schedule)
+        with self.lock:
+            self.limit_kbps = max(float(limit_kbps or 0), 0.0)
+            self.schedule = windows
+
+    def current_kbps(self, now: datetime.datetime = None):
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, kbps in self.schedule:
+            if start <= minute < end or (
+                end < start and (minute >= start or minute < end)
+            ):
+                return kbps * self.share
+        return self.limit_kbps * self.share
+
+    def _refill(self, rate: float):
+        now = time.monotonic()
+        # One second of burst at most
+        self.tokens = min(self.tokens + (now - self.last) * rate, rate)
+        self.last = now
+
+    def consume(self, nbytes: int):
+        """Take `nbytes` from the budget, returns the seconds spent waiting."""
+        if nbytes <= 0:
+            return 0.0
+        with self.lock:
+            rate = self.current_kbps() * 1000 / 8
+            if not rate:
+                return 0.0
+            self._refill(rate)
+            self.tokens -= nbytes
+            deficit = -self.tokens
+        started = time.monotonic()
+        while deficit > 0:
+            time.sleep(min(deficit / rate, MAX_SLEEP))
+            with self.lock:
+                rate = self.current_kbps() * 1000 / 8
+                if not rate:
+                    # Limit lifted, forget the debt
+                    self.tokens = 0.0
+                    break
+                self._refill(rate)
+                deficit = -self.tokens
+        waited = time.monotonic() - started
+        with self.lock:
+            self.waited += waited
+        return waited
+
+    def progress_hook(self):
+        """yt-dlp progress hook that charges every received block to the budget."""
+        received = {}
+        lock = threading.Lock()
+
+        def hook(status):
+            if status.get("status") != "downloading":
+                return
+            name = status.get("tmpfilename") or status.get("filename")
+            total = status.get("downloaded_bytes") or 0
+            with lock:
+                previous = received.get(name, 0)
+                received[name] = total
+            # A restarted download counts from zero again
+            self.consume(total - previous if total >= previous else total)
+
+        return hook
+
+
+class ConnectionBudget:
+    """Connections that all source downloads may hold together.
+
+    Every download gets one, extra ones (parallel fragments) only while the
+    total stays within `limit`, so it never exceeds max(limit, workers).
+    """
+
+    def __init__(self, limit: int = DEFAULT_MAX_CONNECTIONS):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.share = 1.0
+        self.used = 0
+
+    @contextmanager
+    def reserve(self, wanted: int):
+        with self.lock:
+            limit = int(self.limit * self.share)
+            granted = max(1, min(wanted, limit - self.used))
+            self.used += granted
+        try:
+            yield granted
+        finally:
+            with self.lock:
+                self.used -= granted
+
+
+governor = BandwidthGovernor()
+connections = ConnectionBudget()
+
+
+def configure_bandwidth(config: dict):
+    governor.configure(
+        config.get("bandwidth_kbps", 0), config.get("bandwidth_schedule")
+    )
+    connections.limit = max(
+        int(config.get("max_connections") or DEFAULT_MAX_CONNECTIONS), 1
+    )
+
+
+def share_bandwidth(fraction: float):
+    """Let this process use `fraction` of the budgets, for worker processes."""
+    governor.share = fraction
+    connections.share = fraction
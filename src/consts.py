@@ -1 +1,4 @@
 CONFIG_FILE = "../config.json"
+METRICS_DIR = "../metrics"
+PROFILE_DIR = "../profiles"
+SOURCE_CACHE_DIR = "../source_cache"
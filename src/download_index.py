@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader import (
+    PRESET_TAG,
+    SOURCE_TAG,
+    quality_map,
+    read_custom_tags,
+    sanitize,
+    source_key,
+)
+from library import LibraryIndex
+
+INDEX_FILE = ".download_index.json"
+SAVE_INTERVAL = 5  # seconds between index writes while tracks finish
+
+
+def extra_output_files(file_path: str, folder: str, targets: list):
+    """Files of the extra outputs (targets[1:]) that go with a main file.
+
+    They have its name, in the same collection `folder` ("." for none) of
+    their own root. None if any of them is missing.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    files = [
+        os.path.join(
+            root,
+            "" if folder == "." else folder,
+            f"{name}.{quality_map[preset]['ext']}",
+        )
+        for root, preset in targets[1:]
+    ]
+    if not all(os.path.exists(path) for path in files):
+        return None
+    return files
+
+
+class DownloadIndex:
+    """Finished downloads keyed by source ID and preset.
+
+    Persisted in <root>/.download_index.json. Every file also carries the key
+    in its tags, so a lost or stale index is rebuilt by reading them.
+    """
+
+    def __init__(self, root: str, workers: int = 8):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, INDEX_FILE)
+        self.workers = workers
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.dirty = False
+        self.loaded = self.load()
+
+    @staticmethod
+    def key(source: str, preset: str, folder: str = None):
+        """Key of a track's latest file, or (with `folder`) of its file there."""
+        key = f"{source}|{preset}"
+        return f"{key}|{folder}" if folder is not None else key
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+            return True
+        except (OSError, ValueError):
+            self.entries = {}
+            return False
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.entries)
+            self.dirty = False
+            self.last_save = time.time()
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, self.path)
+
+    def lookup(self, song_dict: dict, preset: str, folder: str = None):
+        """Path of the track's file (in `folder`, relative to the root), or None."""
+        source = source_key(song_dict)
+        if source is None:
+            return None
+        key = self.key(source, preset, folder)
+        with self.lock:
+            rel_path = self.entries.get(key)
+        if rel_path is None:
+            return None
+        full_path = os.path.join(self.root, rel_path)
+        if os.path.exists(full_path):
+            return full_path
+        with self.lock:
+            self.entries.pop(key, None)
+        return None
+
+    def owners(self):
+        """Casefolded absolute path -> source ID of every indexed file."""
+        with self.lock:
+            return {
+                os.path.join(self.root, rel_path).casefold(): key.split("|", 1)[0]
+                for key, rel_path in self.entries.items()
+            }
+
+    def add(self, song_dict: dict, preset: str, file_path: str):
+        source = source_key(song_dict)
+        if source is None or not file_path:
+            return
+        rel_path = os.path.relpath(file_path, self.root)
+        folder = os.path.dirname(rel_path) or "."
+        with self.lock:
+            self.entries[self.key(source, preset)] = rel_path
+            self.entries[self.key(source, preset, folder)] = rel_path
+            self.dirty = True
+            due = time.time() - self.last_save > SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def flush(self):
+        if self.dirty:
+            self.save()
+
+    def rebuild(self):
+        """Re-create the index from the source tags of every file, in parallel."""
+        library = LibraryIndex(self.root).refresh()
+        rel_paths = library.audio_files()
+
+        def read(rel_path):
+            try:
+                return rel_path, read_custom_tags(os.path.join(self.root, rel_path))
+            except Exception:
+                return rel_path, {}
+
+        entries = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for rel_path, tags in pool.map(read, rel_paths):
+                if tags.get(SOURCE_TAG) and tags.get(PRESET_TAG):
+                    source, preset = tags[SOURCE_TAG], tags[PRESET_TAG]
+                    folder = os.path.dirname(rel_path) or "."
+                    entries[self.key(source, preset)] = rel_path
+                    entries[self.key(source, preset, folder)] = rel_path
+        with self.lock:
+            self.entries = entries
+        self.save()
+        return len(entries)
+
+    def mark_existing(self, download_queue: list, targets: list):
+        """Set tracks that are already in the library to done, returns how many.
+
+        `targets` are the (root, preset) outputs, see output_targets(), the
+        first is this index's. Only a file in the track's own collection
+        folder counts, and only if the files of the other outputs (same name
+        in their root) exist too, otherwise the track is downloaded again to
+        make them. One that is elsewhere (downloaded for another collection)
+        becomes the track's "existing_file", which the download copies
+        instead of fetching.
+        """
+        preset = targets[0][1]
+        found = 0
+        for item in download_queue:
+            playlist = item["item-type"] == "playlist"
+            tracks = item["tracks"] if playlist else [item]
+            folder = sanitize(item["title"]) if playlist else "."
+            for track in tracks:
+                if track.get("status") not in ("waiting", "error"):
+                    continue
+                track.pop("existing_file", None)
+                file_path = self.lookup(track, preset, folder)
+                if not file_path:
+                    elsewhere = self.lookup(track, preset)
+                    if elsewhere:
+                        track["existing_file"] = elsewhere
+                    continue
+                extra_files = extra_output_files(file_path, folder, targets)
+                if extra_files is None:
+                    continue
+                track["status"] = "done"
+                track["file_path"] = file_path
+                if extra_files:
+                    track["extra_files"] = extra_files
+                found += 1
+        return found
+
+
+def open_download_index(root: str):
+    index = DownloadIndex(root)
+    if not index.loaded and os.path.isdir(root):
+        index.rebuild()
+    return index
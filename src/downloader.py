@@ -1,25 +1,35 @@
 import subprocess
 import json
 import re
+import importlib
+import threading
 
-import yt_dlp
-import ytmusicapi
-import ping3
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+# yt_dlp, ytmusicapi, spotipy, mutagen, ping3, requests and imageio_ffmpeg are
+# imported inside the functions that use them so that launching the UI stays fast.
 import os
-import imageio_ffmpeg as ffmpeg
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC
-from mutagen.mp4 import MP4, MP4Cover
-from mutagen.oggvorbis import OggVorbis
-from mutagen.flac import FLAC, Picture
-import requests
 import base64
+import copy
 
-import random
+import shutil
 import time
 
+from bandwidth import configure_bandwidth, connections, governor
+from consts import SOURCE_CACHE_DIR
+from info_cache import InfoCache, Prefetcher
+from matching import best_candidate, get_match_audit
+from metrics import metrics
+from output_paths import OutputPlanner, clean_filename, compile_template, template_data
+from replaygain import (
+    LOUDNESS_FILTER,
+    REPLAYGAIN_TAGS,
+    album_tags,
+    loudness_from_tags,
+    parse_ebur128,
+    track_tags,
+)
+from singleflight import SingleFlight
+from source_cache import get_source_cache
+
 # Constants
 
 quality_map = {
@@ -30,9 +40,31 @@ quality_map = {
     "M4A": {"ext": "m4a", "codec": "aac", "bitrate": "192K"},
     "FLAC": {"ext": "flac", "codec": "flac", "bitrate": "0"},
 }
+TEMP_DIR = ".TEMP"
+# Custom tags that tie a file back to where it came from
+SOURCE_TAG = "POWERAMP_DL_SOURCE"
+PRESET_TAG = "POWERAMP_DL_PRESET"
+MP4_FREEFORM_PREFIX = "----:com.apple.iTunes:"
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60  # seconds before an unused .part file is dropped
+FICLONE = 0x40049409  # Linux ioctl that reflinks a whole file
+ANALYZE_WORKERS = 4  # links analyzed at once by a bulk import
+SPOTIFY_TRACKS_BATCH = 50  # ids per sp.tracks() call, the API's maximum
+# A lossy source at 3/4 of a lossy target's bitrate is still transparent for it,
+# Opus and AAC need about that much less than MP3/Vorbis for the same quality
+SOURCE_ABR_RATIO = 0.75
+# Target codec -> prefix of yt-dlp's acodec for sources that can be stream copied
+COPY_CODECS = {"aac": "mp4a"}
+# yt-dlp options that change what extraction returns, shared by the prefetch
+# so a cached extraction is the one the download would have made
+EXTRACT_PARAMS = {"quiet": True}
+# Sources longer than this (seconds) are extracted again as range fragments,
+# fetched over several connections since YouTube throttles each one. Shorter
+# ones are faster as one plain request
+LONG_SOURCE_SECONDS = 900
+LONG_SOURCE_PARAMS = {"extractor_args": {"youtube": {"formats": ["dashy"]}}}
 tag_map = {
     "mp3": {
-        "handler": EasyID3,
+        "handler": ("mutagen.easyid3", "EasyID3"),
         "title": "title",
         "artist": "albumartist",
         "album": "album",
@@ -40,7 +72,7 @@ tag_map = {
         "track": "tracknumber",
     },
     "m4a": {
-        "handler": MP4,
+        "handler": ("mutagen.mp4", "MP4"),
         "title": "\xa9nam",
         "artist": "\xa9ART",
         "album": "\xa9alb",
@@ -48,7 +80,7 @@ tag_map = {
         "track": "trkn",
     },
     "ogg": {
-        "handler": OggVorbis,
+        "handler": ("mutagen.oggvorbis", "OggVorbis"),
         "title": "TITLE",
         "artist": "ARTIST",
         "album": "ALBUM",
@@ -56,7 +88,7 @@ tag_map = {
         "track": "TRACKNUMBER",
     },
     "flac": {
-        "handler": FLAC,
+        "handler": ("mutagen.flac", "FLAC"),
         "title": "TITLE",
         "artist": "ARTIST",
         "album": "ALBUM",
@@ -66,8 +98,33 @@ tag_map = {
 }
 
 
+_ffmpeg_path = None
+_ffmpeg_lock = threading.Lock()
+
+
 # Helper functions
+def get_ffmpeg_path():
+    global _ffmpeg_path
+    with _ffmpeg_lock:
+        if _ffmpeg_path is None:
+            import imageio_ffmpeg
+
+            _ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
+    return _ffmpeg_path
+
+
+def prefetch_ffmpeg_path():
+    threading.Thread(target=get_ffmpeg_path, daemon=True).start()
+
+
+def load_tag_handler(ext: str):
+    module_name, class_name = tag_map[ext]["handler"]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 def check_network():
+    import ping3
+
     is_online = ping3.ping("1.1.1.1")
     return is_online
 
@@ -77,38 +134,84 @@ def sanitize(s):
 
 
 def download_file(url: str, save_path: str):
+    import requests
+
     if check_network():
         r = requests.get(url, stream=True)
         r.raise_for_status()
         with open(save_path, "wb") as f:
             for chunk in r.iter_content(8192):
+                governor.consume(len(chunk))
                 f.write(chunk)
         return save_path
     else:
         raise ConnectionError("Failure to download cover art!")
 
 
-def template_decoder(template, data: dict = None, magic_char: str = "$"):
-    if data is None:
-        data = {}
-    final, opened, opened_keyword = "", False, ""
-    for char in template:
-        if not opened:
-            if char == magic_char:
-                opened = True
-            else:
-                final += char
-            continue
-        if opened:
-            if char == magic_char:
-                opened = False
-                final += str(data.get(opened_keyword, ""))
-                opened_keyword = ""
-            else:
-                opened_keyword += char
-            continue
+def is_partial_file(name: str):
+    return ".part" in name or name.endswith(".ytdl")
+
+
+def find_partials(youtube_id: str, temp_dir: str = TEMP_DIR):
+    if not os.path.isdir(temp_dir):
+        return []
+    return [
+        os.path.join(temp_dir, name)
+        for name in os.listdir(temp_dir)
+        if name.startswith(f"{youtube_id}.") and is_partial_file(name)
+    ]
+
+
+def cleanup_stale_partials(temp_dir: str = TEMP_DIR, max_age: int = PARTIAL_MAX_AGE):
+    if not os.path.isdir(temp_dir):
+        return 0
+    now = time.time()
+    removed = 0
+    with os.scandir(temp_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or not is_partial_file(entry.name):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def verify_audio_file(path: str, expected_size: int = None, demux: bool = True):
+    """Whether a downloaded file is whole.
+
+    With `demux` the stream is also read through once without decoding,
+    spliced files (a resumed partial that no longer matched) fail there.
+    """
+    if not path or not os.path.exists(path):
+        return False
+    if expected_size and os.path.getsize(path) != expected_size:
+        return False
+    if not demux:
+        return True
+    command = [
+        get_ffmpeg_path(),
+        "-v",
+        "error",
+        "-i",
+        path,
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        "-f",
+        "null",
+        "-",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    return result.returncode == 0 and not result.stderr.strip()
 
-    return re.sub(r'[<>:"/\\|?*\']', "", final).strip()
+
+def template_decoder(template, data: dict = None, magic_char: str = "$"):
+    return compile_template(template, magic_char).render(data or {})
 
 
 def transcode_audio(
@@ -117,54 +220,92 @@ def transcode_audio(
     filename: str,
     quality_preset: str = "MP3 256kbps",
     overwrite: bool = True,
+    threads: int = 0,
 ):
-
-    if not all([input_file, output_path, filename]):
-        raise ValueError("Input file, output path, and filename are required.")
-
     if quality_preset not in quality_map:
         raise ValueError(f"Invalid preset. Choose from: {list(quality_map.keys())}")
+    if not all([output_path, filename]):
+        raise ValueError("Input file, output path, and filename are required.")
+    output_file = os.path.join(
+        output_path, f"{clean_filename(filename)}.{quality_map[quality_preset]['ext']}"
+    )
+    return transcode_audio_multi(
+        input_file,
+        [(output_file, quality_preset)],
+        overwrite=overwrite,
+        threads=threads,
+    )[0]
 
-    if not os.path.exists(input_file):
-        raise FileNotFoundError(f"Input file not found: {input_file}")
-
-    if not os.path.exists(output_path):
-        os.makedirs(output_path, exist_ok=True)
-
-    settings = quality_map[quality_preset]
-    output_ext = settings["ext"]
-    bitrate = settings["bitrate"]
-    codec = settings["codec"]
-
-    clean_filename = "".join(
-        [c for c in filename if c.isalnum() or c in (" ", ".", "_", "-")]
-    ).rstrip()
-    output_file = os.path.join(output_path, f"{clean_filename}.{output_ext}")
 
-    if os.path.exists(output_file) and not overwrite:
-        raise FileExistsError(f"Output file already exists: {output_file}")
+def transcode_audio_multi(
+    input_file: str,
+    outputs: list,
+    overwrite: bool = True,
+    threads: int = 0,
+    loudness: dict = None,
+):
+    """Encode one input to several (output_file, preset) targets.
+
+    The source is decoded once, ffmpeg writes every output in the same run.
+    A target can carry a fourth item, True to stream copy the audio instead
+    of encoding it. Returns the output files in the order given. A `loudness` dict is filled
+    with the integrated loudness and true peak, measured from that same
+    decode by one more (null) output.
+    """
+    if not input_file or not outputs:
+        raise ValueError("Input file, output path, and filename are required.")
 
-    ffmpeg_path = ffmpeg.get_ffmpeg_exe()
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file not found: {input_file}")
 
+    ffmpeg_path = get_ffmpeg_path()
     command = [
         ffmpeg_path,
         "-loglevel",
-        "quiet",
+        "quiet" if loudness is None else "info",
+        "-nostats",
         "-i",
         input_file,
-        "-c:a",
-        codec,
+        "-y" if overwrite else "-n",
     ]
-    if bitrate != "0":
-        command.extend(["-b:a", bitrate])
-    if overwrite:
-        command.append("-y")
-    else:
-        command.append("-n")
-    command.append(output_file)
+    output_files = []
+    for output_file, quality_preset, *copy in outputs:
+        if not output_file:
+            raise ValueError("Input file, output path, and filename are required.")
+
+        if quality_preset not in quality_map:
+            raise ValueError(f"Invalid preset. Choose from: {list(quality_map.keys())}")
+
+        output_path = os.path.dirname(output_file)
+        if not os.path.exists(output_path):
+            os.makedirs(output_path, exist_ok=True)
+
+        settings = quality_map[quality_preset]
+        bitrate = settings["bitrate"]
+        codec = settings["codec"]
+
+        if os.path.exists(output_file) and not overwrite:
+            raise FileExistsError(f"Output file already exists: {output_file}")
+
+        # Embedded cover art is added back by add_cover_art
+        if copy and copy[0]:
+            command.extend(["-vn", "-c:a", "copy"])
+        else:
+            command.extend(["-vn", "-c:a", codec])
+            if threads:
+                command.extend(["-threads", str(threads)])
+            if bitrate != "0":
+                command.extend(["-b:a", bitrate])
+        command.append(output_file)
+        output_files.append(output_file)
+    if loudness is not None:
+        command.extend(["-vn", "-af", LOUDNESS_FILTER, "-f", "null", "-"])
+
     try:
-        subprocess.run(command, check=True, capture_output=True, text=True)
-        return output_file
+        process = subprocess.run(command, check=True, capture_output=True, text=True)
+        if loudness is not None:
+            loudness.update(parse_ebur128(process.stderr) or {})
+        return output_files
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"FFmpeg process failed: {e.stderr}")
 
@@ -181,7 +322,7 @@ def edit_audio_metadata(input_file: str, data: dict):
         raise ValueError(f"Unsupported format: {ext}")
 
     mapping = tag_map[ext]
-    audio = mapping["handler"](input_file)
+    audio = load_tag_handler(ext)(input_file)
 
     if ext == "m4a":
         if audio.tags is None:
@@ -235,6 +376,20 @@ def edit_audio_metadata(input_file: str, data: dict):
         else:
             tags[mapping["track"]] = track
 
+    for name, val in (data.get("custom_tags") or {}).items():
+        if ext == "mp3":
+            # Prefixed so names EasyID3 maps elsewhere (replaygain_*) stay TXXX
+            key = f"txxx:{name.lower()}"
+            if key not in audio.valid_keys:
+                audio.RegisterTXXXKey(key, name)
+            tags[key] = str(val)
+        elif ext == "m4a":
+            from mutagen.mp4 import MP4FreeForm
+
+            tags[MP4_FREEFORM_PREFIX + name] = [MP4FreeForm(str(val).encode("utf-8"))]
+        else:
+            tags[name] = str(val)
+
     if ext == "mp3":
         audio.save(v2_version=3)
     else:
@@ -243,16 +398,62 @@ def edit_audio_metadata(input_file: str, data: dict):
     return data
 
 
+def read_custom_tags(input_file: str, names=(SOURCE_TAG, PRESET_TAG)):
+    ext = os.path.splitext(input_file)[1].lstrip(".").lower()
+    if ext not in tag_map:
+        raise ValueError(f"Unsupported format: {ext}")
+
+    result = {}
+    if ext == "mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError
+
+        try:
+            frames = ID3(input_file).getall("TXXX")
+        except ID3NoHeaderError:
+            return result
+        for frame in frames:
+            if frame.desc in names and frame.text:
+                result[frame.desc] = str(frame.text[0])
+    elif ext == "m4a":
+        tags = load_tag_handler(ext)(input_file).tags or {}
+        for name in names:
+            value = tags.get(MP4_FREEFORM_PREFIX + name)
+            if value:
+                result[name] = bytes(value[0]).decode("utf-8")
+    else:
+        tags = load_tag_handler(ext)(input_file)
+        for name in names:
+            value = tags.get(name)
+            if value:
+                result[name] = value[0]
+    return result
+
+
+def source_key(song_dict: dict):
+    if song_dict.get("spotify_id"):
+        return f"spotify:{song_dict['spotify_id']}"
+    if song_dict.get("youtube_id"):
+        return f"youtube:{song_dict['youtube_id']}"
+    return None
+
+
 def add_cover_art(audio_path: str, image_path: str):
     if not os.path.exists(audio_path):
         raise FileNotFoundError(f"Audio file not found: {audio_path}")
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found: {image_path}")
 
+    from mutagen.id3 import ID3, APIC
+    from mutagen.mp4 import MP4, MP4Cover
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.flac import FLAC, Picture
+
     ext = os.path.splitext(audio_path)[1].lstrip(".").lower()
 
     with open(image_path, "rb") as img_file:
         image_data = img_file.read()
+    is_jpeg = image_data[:2] == b"\xff\xd8"
+    mime = "image/jpeg" if is_jpeg else "image/png"
 
     if ext == "mp3":
         try:
@@ -263,7 +464,7 @@ def add_cover_art(audio_path: str, image_path: str):
         audio.add(
             APIC(
                 encoding=3,
-                mime="image/png",
+                mime=mime,
                 type=3,
                 desc="Front Cover",
                 data=image_data,
@@ -273,7 +474,10 @@ def add_cover_art(audio_path: str, image_path: str):
 
     elif ext == "m4a":
         audio = MP4(audio_path)
-        cover = MP4Cover(image_data, imageformat=MP4Cover.FORMAT_PNG)
+        cover = MP4Cover(
+            image_data,
+            imageformat=MP4Cover.FORMAT_JPEG if is_jpeg else MP4Cover.FORMAT_PNG,
+        )
         audio.tags["covr"] = [cover]
         audio.save()
 
@@ -282,7 +486,7 @@ def add_cover_art(audio_path: str, image_path: str):
         picture = Picture()
         picture.data = image_data
         picture.type = 3
-        picture.mime = "image/png"
+        picture.mime = mime
         picture.desc = "Front Cover"
         audio.add_picture(picture)
         audio.save()
@@ -292,7 +496,7 @@ def add_cover_art(audio_path: str, image_path: str):
         picture = Picture()
         picture.data = image_data
         picture.type = 3
-        picture.mime = "image/png"
+        picture.mime = mime
         picture.desc = "Front Cover"
 
         picture_data = base64.b64encode(picture.write()).decode("ascii")
@@ -305,6 +509,105 @@ def add_cover_art(audio_path: str, image_path: str):
     return True
 
 
+def read_cover_art(audio_path: str):
+    """Bytes of the embedded front cover (or the first picture), None if none."""
+    ext = os.path.splitext(audio_path)[1].lstrip(".").lower()
+    pictures = []
+    if ext == "mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError
+
+        try:
+            pictures = [(f.type, f.data) for f in ID3(audio_path).getall("APIC")]
+        except ID3NoHeaderError:
+            return None
+    elif ext == "m4a":
+        from mutagen.mp4 import MP4
+
+        tags = MP4(audio_path).tags or {}
+        pictures = [(3, bytes(cover)) for cover in tags.get("covr", [])]
+    elif ext == "flac":
+        from mutagen.flac import FLAC
+
+        pictures = [(p.type, p.data) for p in FLAC(audio_path).pictures]
+    elif ext == "ogg":
+        from mutagen.flac import Picture
+        from mutagen.oggvorbis import OggVorbis
+
+        for data in OggVorbis(audio_path).get("metadata_block_picture", []):
+            picture = Picture(base64.b64decode(data))
+            pictures.append((picture.type, picture.data))
+    if not pictures:
+        return None
+    return next((data for kind, data in pictures if kind == 3), pictures[0][1])
+
+
+def copy_audio_tags(src: str, dst: str, custom_tags: dict = None):
+    """Copy every text tag mutagen can map between the two formats.
+
+    Source/preset tags are carried over by name and updated with `custom_tags`.
+    """
+    import mutagen
+
+    source = mutagen.File(src, easy=True)
+    target = mutagen.File(dst, easy=True)
+    if target.tags is None:
+        target.add_tags()
+    for key, values in (source.tags or {}).items():
+        if key.lower() == "metadata_block_picture" or key.upper() in (
+            SOURCE_TAG,
+            PRESET_TAG,
+            *REPLAYGAIN_TAGS,
+        ):
+            continue
+        try:
+            target[key] = values
+        except (KeyError, ValueError, TypeError):
+            pass
+    ext = os.path.splitext(dst)[1].lstrip(".").lower()
+    if ext == "mp3":
+        target.save(v2_version=3)
+    else:
+        target.save()
+
+    custom = {
+        **read_custom_tags(src, (SOURCE_TAG, PRESET_TAG, *REPLAYGAIN_TAGS)),
+        **(custom_tags or {}),
+    }
+    if custom:
+        edit_audio_metadata(dst, {"custom_tags": custom})
+
+
+def spotify_client():
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+
+    with open("../config.json", "r") as f:
+        config = json.load(f)
+
+    if config["sp_id"] == "" or config["sp_sec"] == "":
+        raise ValueError("No spotify tokens given!")
+
+    client_credentials_mgmt = SpotifyClientCredentials(
+        client_id=config["sp_id"], client_secret=config["sp_sec"]
+    )
+    return spotipy.Spotify(client_credentials_manager=client_credentials_mgmt)
+
+
+def spotify_fill_isrcs(sp, tracks: list):
+    """Set "isrc" on the track dicts that have none, in batched sp.tracks() calls.
+
+    Album listings carry no ISRCs, playlist items usually do already.
+    """
+    missing = [t for t in tracks if not t.get("isrc") and t.get("spotify_id")]
+    for start in range(0, len(missing), SPOTIFY_TRACKS_BATCH):
+        batch = missing[start : start + SPOTIFY_TRACKS_BATCH]
+        with metrics.span("isrc"):
+            result = sp.tracks([t["spotify_id"] for t in batch])
+        for track_dict, track in zip(batch, result["tracks"]):
+            if track:
+                track_dict["isrc"] = (track.get("external_ids") or {}).get("isrc")
+
+
 def spotify_get_initial(link):
     try:
         if "playlist/" not in link and "album/" not in link and "track/" not in link:
@@ -317,17 +620,8 @@ def spotify_get_initial(link):
         if spotify_id is None:
             raise ValueError("Invalid spotify id given!")
 
-        with open("../config.json", "r") as f:
-            config = json.load(f)
-
-        if config["sp_id"] == "" or config["sp_sec"] == "":
-            raise ValueError("No spotify tokens given!")
-
         return_dict = {}
-        client_credentials_mgmt = SpotifyClientCredentials(
-            client_id=config["sp_id"], client_secret=config["sp_sec"]
-        )
-        sp = spotipy.Spotify(client_credentials_manager=client_credentials_mgmt)
+        sp = spotify_client()
         if "playlist/" in link:
             collection_data = sp.playlist(spotify_id)
 
@@ -338,6 +632,7 @@ def spotify_get_initial(link):
             )
             return_dict["type"] = "spotify"
             return_dict["item-type"] = "playlist"
+            return_dict["snapshot_id"] = collection_data.get("snapshot_id")
 
             return_result = sp.playlist_items(spotify_id)
 
@@ -377,6 +672,9 @@ def spotify_get_initial(link):
                 track_dict["track_number"] = i + 1
                 track_dict["status"] = "waiting"
                 track_dict["spotify_id"] = track["track"].get("id", None)
+                track_dict["isrc"] = (track["track"].get("external_ids") or {}).get(
+                    "isrc"
+                )
                 track_dict["type"] = "spotify"
                 track_dict["item-type"] = "track"
                 return_dict["tracks"].append(track_dict)
@@ -417,6 +715,8 @@ def spotify_get_initial(link):
                 track_dict["type"] = "spotify"
                 track_dict["item-type"] = "track"
                 return_dict["tracks"].append(track_dict)
+        if "tracks" in return_dict:
+            spotify_fill_isrcs(sp, return_dict["tracks"])
         if "track/" in link:
             track_data = sp.track(spotify_id)
 
@@ -440,6 +740,7 @@ def spotify_get_initial(link):
             return_dict["track_number"] = 1
             return_dict["status"] = "waiting"
             return_dict["spotify_id"] = track_data.get("id", None)
+            return_dict["isrc"] = (track_data.get("external_ids") or {}).get("isrc")
             return_dict["type"] = "spotify"
             return_dict["item-type"] = "track"
 
@@ -449,6 +750,8 @@ def spotify_get_initial(link):
 
 
 def youtube_get_initial(link):
+    import ytmusicapi
+
     try:
         if "list" not in link and "watch?v=" not in link:
             raise ValueError("Not a valid Link!")
@@ -545,54 +848,342 @@ def soundcloud_get_initial(link):
     pass
 
 
+def get_initial(link):
+    domain = link.removeprefix("https://").removeprefix("http://").split("/")[0]
+    if "youtube.com" in domain or "youtu.be" in domain:
+        with metrics.span("analyze", track=link):
+            return youtube_get_initial(link.split("&si=")[0])
+    if "spotify.com" in domain:
+        with metrics.span("analyze", track=link):
+            return spotify_get_initial(link)
+    raise ValueError(f"Service at {domain} is not supported!")
+
+
+def normalize_link(link: str):
+    """Subscription key of a link, share-tracking parameters stripped."""
+    return link.strip().split("?si=")[0].split("&si=")[0]
+
+
+def split_links(text: str):
+    """Links in pasted text or a links file, in order and without repeats.
+
+    Links may be separated by newlines or spaces, lines starting with '#'
+    are comments.
+    """
+    links = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            links.extend(line.split())
+    return list(dict.fromkeys(normalize_link(link) for link in links))
+
+
+def analyze_links(links: list, on_result, workers: int = ANALYZE_WORKERS):
+    """Run get_initial() on every link, at most `workers` at a time.
+
+    `on_result(link, result_dict, error)` is called from the worker thread as
+    soon as each link is done, so results arrive in completion order.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def analyze(link):
+        try:
+            result_dict = get_initial(link)
+        except Exception as e:
+            on_result(link, None, e)
+            return
+        on_result(link, result_dict, None)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(analyze, links))
+
+
+def collection_snapshot(link):
+    """Cheap change token for a collection, None when the service has none.
+
+    Only Spotify playlists have one (snapshot_id), it changes whenever the
+    playlist does and is fetched without listing the tracks.
+    """
+    domain = link.removeprefix("https://").removeprefix("http://").split("/")[0]
+    if "spotify.com" not in domain or "playlist/" not in link:
+        return None
+    spotify_id = link.split("/")[-1].split("?")[0]
+    with metrics.span("snapshot", track=link):
+        return spotify_client().playlist(spotify_id, fields="snapshot_id")[
+            "snapshot_id"
+        ]
+
+
 # Download functions for service
 
 
-def download_spotify(song_dict, callback=None):
-    os.makedirs(".TEMP", exist_ok=True)
-    search_query = f"{sanitize(' '.join(song_dict['artists']))} {song_dict['title']}"
+def source_cache():
+    """The raw source cache configured in config.json, None when disabled."""
+    with open("../config.json", "r") as f:
+        config = json.load(f)
+    return get_source_cache(
+        config.get("source_cache_dir") or SOURCE_CACHE_DIR,
+        config.get("source_cache_mb", 0),
+    )
+
+
+def download_spotify(song_dict, callback=None, presets: list = None):
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    cache = source_cache()
+    key = source_key(song_dict)
+    video_id = cache.video_for(key) if cache and key else None
+    if video_id is None:
+        video_id = search_spotify_track(song_dict, callback)
+        if cache and key:
+            cache.add_alias(key, video_id)
+    result = acquire_source(video_id, presets)
+    if callback:
+        callback(f"Done {result}", "log")
+    return result, video_id
+
+
+def search_spotify_track(song_dict, callback=None):
+    """YouTube Music video for a Spotify track.
+
+    The ISRC is searched first, then artist and title among songs and at
+    last among videos. Every result is scored (matching.py), ones of the
+    wrong length are rejected before anything is downloaded, and the scores
+    go to the download root's match audit log.
+    """
+    import ytmusicapi
+
     if not check_network():
         raise ConnectionError("No internet connection!")
     yt_music_api = ytmusicapi.YTMusic()
-    result_for_search = yt_music_api.search(search_query, filter="songs", limit=10)
-    video_id = None
-    for i in result_for_search:
-        if (
-            str(i.get("artists", [{}])[0].get("name")).lower()
-            in str(" ".join(song_dict["artists"])).lower()
-        ):
-            video_id = i.get("videoId")
+    search_query = f"{sanitize(' '.join(song_dict['artists']))} {song_dict['title']}"
+    searches = [(search_query, "songs", 10), (search_query, "videos", 10)]
+    if song_dict.get("isrc"):
+        searches.insert(0, (song_dict["isrc"], "songs", 5))
+
+    best, audited = None, []
+    for query, kind, limit in searches:
+        with metrics.span("search", track=song_dict.get("spotify_id")):
+            result_for_search = yt_music_api.search(query, filter=kind, limit=limit)
+        best, scored = best_candidate(song_dict, result_for_search)
+        audited.append({"query": query, "filter": kind, "candidates": scored})
+        if callback:
+            callback(f"Searched {kind} for {query}: {len(scored)} results", "log")
+        if best:
             break
-    video_id = video_id if video_id is not None else result_for_search[0]["videoId"]
-    if callback:
-        callback(f"Searched for {search_query}", "log")
-    if callback:
-        callback(f"Result is {result_for_search}", "log")
-    if callback:
-        callback(f"Final id {video_id}", "log")
-    result = download_youtube(video_id)
+
+    with open("../config.json", "r") as f:
+        download_path = json.load(f)["path"]
+    get_match_audit(download_path).record(
+        {
+            "spotify_id": song_dict.get("spotify_id"),
+            "isrc": song_dict.get("isrc"),
+            "title": song_dict["title"],
+            "artists": song_dict["artists"],
+            "duration": song_dict.get("duration_seconds"),
+            "chosen": best["videoId"] if best else None,
+            "searches": audited,
+        }
+    )
+    if best is None:
+        raise ValueError(
+            f"No search result matches {song_dict['title']} "
+            f"({song_dict.get('duration_seconds')} s)"
+        )
     if callback:
-        callback(f"Done {result}", "log")
-    return result["file_path"], result_for_search[0]["videoId"]
+        callback(f"Final id {best['videoId']} (score {best['score']})", "log")
+    return best["videoId"]
+
+
+def source_format(presets: list = None):
+    """yt-dlp format selection matched to the target presets.
+
+    Returns (format, format_sort, min_abr). Lossless targets get the best
+    stream (min_abr is infinite). Lossy ones get the smallest stream of at least SOURCE_ABR_RATIO
+    times the highest target bitrate, preferring one whose codec can be
+    stream copied.
+    """
+    settings = [quality_map[preset] for preset in presets or []]
+    if not settings or any(s["bitrate"] == "0" for s in settings):
+        return "bestaudio/best", [], float("inf")
+    kbps = max(int(s["bitrate"].rstrip("K")) for s in settings)
+    min_abr = int(kbps * SOURCE_ABR_RATIO)
+    selectors = [
+        f"bestaudio[acodec^={COPY_CODECS[s['codec']]}][abr>={min_abr}]"
+        for s in settings
+        if s["codec"] in COPY_CODECS
+    ]
+    selectors += [f"bestaudio[abr>={min_abr}]"]
+    # Smallest first, so "best" of the matching streams is the cheapest one.
+    # When none reaches min_abr, "worst" under that sort is the highest bitrate
+    selectors += ["worstaudio", "worst"]
+    return "/".join(dict.fromkeys(selectors)), ["+abr"], min_abr
+
 
+def _bytes_saved(info: dict, download: dict):
+    """Transfer saved against the largest audio-only stream on offer."""
+
+    def size(f):
+        return f.get("filesize") or f.get("filesize_approx") or 0
+
+    audio = [
+        f
+        for f in info.get("formats") or []
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+    ]
+    if not audio or not size(download):
+        return 0
+    largest = max(audio, key=lambda f: (f.get("abr") or 0, size(f)))
+    return max(size(largest) - size(download), 0)
+
+
+def stream_copy(source: dict, preset: str):
+    """Whether a downloaded source can go into `preset` without re-encoding."""
+    settings = quality_map[preset]
+    prefix = COPY_CODECS.get(settings["codec"])
+    abr = source.get("abr")
+    return bool(
+        prefix
+        and (source.get("acodec") or "").startswith(prefix)
+        and abr
+        and abr <= int(settings["bitrate"].rstrip("K"))
+    )
+
+
+# Extraction results by video id, made during analysis and used by the download
+info_cache = InfoCache()
+
+
+def extract_youtube(youtube_id):
+    """yt-dlp's extraction of a video, not processed into a format choice yet."""
+    import yt_dlp
+
+    def extract(params):
+        # YoutubeDL fills its defaults into the params it is given
+        with yt_dlp.YoutubeDL(copy.deepcopy(params)) as ydl:
+            return ydl.extract_info(
+                f"https://music.youtube.com/watch?v={youtube_id}",
+                download=False,
+                process=False,
+            )
+
+    with metrics.span("extract", track=youtube_id):
+        info = extract(EXTRACT_PARAMS)
+        if (info.get("duration") or 0) > LONG_SOURCE_SECONDS:
+            info = extract({**EXTRACT_PARAMS, **LONG_SOURCE_PARAMS})
+        return info
+
+
+extraction_prefetcher = Prefetcher(info_cache, extract_youtube)
+
+
+def prefetch_extraction(tracks: list):
+    """Extract queued YouTube tracks in the background, in download order.
+
+    Tracks whose source is already cached are left out, their download never
+    extracts.
+    """
+    cache = source_cache()
+    video_ids = [
+        track["youtube_id"]
+        for track in tracks
+        if track.get("type") == "youtube"
+        and track.get("youtube_id")
+        and track.get("status") != "done"
+        and not (cache and cache.has_audio(track["youtube_id"]))
+    ]
+    extraction_prefetcher.submit(video_ids)
+
+
+def download_youtube(youtube_id, presets: list = None):
+    import yt_dlp
 
-def download_youtube(youtube_id):
     if not check_network():
         raise ConnectionError("No internet connection!")
     if youtube_id is None:
         raise ValueError("No youtube id given!")
     if len(youtube_id) != 11:
         ValueError("Invalid youtube id given!")
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    cleanup_stale_partials()
+    resumed = bool(find_partials(youtube_id))
+    format_selector, format_sort, _ = source_format(presets)
     ydl_config = {
-        "format": "bestaudio/best",
-        "outtmpl": f".TEMP/{youtube_id}.%(ext)s",
-        "quiet": True,
+        "format": format_selector,
+        "format_sort": format_sort,
+        "outtmpl": f"{TEMP_DIR}/{youtube_id}.%(ext)s",
+        **copy.deepcopy(EXTRACT_PARAMS),
+        "noprogress": True,
+        # Shares the process-wide bandwidth budget with every other download
+        "progress_hooks": [governor.progress_hook()],
+        # Keep .part files between attempts and continue them with range requests
+        "continuedl": True,
+        "nopart": False,
+        "retries": 10,
+        "fragment_retries": 10,
     }
+
+    def process(ydl, info):
+        # One connection per fragment, as far as the budget allows. The
+        # format is not picked yet, so plan for the most fragmented audio one
+        fragments = max(
+            [
+                len(f.get("fragments") or [])
+                for f in info.get("formats") or []
+                if f.get("vcodec") == "none"
+            ]
+            + [1]
+        )
+        with connections.reserve(fragments) as granted:
+            ydl.params["concurrent_fragment_downloads"] = granted
+            return ydl.process_ie_result(info, download=True)
+
+    def fetch():
+        # Usually extracted ahead by prefetch_extraction(), or once here
+        info, reused = info_cache.get_or_extract(youtube_id, extract_youtube)
+        with metrics.span("fetch", track=youtube_id) as span:
+            with yt_dlp.YoutubeDL(ydl_config) as ydl:
+                try:
+                    info = process(ydl, info)
+                except yt_dlp.utils.DownloadError:
+                    if not reused:
+                        raise
+                    # The stored stream URLs stopped working early, extract again
+                    info_cache.invalidate(youtube_id)
+                    info = process(
+                        ydl, info_cache.get_or_extract(youtube_id, extract_youtube)[0]
+                    )
+            download = info["requested_downloads"][0]
+            span["bytes"] = os.path.getsize(download["filepath"])
+        return info, download
+
+    def verify(download):
+        # Only a resumed download can be spliced, a fresh one needs no extra pass
+        with metrics.span("verify", track=youtube_id):
+            return verify_audio_file(
+                download["filepath"], download.get("filesize"), demux=resumed
+            )
+
     try:
-        with yt_dlp.YoutubeDL(ydl_config) as ydl:
-            info = ydl.extract_info(f"https://music.youtube.com/watch?v={youtube_id}")
+        info, download = fetch()
+        audio_file = download["filepath"]
+        if not verify(download):
+            if not resumed:
+                raise RuntimeError(
+                    f"Downloaded file failed integrity check: {audio_file}"
+                )
+            # The resumed partial did not match the remote file, start over once
+            for leftover in [audio_file, *find_partials(youtube_id)]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            ydl_config["continuedl"] = False
+            resumed = False
+            info, download = fetch()
+            audio_file = download["filepath"]
+            if not verify(download):
+                raise RuntimeError(
+                    f"Downloaded file failed integrity check: {audio_file}"
+                )
 
-        audio_file = info["requested_downloads"][0]["filepath"]
         title = sanitize(info.get("title", "Unknown Title"))
         artist_list = info.get("artists", [info.get("uploader", "Unknown Artist")])
         artist_str = sanitize(", ".join(artist_list))
@@ -616,65 +1207,474 @@ def download_youtube(youtube_id):
             "release": release_year,
             "length": length,
             "cover_url": cover_url,
+            "format_id": download.get("format_id"),
+            "acodec": download.get("acodec"),
+            "abr": download.get("abr"),
+            "bytes_saved": _bytes_saved(info, download),
             "file_path": audio_file,
         }
     except Exception as e:
         raise e
 
 
+# Sharing work between duplicate jobs
+
+
+def _remove_source(result):
+    if not result:
+        return
+    if result.get("cache_key"):
+        # Cached sources stay, they are only unpinned for eviction
+        cache = source_cache()
+        if cache:
+            cache.unpin(result["cache_key"])
+    elif os.path.exists(result["file_path"]):
+        os.remove(result["file_path"])
+
+
+# Downloaded sources by video id, removed once every job using them is done
+source_flights = SingleFlight(cleanup=_remove_source)
+# Finished outputs by "source|preset", of the current run (see plan_outputs())
+output_flights = SingleFlight()
+finished_outputs = {}
+finished_outputs_lock = threading.Lock()
+
+
+def fetch_source(youtube_id, presets: list = None):
+    cache = source_cache()
+    if cache:
+        result = cache.get_audio(youtube_id, min_abr=source_format(presets)[2])
+        if result:
+            metrics.record("cache_hit", 0.0, track=youtube_id)
+            return result
+    result = download_youtube(youtube_id, presets)
+    if result["bytes_saved"]:
+        metrics.record(
+            "format_saved", 0.0, track=youtube_id, nbytes=result["bytes_saved"]
+        )
+    return cache.put_audio(youtube_id, result) if cache else result
+
+
+def acquire_source(youtube_id, presets: list = None):
+    """Downloaded (or cached) source shared between concurrent jobs.
+
+    `presets` are the targets it is for, they decide the stream fetched.
+    Pair every call with release_source().
+    """
+    return source_flights.acquire(
+        youtube_id, lambda: fetch_source(youtube_id, presets)
+    )[0]
+
+
+def release_source(youtube_id):
+    source_flights.release(youtube_id)
+
+
+def clone_file(src: str, dst: str):
+    """Copy a file, as a reflink where the filesystem supports it."""
+    try:
+        import fcntl
+
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def unshare_file(path: str):
+    """Give a hardlinked file its own copy, so retagging it touches no other."""
+    if os.stat(path).st_nlink < 2:
+        return
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    clone_file(path, temp_path)
+    os.replace(temp_path, path)
+
+
+def place_duplicate(source: tuple, target: str, data: dict, custom_tags: dict):
+    """Put an already finished output at another path under its own tags.
+
+    Identical tags get a hardlink, otherwise the file is reflinked or copied
+    and retagged. Returns the new path.
+    """
+    source_path, source_data = source
+    ext = os.path.splitext(source_path)[1]
+    if os.path.abspath(target) == os.path.abspath(source_path):
+        return source_path
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_path = f"{target}.{threading.get_ident()}.tmp"
+    try:
+        linked = False
+        if data == source_data:
+            try:
+                os.link(source_path, temp_path)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            clone_file(source_path, temp_path)
+            # The temp name hides the extension the tag handler is picked by
+            retag_path = f"{temp_path}{ext}"
+            os.replace(temp_path, retag_path)
+            temp_path = retag_path
+            edit_audio_metadata(temp_path, {**data, "custom_tags": custom_tags})
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return target
+
+
+def output_targets(config: dict):
+    """(root, preset) of every output, the main path and quality come first.
+
+    More come from "extra_outputs": [{"path": ..., "quality": ...}, ...].
+    """
+    targets = [(config["path"], config["quality"])]
+    for extra in config.get("extra_outputs") or []:
+        target = (extra["path"], extra.get("quality") or config["quality"])
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+
+# Output paths, planned for the whole queue before downloading
+
+
+def track_key(song_dict: dict):
+    """Who an output path belongs to, the same for duplicates of a track."""
+    return source_key(song_dict) or f"track:{id(song_dict)}"
+
+
+# Planner of the current run, see plan_outputs()
+output_planner = OutputPlanner()
+
+
+def plan_outputs(download_queue: list, download_index=None):
+    """Decide the output files of every queued track in one pass.
+
+    Tracks still to download get "planned_files", one per output target.
+    They are planned in queue order, so the same queue gets the same names,
+    around the files of finished tracks and those the download index knows.
+    A YouTube track whose name uses fields of its source is left to claim
+    its paths when it has them. Returns how many tracks were planned.
+    """
+    global output_planner
+    with open("../config.json", "r") as f:
+        config = json.load(f)
+    # Files of an earlier run may have been changed or removed since
+    with finished_outputs_lock:
+        finished_outputs.clear()
+    template = compile_template(config["filename_template"])
+    planner = OutputPlanner(download_index.owners() if download_index else None)
+    planned = 0
+    for item in download_queue:
+        playlist = item["item-type"] == "playlist"
+        folder_name = sanitize(item["title"]) if playlist else None
+        targets = [
+            (
+                root if folder_name is None else os.path.join(root, folder_name),
+                quality_map[preset]["ext"],
+            )
+            for root, preset in output_targets(config)
+        ]
+        for track in item["tracks"] if playlist else [item]:
+            if track.get("status") not in ("waiting", "error"):
+                if track.get("file_path"):
+                    files = [track["file_path"], *track.get("extra_files", [])]
+                    planner.keep(track_key(track), files)
+                continue
+            track.pop("planned_files", None)
+            if template.needs_source(track):
+                continue
+            try:
+                name = template.render(template_data(track))
+                track["planned_files"] = planner.claim(track_key(track), name, targets)
+            except (KeyError, ValueError):
+                # Fails the same way when it is downloaded, with the error shown
+                continue
+            planned += 1
+    output_planner = planner
+    return planned
+
+
+def output_files(song_dict: dict, targets: list, config: dict):
+    """Output file of a track for each (folder, preset) target."""
+    planned = song_dict.get("planned_files")
+    if planned and len(planned) == len(targets):
+        return planned
+    # Not planned (yet), claimed from the same planner now
+    name = compile_template(config["filename_template"]).render(
+        template_data(song_dict)
+    )
+    return output_planner.claim(
+        track_key(song_dict),
+        name,
+        [(folder, quality_map[preset]["ext"]) for folder, preset in targets],
+    )
+
+
 # A wrapper function for all the download functions
 
 
 def download_single(song_dict: dict, folder_name: str = None, callback=None):
-    # Download initial file from service
-    if song_dict["type"] == "youtube":
-        result = download_youtube(song_dict["youtube_id"])
-        song_dict["album"] = result["album"]
-        song_dict["release"] = result["release"]
-        song_dict["duration_seconds"] = result["length"]
-        id = result["id"]
-        music_filename = result["file_path"]
-    if song_dict["type"] == "spotify":
-        music_filename, id = download_spotify(song_dict, callback)
+    # Figure out folder names, one per output target
+
+    with open("../config.json", "r") as f:
+        config = json.load(f)
+    configure_bandwidth(config)
+
+    targets = [
+        (root if folder_name is None else os.path.join(root, folder_name), preset)
+        for root, preset in output_targets(config)
+    ]
+    templater_data = template_data(song_dict)
+    source = source_key(song_dict)
+    existing = song_dict.pop("existing_file", None)
+    if existing and len(targets) == 1 and os.path.exists(existing):
+        # In the library for another collection, this one gets its own copy
+        if callback:
+            callback("metadata", "status")
+        with metrics.span("dedup", track=source):
+            custom_tags = {PRESET_TAG: targets[0][1], SOURCE_TAG: source}
+            output = place_duplicate(
+                (existing, None),
+                output_files(song_dict, targets, config)[0],
+                templater_data,
+                custom_tags,
+            )
+        set_output_files(song_dict, [output])
+        if callback:
+            callback("done", "status")
+        return output
+    if not source:
+        outputs = _download_single(song_dict, targets, config, callback)[0]
+        if callback:
+            callback("done", "status")
+        return outputs[0]
+
+    # The same track queued several times is downloaded and transcoded once
+    flight_key = "|".join([source, *(preset for _, preset in targets)])
+    with finished_outputs_lock:
+        finished = finished_outputs.get(flight_key)
+    shared = finished is not None and all(os.path.exists(p) for p in finished[0])
+    if not shared:
+        finished, shared = output_flights.acquire(
+            flight_key,
+            lambda: _download_single(song_dict, targets, config, callback),
+        )
+        output_flights.release(flight_key)
+        outputs = finished[0]
+        with finished_outputs_lock:
+            finished_outputs[flight_key] = finished
+        if not shared:
+            if callback:
+                callback("done", "status")
+            return outputs[0]
+
+    if callback:
+        callback(f"Reusing {finished[0][0]} for {flight_key}", "log")
+        callback("metadata", "status")
+    # Fields the first job filled in from the source apply to this copy too
+    song_dict["album"] = templater_data["album"] = finished[1]["album"]
+    song_dict["release"] = templater_data["year"] = finished[1]["year"]
+    song_dict["duration_seconds"] = templater_data["length"] = finished[1]["length"]
+    if finished[2]:
+        song_dict["loudness"] = finished[2]
+    outputs = []
+    with metrics.span("dedup", track=flight_key):
+        for finished_path, target, (_, preset) in zip(
+            finished[0], output_files(song_dict, targets, config), targets
+        ):
+            outputs.append(
+                place_duplicate(
+                    (finished_path, finished[1]),
+                    target,
+                    templater_data,
+                    {PRESET_TAG: preset, SOURCE_TAG: source},
+                )
+            )
+    if callback:
+        callback("done", "status")
+    set_output_files(song_dict, outputs)
+    return outputs[0]
 
-    # Figure out folder name
 
+def share_outputs(song_dict: dict, shared: dict = None):
+    """Take what another process finished of the track in this run, if anything.
+
+    `shared` is the finished track, this process forgets what it has of the
+    track when it is None, it may be from an earlier run.
+    """
     with open("../config.json", "r") as f:
         config = json.load(f)
+    presets = [preset for _, preset in output_targets(config)]
+    source = source_key(song_dict)
+    if not source:
+        return
+    flight_key = "|".join([source, *presets])
+    outputs = [None]
+    if shared:
+        outputs = [shared.get("file_path"), *shared.get("extra_files", [])]
+    with finished_outputs_lock:
+        if not outputs[0] or len(outputs) != len(presets):
+            finished_outputs.pop(flight_key, None)
+        else:
+            finished_outputs[flight_key] = (
+                outputs,
+                template_data(shared),
+                shared.get("loudness"),
+            )
+
+
+def run_track_job(job: dict, callback):
+    """Downloads a serialized track job, returns the updated track.
+
+    Jobs are {"song": song_dict, "folder": folder_name, ...}, the form in
+    which tracks go to worker processes and other nodes.
+    """
+    song_dict = job["song"]
+    if "shared" in job:
+        share_outputs(song_dict, job["shared"])
+    callback("downloading")
+    download_single(song_dict=song_dict, folder_name=job["folder"], callback=callback)
+    # The status is the submitting side's, it follows the reported states
+    return {key: value for key, value in song_dict.items() if key != "status"}
 
-    if folder_name is None:
-        output_folder = config["path"]
+
+def set_output_files(song_dict: dict, outputs: list):
+    song_dict["file_path"] = outputs[0]
+    if len(outputs) > 1:
+        song_dict["extra_files"] = outputs[1:]
     else:
-        output_folder = os.path.join(config["path"], folder_name)
-        os.makedirs(output_folder, exist_ok=True)
+        song_dict.pop("extra_files", None)
+
+
+def _download_single(song_dict: dict, targets: list, config: dict, callback=None):
+    # Download initial file from service
+    presets = [preset for _, preset in targets]
+    if song_dict["type"] == "youtube":
+        source = acquire_source(song_dict["youtube_id"], presets)
+        song_dict["album"] = source["album"]
+        song_dict["release"] = source["release"]
+        song_dict["duration_seconds"] = source["length"]
+        id = source["id"]
+    if song_dict["type"] == "spotify":
+        source, id = download_spotify(song_dict, callback, presets)
+    if callback and source.get("bytes_saved"):
+        callback(
+            f"Fetched format {source.get('format_id')} ({source.get('abr')}k), "
+            f"{source['bytes_saved']} bytes less than the best stream",
+            "log",
+        )
+    try:
+        result = _transcode_single(
+            song_dict, source["file_path"], id, targets, config, callback, source
+        )
+    finally:
+        if callback:
+            callback("cleaning", "status")
+        release_source(id)
+    return result
+
+
+def _transcode_single(
+    song_dict: dict,
+    music_filename: str,
+    id: str,
+    targets: list,
+    config: dict,
+    callback=None,
+    source: dict = None,
+):
     if callback:
         callback("transcoding", "status")
-    templater_data = {
-        "title": song_dict["title"],
-        "artist": ", ".join(song_dict["artists"]),
-        "artists": song_dict["artists"],
-        "album": song_dict["album"],
-        "year": song_dict["release"],
-        "length": song_dict["duration_seconds"],
-        "platform": song_dict["type"],
-        "track_number": int(song_dict["track_number"]),
-    }
-    final_filename = template_decoder(config["filename_template"], data=templater_data)
-    # Transcode
-    ffmpeg_out = transcode_audio(
-        music_filename, output_folder, final_filename, quality_preset=config["quality"]
-    )
+    templater_data = template_data(song_dict)
+    # Transcode, one decode for every output
+    loudness = {} if config.get("replaygain") else None
+    with metrics.span("transcode", track=id) as span:
+        outputs = transcode_audio_multi(
+            music_filename,
+            [
+                (output_file, preset, stream_copy(source or {}, preset))
+                for output_file, (_, preset) in zip(
+                    output_files(song_dict, targets, config), targets
+                )
+            ],
+            loudness=loudness,
+        )
+        span["bytes"] = sum(os.path.getsize(output) for output in outputs)
     # Add text based metadata
     if callback:
         callback("metadata", "status")
-    edit_audio_metadata(ffmpeg_out, data=templater_data)
+    with metrics.span("tagging", track=id):
+        for output, (_, preset) in zip(outputs, targets):
+            custom_tags = {PRESET_TAG: preset}
+            if source_key(song_dict):
+                custom_tags[SOURCE_TAG] = source_key(song_dict)
+            if loudness:
+                custom_tags.update(track_tags(loudness))
+            edit_audio_metadata(
+                output, data={**templater_data, "custom_tags": custom_tags}
+            )
     # Add cover
     if song_dict.get("thumbnail"):
-        cover_file = download_file(song_dict["thumbnail"], f".TEMP/{sanitize(id)}.png")
-        add_cover_art(ffmpeg_out, f".TEMP/{sanitize(id)}.png")
-        os.remove(cover_file)
-    if callback:
-        callback("cleaning", "status")
-    os.remove(music_filename)
-    if callback:
-        callback("done", "status")
+        with metrics.span("cover", track=id) as span:
+            cover_file = os.path.join(
+                TEMP_DIR, f"{sanitize(id)}-{threading.get_ident()}.png"
+            )
+            cache = source_cache()
+            if cache:
+                cache.fetch_cover(song_dict["thumbnail"], cover_file, download_file)
+            else:
+                download_file(song_dict["thumbnail"], cover_file)
+            span["bytes"] = os.path.getsize(cover_file)
+            for output in outputs:
+                add_cover_art(output, cover_file)
+            os.remove(cover_file)
+    set_output_files(song_dict, outputs)
+    if loudness:
+        song_dict["loudness"] = loudness
+    return outputs, templater_data, loudness
+
+
+def write_album_gain(tracks: list, folder_name: str = None):
+    """Tag the finished tracks of a collection with its album ReplayGain.
+
+    Runs after the collection's downloads, from loudness measured during
+    transcoding (or read back from the tags of tracks from earlier runs),
+    so nothing is decoded again. With `folder_name` only files in folders of
+    that name are tagged, a track's file elsewhere belongs to another
+    collection. Returns the number of files tagged.
+    """
+    import mutagen
+
+    done = [t for t in tracks if t.get("status") == "done" and t.get("file_path")]
+    # Nothing measured this run means nothing changed
+    if not any(t.get("loudness") for t in done):
+        return 0
+    measured = []
+    for track in done:
+        loudness = track.get("loudness") or loudness_from_tags(
+            read_custom_tags(track["file_path"], REPLAYGAIN_TAGS)
+        )
+        if not loudness:
+            # A gain from part of the collection would be wrong
+            return 0
+        length = mutagen.File(track["file_path"]).info.length
+        measured.append((loudness, length))
+    tags = album_tags(measured)
+    tagged = 0
+    with metrics.span("album_gain"):
+        for track in done:
+            paths = [track["file_path"], *track.get("extra_files", [])]
+            for path in dict.fromkeys(paths):
+                folder = os.path.basename(os.path.dirname(path))
+                if folder_name is not None and folder != folder_name:
+                    continue
+                unshare_file(path)
+                edit_audio_metadata(path, {"custom_tags": tags})
+                tagged += 1
+    return tagged
@@ -0,0 +1,488 @@
+import json
+import sys
+import threading
+import time
+
+from consts import CONFIG_FILE
+from downloader import *
+from metrics import metrics
+from download_index import DownloadIndex, open_download_index
+from playlist import *
+from sync import (
+    SyncState,
+    check_snapshots,
+    diff_collection,
+    handle_removed,
+    mark_synced,
+)
+from redis_queue import RedisQueueSystem
+from threader import *
+
+# Exit codes
+EXIT_OK = 0
+EXIT_TRACK_FAILED = 1
+EXIT_ANALYSIS_FAILED = 2
+EXIT_NO_INPUT = 3
+
+
+def read_links(links: list, file_path: str = None, use_stdin: bool = False):
+    raw = [link for link in links if link != "-"]
+    use_stdin = use_stdin or "-" in links
+    if file_path:
+        with open(file_path, "r", encoding="utf-8") as f:
+            raw.append(f.read())
+    if use_stdin:
+        raw.append(sys.stdin.read())
+    return split_links("\n".join(raw))
+
+
+class HeadlessRunner:
+    def __init__(
+        self,
+        max_parallel: int = 1,
+        out=None,
+        metrics_dir: str = None,
+        redis_url: str = None,
+        backend: str = "threads",
+        jobs_per_worker: int = JOBS_PER_WORKER,
+    ):
+        self.out = out if out is not None else sys.stdout
+        self.out_lock = threading.Lock()
+        self.queue_lock = threading.Lock()
+        self.download_queue = []
+        self.analysis_failed = 0
+        self.max_parallel = max_parallel
+        self.metrics_dir = metrics_dir
+        # Track jobs go through this Redis queue instead of in-process threads
+        self.redis_url = redis_url
+        # "threads" or "processes" for the local queue
+        self.backend = backend
+        self.jobs_per_worker = jobs_per_worker
+        self.playlist_writers = {}
+        self.download_index = None
+        self.preset = None
+        # queue number -> (link, snapshot) of collections run by sync()
+        self.synced = {}
+
+    def emit(self, event, **fields):
+        record = {"ts": round(time.time(), 3), "event": event, **fields}
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.out_lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def analyze_link(self, link):
+        self.emit("analyzing", link=link)
+        try:
+            result_dict = get_initial(link)
+        except Exception as e:
+            self._analyzed(link, None, e)
+            return None
+        self._analyzed(link, result_dict, None)
+        return result_dict
+
+    def _analyzed(self, link, result_dict, error):
+        if error:
+            with self.queue_lock:
+                self.analysis_failed += 1
+            self.emit("analysis_error", link=link, error=str(error))
+            return
+        with self.queue_lock:
+            self.download_queue.append(result_dict)
+        self.emit(
+            "queued",
+            link=link,
+            title=result_dict.get("title"),
+            item_type=result_dict.get("item-type"),
+            tracks=len(result_dict.get("tracks", [])) or 1,
+        )
+
+    def analyze(self, links):
+        """Analyze links concurrently, each is queued as soon as it is done."""
+        for link in links:
+            self.emit("analyzing", link=link)
+        analyze_links(links, self._analyzed)
+
+    def sync(self, links, removed_mode="keep"):
+        """Download only what changed in subscribed collections.
+
+        With no links every collection synced before is re-checked. Unchanged
+        Spotify playlists (same snapshot_id) are skipped without being listed.
+        """
+        with open(CONFIG_FILE, "r") as f:
+            config = json.load(f)
+        download_path = config["path"]
+        state = SyncState(download_path)
+        links = list(dict.fromkeys(normalize_link(link) for link in links))
+        links = links or state.links()
+        if not links:
+            self.emit("summary", done=0, failed=0, error="No subscriptions yet")
+            return EXIT_NO_INPUT
+
+        checks = check_snapshots(state, links)
+        for link in links:
+            check = checks[link]
+            if isinstance(check, Exception):
+                self.analysis_failed += 1
+                self.emit("analysis_error", link=link, error=str(check))
+                continue
+            snapshot, unchanged = check
+            previous = state.get(link)
+            if unchanged:
+                self.emit("unchanged", link=link, title=previous.get("title"))
+                continue
+            collection = self.analyze_link(link)
+            if collection is None:
+                continue
+            added, removed = diff_collection(previous, collection)
+            unchanged_tracks = mark_synced(
+                download_path, previous, collection, added, output_targets(config)
+            )
+            try:
+                touched = handle_removed(download_path, previous, removed, removed_mode)
+            except OSError as e:
+                touched = []
+                self.emit("log", message=f"Could not remove dropped tracks: {e}")
+            self.emit(
+                "diff",
+                link=link,
+                title=collection.get("title"),
+                added=len(added),
+                removed=len(removed),
+                already_synced=unchanged_tracks,
+                files_removed=len(touched),
+            )
+            self.synced[len(self.download_queue) - 1] = (
+                link,
+                snapshot or collection.get("snapshot_id"),
+            )
+
+        result = self.run()
+        for queue_num, (link, snapshot) in self.synced.items():
+            collection = self.download_queue[queue_num]
+            tracks = collection.get("tracks") or [collection]
+            complete = all(track["status"] == "done" for track in tracks)
+            # Keep no snapshot after failures so the next sync lists it again
+            state.update(link, collection, snapshot if complete else None)
+        state.save()
+        return result
+
+    def change_state(self, state, q_num, q_s_num, type="state"):
+        if q_s_num is not None:
+            track = self.download_queue[q_num]["tracks"][q_s_num]
+            collection = self.download_queue[q_num].get("title")
+        else:
+            track = self.download_queue[q_num]
+            collection = None
+        fields = {
+            "queue": q_num,
+            "track": q_s_num,
+            "title": track.get("title", "Unknown"),
+            "collection": collection,
+        }
+        if type == "log":
+            self.emit("log", message=state, **fields)
+        else:
+            track["status"] = state
+            self.emit("status", status=state, **fields)
+
+    def _job_target(self, queue_num, queue_sub_num):
+        """(song_dict, folder_name) of a queued track."""
+        if queue_sub_num is not None:
+            song_dict = self.download_queue[queue_num]["tracks"][queue_sub_num]
+            return song_dict, sanitize(self.download_queue[queue_num]["title"])
+        return self.download_queue[queue_num], None
+
+    def _download_wrapper(self, queue_num, queue_sub_num):
+        callback = lambda state, type="state": self.change_state(
+            state, queue_num, queue_sub_num, type
+        )
+        self.change_state("downloading", queue_num, queue_sub_num)
+        song_dict, folder_name = self._job_target(queue_num, queue_sub_num)
+        try:
+            download_single(
+                song_dict=song_dict, folder_name=folder_name, callback=callback
+            )
+        except Exception as e:
+            self._track_failed(queue_num, queue_sub_num, song_dict, e)
+            return
+        self._track_done(queue_num, queue_sub_num, song_dict)
+
+    def _track_failed(self, queue_num, queue_sub_num, song_dict, error):
+        self.emit(
+            "error",
+            queue=queue_num,
+            track=queue_sub_num,
+            title=song_dict.get("title", "Unknown"),
+            error=str(error),
+        )
+        self.change_state("error", queue_num, queue_sub_num)
+
+    def _track_done(self, queue_num, queue_sub_num, song_dict):
+        if self.download_index:
+            self.download_index.add(song_dict, self.preset, song_dict["file_path"])
+        for writer in self.playlist_writers.get(queue_num, []):
+            if writer.add_track(song_dict):
+                self.emit("playlist", queue=queue_num, path=writer.playlist_path)
+
+    def _track_job(self, queue_num, queue_sub_num):
+        """Serializable form of a queued track for the Redis and process queues."""
+        song_dict, folder_name = self._job_target(queue_num, queue_sub_num)
+        return {
+            "queue": queue_num,
+            "track": queue_sub_num,
+            "song": song_dict,
+            "folder": folder_name,
+        }
+
+    def _remote_event(self, job, event):
+        """Applies what a (possibly remote) worker reported for a track job."""
+        queue_num, queue_sub_num = job["queue"], job["track"]
+        song_dict, _ = self._job_target(queue_num, queue_sub_num)
+        if "state" in event:
+            self.change_state(event["state"], queue_num, queue_sub_num, event["type"])
+        elif "error" in event:
+            self._track_failed(queue_num, queue_sub_num, song_dict, event["error"])
+        else:
+            song_dict.update(event["result"])
+            self._track_done(queue_num, queue_sub_num, song_dict)
+
+    def serve(self):
+        """Run track jobs from the Redis queue until interrupted (worker node)."""
+
+        def handler(job, callback):
+            title = job["song"].get("title", "Unknown")
+
+            def report(state, type="state"):
+                if type == "log":
+                    self.emit("log", message=state, title=title)
+                else:
+                    self.emit("status", status=state, title=title)
+                callback(state, type)
+
+            try:
+                result = run_track_job(job, report)
+            except Exception as e:
+                self.emit("error", title=title, error=str(e))
+                raise
+            return result
+
+        thread_system = RedisQueueSystem(
+            self.redis_url, handler, max_processes=self.max_parallel
+        )
+        thread_system.start()
+        self.emit("serving", workers=self.max_parallel)
+        try:
+            thread_system.stop_event.wait()
+        except KeyboardInterrupt:
+            self.emit("log", message="Finishing running jobs")
+            thread_system.shutdown_graceful()
+        return EXIT_OK
+
+    def _mark_existing(self):
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                config = json.load(f)
+        except Exception:
+            return
+        self.preset = config["quality"]
+        targets = output_targets(config)
+        self.download_index = open_download_index(config["path"])
+        for queue_num, item in enumerate(self.download_queue):
+            tracks = item["tracks"] if item["item-type"] == "playlist" else [item]
+            before = [t.get("status") for t in tracks]
+            self.download_index.mark_existing([item], targets)
+            for queue_sub_num, track in enumerate(tracks):
+                if before[queue_sub_num] != "done" and track["status"] == "done":
+                    self.emit(
+                        "skipped",
+                        queue=queue_num,
+                        track=(
+                            queue_sub_num if item["item-type"] == "playlist" else None
+                        ),
+                        title=track.get("title"),
+                        path=track["file_path"],
+                    )
+
+    def _open_playlist_writers(self):
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                roots = [root for root, _ in output_targets(json.load(f))]
+        except Exception:
+            return
+
+        for queue_num, item in enumerate(self.download_queue):
+            if item.get("item-type") == "playlist":
+                folder_name = sanitize(item["title"])
+                # A synced collection is complete, dropped tracks leave the list
+                synced = queue_num in self.synced
+                writers = collection_writers(
+                    folder_name, list(dict.fromkeys(roots)), keep_previous=not synced
+                )
+                for writer in writers:
+                    for track in item["tracks"]:
+                        if track.get("status") == "done":
+                            writer.add_track(track, write=False)
+                    if synced:
+                        writer.write()
+                self.playlist_writers[queue_num] = writers
+
+    def _write_album_gain(self):
+        for queue_num, item in enumerate(self.download_queue):
+            if item.get("item-type") != "playlist":
+                continue
+            try:
+                tagged = write_album_gain(item["tracks"], sanitize(item["title"]))
+            except Exception as e:
+                self.emit(
+                    "error",
+                    queue=queue_num,
+                    title=item.get("title"),
+                    error=f"Album gain failed: {e}",
+                )
+                continue
+            if tagged:
+                self.emit("album_gain", queue=queue_num, files=tagged)
+
+    def _tracks(self):
+        for item in self.download_queue:
+            if item["item-type"] == "playlist":
+                yield from item["tracks"]
+            else:
+                yield item
+
+    def run(self):
+        self._mark_existing()
+        plan_outputs(self.download_queue, self.download_index)
+        targets = []
+        for queue_num, data in enumerate(self.download_queue):
+            if data["item-type"] == "track":
+                if data["status"] == "waiting":
+                    targets.append((queue_num, None))
+            if data["item-type"] == "playlist":
+                for queue_sub_num, track in enumerate(data["tracks"]):
+                    if track["status"] in ("waiting", "error"):
+                        targets.append((queue_num, queue_sub_num))
+
+        started = time.time()
+        self.emit("start", jobs=len(targets), workers=self.max_parallel)
+        self._open_playlist_writers()
+        if self.redis_url:
+            thread_system = RedisQueueSystem(
+                self.redis_url,
+                run_track_job,
+                on_event=self._remote_event,
+                max_processes=self.max_parallel,
+            )
+            thread_system.submit_jobs(self._track_job(*target) for target in targets)
+            thread_system.wait_completion()
+            # Stop taking other nodes' jobs, the running ones still finish
+            thread_system.shutdown_graceful()
+        elif self.backend == "processes":
+            thread_system = ProcessQueueSystem(
+                run_track_job,
+                on_event=self._remote_event,
+                max_processes=self.max_parallel,
+                jobs_per_worker=self.jobs_per_worker,
+                key=lambda job: source_key(job["song"]),
+            )
+            thread_system.submit_jobs(self._track_job(*target) for target in targets)
+            thread_system.wait_completion()
+            thread_system.shutdown_graceful()
+        else:
+            # Downloads in this process use the extractions made meanwhile
+            prefetch_extraction([self._job_target(*target)[0] for target in targets])
+            thread_system = QueueSystem(max_processes=self.max_parallel)
+            thread_system.submit_jobs(
+                lambda target=target: self._download_wrapper(*target)
+                for target in targets
+            )
+            thread_system.wait_completion()
+        if self.download_index:
+            self.download_index.flush()
+        self._write_album_gain()
+
+        # Tracks already in the library are reported apart, they ran no job
+        statuses = [track["status"] for track in self._tracks()]
+        done = sum(
+            self._job_target(*target)[0]["status"] == "done" for target in targets
+        )
+        skipped = statuses.count("done") - done
+        failed = len(statuses) - done - skipped
+        elapsed = time.time() - started
+        if self.metrics_dir:
+            self.emit("metrics", files=metrics.export(self.metrics_dir))
+        self.emit(
+            "summary",
+            done=done,
+            skipped=skipped,
+            failed=failed,
+            analysis_failed=self.analysis_failed,
+            stages=metrics.summary(),
+            seconds=round(elapsed, 3),
+            tracks_per_minute=round(done / elapsed * 60, 2) if elapsed else 0,
+        )
+        if failed:
+            return EXIT_TRACK_FAILED
+        if self.analysis_failed:
+            return EXIT_ANALYSIS_FAILED
+        return EXIT_OK
+
+
+def run_headless(args, out=None):
+    links = read_links(args.links, args.file, args.stdin)
+    runner = HeadlessRunner(
+        max_parallel=args.parallel,
+        out=out,
+        metrics_dir=args.metrics,
+        redis_url=args.redis,
+        backend=args.backend,
+        jobs_per_worker=args.jobs_per_worker,
+    )
+    if args.worker:
+        if not args.redis:
+            runner.emit("summary", error="--worker needs a Redis queue (--redis)")
+            return EXIT_NO_INPUT
+        return runner.serve()
+    if args.rebuild_index:
+        with open(CONFIG_FILE, "r") as f:
+            download_path = json.load(f)["path"]
+        started = time.time()
+        entries = DownloadIndex(download_path).rebuild()
+        runner.emit("summary", indexed=entries, seconds=round(time.time() - started, 3))
+        return EXIT_OK
+    if args.reencode:
+        from reencode import LibraryReencoder
+
+        with open(CONFIG_FILE, "r") as f:
+            download_path = json.load(f)["path"]
+        reencoder = LibraryReencoder(
+            download_path,
+            args.reencode,
+            dest=args.reencode_to,
+            workers=args.parallel if args.parallel_given else None,
+            callback=runner.emit,
+        )
+        summary = reencoder.run()
+        if runner.metrics_dir:
+            runner.emit("metrics", files=metrics.export(runner.metrics_dir))
+        runner.emit("summary", **summary)
+        return EXIT_TRACK_FAILED if summary["failed"] else EXIT_OK
+    if args.rebuild_playlists:
+        with open(CONFIG_FILE, "r") as f:
+            download_path = json.load(f)["path"]
+        started = time.time()
+        written = regenerate_playlists(download_path)
+        runner.emit(
+            "summary",
+            playlists=written,
+            seconds=round(time.time() - started, 3),
+        )
+        return EXIT_OK
+    if args.sync:
+        return runner.sync(links, args.sync_removed)
+    if not links:
+        runner.emit("summary", done=0, failed=0, error="No links given")
+        return EXIT_NO_INPUT
+    runner.analyze(links)
+    return runner.run()
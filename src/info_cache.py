@@ -0,0 +1,162 @@
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from singleflight import SingleFlight
+
+MAX_ENTRIES = 256
+EXPIRY_MARGIN = 600  # seconds before its stream URLs expire an entry is dropped
+DEFAULT_TTL = 3600  # seconds, for info whose URLs carry no expiry
+PREFETCH_WORKERS = 2
+
+# YouTube stream URLs carry their expiry as ?expire=<unix time> (or /expire/
+# in manifest paths)
+_expire_re = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def info_expiry(info: dict, now: float = None):
+    """When an extraction result stops being usable for downloading."""
+    now = time.time() if now is None else now
+    expiries = []
+    for f in info.get("formats") or []:
+        urls = [f.get("url"), f.get("fragment_base_url"), f.get("manifest_url")]
+        urls += [fragment.get("url") for fragment in f.get("fragments") or []][:1]
+        for url in urls:
+            match = _expire_re.search(url or "")
+            if match:
+                expiries.append(int(match.group(1)))
+    if not expiries:
+        return now + DEFAULT_TTL
+    return min(expiries) - EXPIRY_MARGIN
+
+
+def copy_info(info: dict):
+    """Copy of an extraction result that processing it leaves unchanged.
+
+    Processing changes the top level and the format and thumbnail dicts.
+    Fragment lists are yt-dlp LazyLists over generators, which cannot be
+    deepcopied, so they become plain lists of copied dicts.
+    """
+    copied = dict(info)
+    formats = []
+    for f in info.get("formats") or []:
+        f = dict(f)
+        fragments = f.get("fragments")
+        if fragments is not None and not callable(fragments):
+            f["fragments"] = [dict(fragment) for fragment in fragments]
+        formats.append(f)
+    if "formats" in info:
+        copied["formats"] = formats
+    if "thumbnails" in info:
+        copied["thumbnails"] = [dict(t) for t in info["thumbnails"] or []]
+    return copied
+
+
+class InfoCache:
+    """Bounded in-memory store of yt-dlp extraction results by video id.
+
+    Holds extract_info(..., process=False) results, which processing can turn
+    into a download without extracting the page again. Entries are dropped
+    shortly before their stream URLs expire, least recently used first past
+    `max_entries`. get_or_extract() runs one extraction per id at a time, so
+    a download waits for a prefetch that is already under way.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.flights = SingleFlight()
+
+    def get(self, video_id: str):
+        """A copy of the stored info (processing changes it), or None."""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+            info, expires = entry
+            if time.time() >= expires:
+                del self.entries[video_id]
+                return None
+            self.entries.move_to_end(video_id)
+        return copy_info(info)
+
+    def put(self, video_id: str, info: dict):
+        """Store a copy of `info` and return it."""
+        info = copy_info(info)
+        expires = info_expiry(info)
+        if expires <= time.time():
+            return info
+        with self.lock:
+            self.entries[video_id] = (info, expires)
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return info
+
+    def invalidate(self, video_id: str):
+        with self.lock:
+            self.entries.pop(video_id, None)
+
+    def __contains__(self, video_id: str):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return entry is not None and time.time() < entry[1]
+
+    def get_or_extract(self, video_id: str, extract: Callable):
+        """(info copy, reused), reused is False when this call extracted it."""
+        info = self.get(video_id)
+        if info is not None:
+            return info, True
+
+        def run():
+            # Waiting callers copy the stored info, never the lazy original
+            return self.put(video_id, extract(video_id))
+
+        # A failed acquire holds nothing to release
+        info, shared = self.flights.acquire(video_id, run)
+        self.flights.release(video_id)
+        return copy_info(info), shared
+
+
+class Prefetcher:
+    """Extracts queued video ids ahead of their downloads, in daemon threads."""
+
+    def __init__(
+        self, cache: InfoCache, extract: Callable, workers: int = PREFETCH_WORKERS
+    ):
+        self.cache = cache
+        self.extract = extract
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            video_id = self.queue.get()
+            try:
+                if video_id not in self.cache:
+                    self.cache.get_or_extract(video_id, self.extract)
+            except Exception:
+                # The download extracts again and reports the error
+                pass
+            finally:
+                self.queue.task_done()
+
+    def submit(self, video_ids: list):
+        """Queue ids for extraction, no more than the cache can hold."""
+        with self.lock:
+            if not self.threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(
+                        target=self._work, name=f"prefetch-{i}", daemon=True
+                    )
+                    thread.start()
+                    self.threads.append(thread)
+        room = self.cache.max_entries - self.queue.qsize()
+        for video_id in list(dict.fromkeys(video_ids))[: max(room, 0)]:
+            self.queue.put(video_id)
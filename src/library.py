@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+AUDIO_FORMATS = {".mp3", ".flac", ".ogg", ".m4a"}
+INDEX_FILE = ".library_index.json"
+# A directory modified this recently may still change within the same mtime tick
+MTIME_SETTLE_NS = 2 * 10**9
+
+
+class LibraryIndex:
+    """Index of the audio files under a download root.
+
+    Built with os.scandir. Every directory's listing is cached together with
+    its mtime, so a refresh only stats each directory and re-lists the ones
+    that changed. Top-level folders are scanned in parallel. With `persist`
+    off the listings are kept in memory only, nothing is written under root.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        cache_path: str = None,
+        workers: int = 8,
+        persist: bool = True,
+    ):
+        self.root = os.path.abspath(root)
+        self.cache_path = cache_path or os.path.join(self.root, INDEX_FILE)
+        self.persist = persist
+        self.workers = workers
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.persist:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("root") == self.root:
+                self.dirs = data.get("dirs", {})
+        except (OSError, ValueError):
+            self.dirs = {}
+
+    def save(self):
+        if not self.persist:
+            return
+        temp_path = self.cache_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"root": self.root, "dirs": self.dirs}))
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def _scan_dir(self, rel_dir: str, now_ns: int):
+        path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.dirs.get(rel_dir)
+        if cached and cached["mtime"] == mtime and now_ns - mtime > MTIME_SETTLE_NS:
+            return cached
+
+        files, subdirs = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif os.path.splitext(entry.name)[1].lower() in AUDIO_FORMATS:
+                        files.append(entry.name)
+        except OSError:
+            return None
+        return {"mtime": mtime, "files": sorted(files), "subdirs": sorted(subdirs)}
+
+    def _scan_tree(self, rel_dir: str, now_ns: int):
+        found = {}
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            entry = self._scan_dir(current, now_ns)
+            if entry is None:
+                continue
+            found[current] = entry
+            for name in entry["subdirs"]:
+                stack.append(f"{current}/{name}" if current else name)
+        return found
+
+    def refresh(self):
+        now_ns = time.time_ns()
+        with self.lock:
+            top = self._scan_dir("", now_ns)
+            if top is None:
+                self.dirs = {}
+                return self
+            found = {"": top}
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for subtree in pool.map(
+                    lambda name: self._scan_tree(name, now_ns), top["subdirs"]
+                ):
+                    found.update(subtree)
+            changed = found.keys() != self.dirs.keys() or any(
+                self.dirs[key] is not entry for key, entry in found.items()
+            )
+            self.dirs = found
+            if changed:
+                self.save()
+        return self
+
+    def audio_files(self, folder: str = ""):
+        """Audio files under `folder` (relative to the root), relative to it."""
+        folder = os.path.relpath(os.path.join(self.root, folder), self.root)
+        folder = "" if folder == "." else folder.replace(os.sep, "/")
+        result = []
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            entry = self.dirs.get(current)
+            if entry is None:
+                continue
+            prefix = current[len(folder) :].lstrip("/")
+            if prefix:
+                result.extend(f"{prefix}/{name}" for name in entry["files"])
+            else:
+                result.extend(entry["files"])
+            for name in entry["subdirs"]:
+                stack.append(f"{current}/{name}" if current else name)
+        return sorted(result)
+
+    def folders(self):
+        return list(self.dirs.get("", {}).get("subdirs", []))
+
+    def __len__(self):
+        return sum(len(entry["files"]) for entry in self.dirs.values())
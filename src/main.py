@@ -1,9 +1,14 @@
 import sys
 import subprocess
 import os
+import argparse
+import json
+import importlib.util
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from consts import CONFIG_FILE
+
 
 def install_and_restart():
     print("Detecting missing dependencies. Installing...")
@@ -19,15 +24,148 @@ def install_and_restart():
         sys.exit(1)
 
 
-try:
-    import requests
-    import mutagen
-    import textual
-    from ui import MusicDownloaderApp
-except ImportError as e:
-    print(f"CRITICAL IMPORT ERROR: {e}")
-    install_and_restart()
+def default_parallel():
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            return max(1, int(json.load(f).get("max_parallel", "1")))
+    except Exception:
+        return 1
+
+
+def default_setting(key: str, default=None):
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            return json.load(f).get(key) or default
+    except Exception:
+        return default
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Poweramp music downloader",
+        epilog="Headless exit codes: 0 all done, 1 some tracks failed, "
+        "2 some links could not be analyzed, 3 no links given.",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="run without the UI and print JSON-lines progress to stdout",
+    )
+    parser.add_argument("links", nargs="*", help="links to download (headless)")
+    parser.add_argument("-f", "--file", help="read links from a file (headless)")
+    parser.add_argument(
+        "--stdin", action="store_true", help="read links from stdin (headless)"
+    )
+    parser.add_argument(
+        "-j",
+        "--parallel",
+        type=int,
+        help="number of parallel download workers, or re-encode workers "
+        "(headless, default: max_parallel from the settings, CPU count for "
+        "--reencode)",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="export metrics.prom and metrics.json here when done (headless)",
+    )
+    parser.add_argument(
+        "--rebuild-playlists",
+        action="store_true",
+        help="rewrite the .m3u8 of every folder in the download root and exit "
+        "(headless)",
+    )
+    parser.add_argument(
+        "--rebuild-index",
+        action="store_true",
+        help="re-create the skip-existing index from file tags and exit (headless)",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="download only what changed in the given collections, or in every "
+        "collection synced before when no links are given (headless)",
+    )
+    parser.add_argument(
+        "--sync-removed",
+        choices=("keep", "move", "delete"),
+        default="keep",
+        help="what --sync does with files of tracks dropped from a collection, "
+        "'move' puts them under .removed/ in the download root (default: keep)",
+    )
+    parser.add_argument(
+        "--reencode",
+        metavar="PRESET",
+        help="re-encode the whole download root to this quality preset and exit "
+        "(headless)",
+    )
+    parser.add_argument(
+        "--reencode-to",
+        metavar="DIR",
+        help="where --reencode writes the library (default: '<root> (<preset>)')",
+    )
+    parser.add_argument(
+        "--redis",
+        metavar="URL",
+        default=default_setting("redis_url"),
+        help="share the download jobs through this Redis queue, e.g. "
+        "redis://host:6379/0, so --worker nodes help (headless, default: "
+        "redis_url from the settings)",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="run download jobs from the --redis queue until interrupted, the "
+        "download path should be storage shared by all nodes (headless)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("threads", "processes"),
+        default=default_setting("queue_backend", "threads"),
+        help="run the download workers as threads or as separate processes "
+        "(headless, default: queue_backend from the settings)",
+    )
+    parser.add_argument(
+        "--jobs-per-worker",
+        type=int,
+        default=default_setting("jobs_per_worker"),
+        help="replace a worker process after this many jobs (headless, "
+        "default: jobs_per_worker from the settings, else 50)",
+    )
+    args = parser.parse_args(argv)
+    args.parallel_given = args.parallel is not None
+    if args.parallel is None:
+        args.parallel = default_parallel()
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    try:
+        # Only check that the service packages exist, they are imported on first use
+        for module in ("requests", "mutagen", "yt_dlp", "ytmusicapi", "spotipy"):
+            if importlib.util.find_spec(module) is None:
+                raise ImportError(f"No module named '{module}'")
+
+        if args.headless:
+            from headless import run_headless
+        else:
+            from ui import MusicDownloaderApp
+    except ImportError as e:
+        print(f"CRITICAL IMPORT ERROR: {e}", file=sys.stderr)
+        install_and_restart()
+
+    if args.headless:
+        # Keep stdout for JSON lines only, everything else goes to stderr
+        out = sys.stdout
+        sys.stdout = sys.stderr
+        return run_headless(args, out=out)
 
-if __name__ == "__main__":
     app = MusicDownloaderApp()
     app.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import difflib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+DURATION_TOLERANCE = 10  # seconds a candidate may be off in any case
+DURATION_TOLERANCE_RATIO = 0.1  # or this part of the track's length, if more
+MIN_SCORE = 0.6  # best candidates below this are not downloaded
+MIN_ARTIST = 0.5  # below this it is someone else's recording (a cover)
+WEIGHTS = {"duration": 0.35, "title": 0.3, "artist": 0.25, "type": 0.1}
+TYPE_SCORES = {"song": 1.0, "video": 0.5}
+
+AUDIT_FILE = ".match_audit.jsonl"
+AUDIT_MAX_BYTES = 5 * 1024 * 1024  # then it moves to .1 and a new one starts
+
+_feat_re = re.compile(r"\b(feat|ft|featuring)\b\.?.*$")
+_punct_re = re.compile(r"[^\w\s]")
+
+
+def normalize(text: str):
+    """Lowercase, no accents, punctuation or featured artists."""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = _punct_re.sub(" ", _feat_re.sub("", text))
+    return " ".join(text.split())
+
+
+def similarity(expected: str, found: str):
+    """0..1, 1 when every word of `expected` is in `found` ("(Official Video)"
+    and such do not count against a title)."""
+    expected, found = normalize(expected), normalize(found)
+    if not expected or not found:
+        return 0.0
+    words = expected.split()
+    contained = sum(word in found.split() for word in words) / len(words)
+    return max(difflib.SequenceMatcher(None, expected, found).ratio(), contained)
+
+
+def candidate_duration(candidate: dict):
+    """Seconds of a ytmusicapi search result, None if it has no duration."""
+    if candidate.get("duration_seconds"):
+        return float(candidate["duration_seconds"])
+    try:
+        seconds = 0.0
+        for part in str(candidate["duration"]).split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except (KeyError, ValueError):
+        return None
+
+
+def duration_tolerance(seconds: float):
+    return max(DURATION_TOLERANCE, seconds * DURATION_TOLERANCE_RATIO)
+
+
+def score_candidate(song_dict: dict, candidate: dict):
+    """Score of one search result for a track, with its parts for the audit.
+
+    A result whose length is out of tolerance is rejected outright, nothing
+    of it is downloaded. When either length is unknown the duration is left
+    out and the score is the weighted mean of the other parts, so such a
+    track can still reach MIN_SCORE on title, artist and type alone.
+    """
+    expected = float(song_dict.get("duration_seconds") or 0)
+    found = candidate_duration(candidate)
+    artists = [a.get("name") or "" for a in candidate.get("artists") or []]
+    scored = {
+        "videoId": candidate.get("videoId"),
+        "title": candidate.get("title"),
+        "artists": artists,
+        "duration": found,
+        "type": candidate.get("resultType"),
+        "rejected": None,
+    }
+
+    parts = {}
+    if expected and found is not None:
+        delta = abs(found - expected)
+        tolerance = duration_tolerance(expected)
+        if delta > tolerance:
+            scored["rejected"] = f"duration off by {delta:.0f} s"
+        parts["duration"] = max(0.0, 1 - delta / tolerance)
+    # Spotify's " - Remastered 2011" and such are seldom in video titles
+    parts["title"] = max(
+        similarity(title, candidate.get("title"))
+        for title in (song_dict["title"], song_dict["title"].split(" - ")[0])
+    )
+    parts["artist"] = max(
+        (
+            similarity(expected_artist, " ".join(artists))
+            for expected_artist in song_dict["artists"]
+        ),
+        default=0.0,
+    )
+    parts["type"] = TYPE_SCORES.get(candidate.get("resultType"), 0.0)
+    scored["parts"] = {name: round(value, 3) for name, value in parts.items()}
+    weight = sum(WEIGHTS[name] for name in parts)
+    scored["score"] = round(
+        sum(WEIGHTS[name] * value for name, value in parts.items()) / weight, 3
+    )
+    if not scored["rejected"] and parts["artist"] < MIN_ARTIST:
+        scored["rejected"] = "different artist"
+    if not scored["rejected"] and scored["score"] < MIN_SCORE:
+        scored["rejected"] = "score too low"
+    return scored
+
+
+def best_candidate(song_dict: dict, candidates: list):
+    """(best accepted scored candidate or None, all scored candidates)."""
+    scored = [score_candidate(song_dict, c) for c in candidates if c.get("videoId")]
+    accepted = [s for s in scored if not s["rejected"]]
+    best = max(accepted, key=lambda s: s["score"], default=None)
+    return best, scored
+
+
+class MatchAudit:
+    """Append-only JSON lines log of how each track's video was picked."""
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, AUDIT_FILE)
+        self.lock = threading.Lock()
+
+    def record(self, entry: dict):
+        line = json.dumps({"ts": round(time.time(), 3), **entry}, ensure_ascii=False)
+        with self.lock:
+            try:
+                if os.path.getsize(self.path) > AUDIT_MAX_BYTES:
+                    os.replace(self.path, f"{self.path}.1")
+            except OSError:
+                pass
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+_audits = {}
+_audits_lock = threading.Lock()
+
+
+def get_match_audit(folder: str):
+    folder = os.path.abspath(folder)
+    with _audits_lock:
+        if folder not in _audits:
+            _audits[folder] = MatchAudit(folder)
+        return _audits[folder]
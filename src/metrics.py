@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SAMPLES_PER_STAGE = 2048
+SPANS_KEPT = 5000
+PROMETHEUS_PREFIX = "poweramp_dl"
+
+
+def percentile(ordered: list, q: float):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.errors = 0
+        self.samples = deque(maxlen=SAMPLES_PER_STAGE)
+
+    def observe(self, seconds: float, nbytes: int = 0, ok: bool = True):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        if not ok:
+            self.errors += 1
+        self.samples.append(seconds)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "mean": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50": round(percentile(ordered, 0.50), 4),
+            "p95": round(percentile(ordered, 0.95), 4),
+            "max": round(self.max, 4),
+            "bytes": self.bytes,
+            "errors": self.errors,
+        }
+
+
+class Metrics:
+    """Timing spans for every pipeline stage of every track."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: dict[str, Histogram] = {}
+        self.spans = deque(maxlen=SPANS_KEPT)
+        self.version = 0
+
+    def record(
+        self,
+        stage: str,
+        seconds: float,
+        track: str = None,
+        nbytes: int = 0,
+        ok: bool = True,
+        worker: str = None,
+    ):
+        worker = worker or threading.current_thread().name
+        with self.lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds, nbytes, ok)
+            self.spans.append(
+                {
+                    "stage": stage,
+                    "track": track,
+                    "worker": worker,
+                    "end": round(time.time(), 3),
+                    "seconds": round(seconds, 4),
+                    "bytes": nbytes,
+                    "ok": ok,
+                }
+            )
+            self.version += 1
+
+    @contextmanager
+    def span(self, stage: str, track: str = None):
+        """Time a block. Set `span["bytes"]` inside it to record bytes moved."""
+        span = {"bytes": 0}
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield span
+            ok = True
+        finally:
+            self.record(
+                stage,
+                time.perf_counter() - started,
+                track=track,
+                nbytes=span["bytes"],
+                ok=ok,
+            )
+
+    def summary(self):
+        with self.lock:
+            return {stage: h.summary() for stage, h in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.spans.clear()
+            self.version += 1
+
+    def to_json(self):
+        with self.lock:
+            spans = list(self.spans)
+        return {
+            "generated": round(time.time(), 3),
+            "stages": self.summary(),
+            "spans": spans,
+        }
+
+    def to_prometheus(self):
+        name = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each download pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for stage, h in histograms:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+            for metric, attr, help_text in (
+                ("stage_bytes_total", "bytes", "Bytes moved by each stage."),
+                ("stage_errors_total", "errors", "Failed runs of each stage."),
+            ):
+                lines.append(f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}")
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} counter")
+                for stage, h in histograms:
+                    lines.append(
+                        f'{PROMETHEUS_PREFIX}_{metric}{{stage="{stage}"}} {getattr(h, attr)}'
+                    )
+        return "\n".join(lines) + "\n"
+
+    def export(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for filename, content in (
+            ("metrics.prom", self.to_prometheus()),
+            ("metrics.json", json.dumps(self.to_json(), indent=4)),
+        ):
+            path = os.path.join(folder, filename)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+        return paths
+
+
+metrics = Metrics()
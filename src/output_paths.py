@@ -0,0 +1,126 @@
+import functools
+import os
+import re
+import threading
+
+MAGIC_CHAR = "$"
+# Fields a YouTube track only has once its source is downloaded
+SOURCE_FIELDS = {"album", "year", "length"}
+
+# Filenames keep letters, digits and " _.-", whatever the template produced
+_unsafe_re = re.compile(r"[^\w .\-]")
+
+
+def clean_filename(name: str):
+    return _unsafe_re.sub("", name).strip()
+
+
+class FilenameTemplate:
+    """A filename template such as "$artist$ - $title$", parsed once.
+
+    Text between two magic characters is a field of the track, a field left
+    open at the end is dropped.
+    """
+
+    def __init__(self, template: str, magic_char: str = MAGIC_CHAR):
+        parts = template.split(magic_char)
+        if len(parts) % 2 == 0:
+            parts.pop()
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def render(self, data: dict):
+        """The filename for `data`, cleaned but without an extension."""
+        values = [str(data.get(field, "")) for field in self.fields] + [""]
+        return clean_filename(
+            "".join(part for pair in zip(self.literals, values) for part in pair)
+        )
+
+    def needs_source(self, song_dict: dict):
+        """Whether the name depends on fields the track's download fills in."""
+        return song_dict.get("type") == "youtube" and not SOURCE_FIELDS.isdisjoint(
+            self.fields
+        )
+
+
+@functools.lru_cache(maxsize=32)
+def compile_template(template: str, magic_char: str = MAGIC_CHAR):
+    return FilenameTemplate(template, magic_char)
+
+
+def template_data(song_dict: dict):
+    """What a track's filename template and tags are filled from."""
+    return {
+        "title": song_dict["title"],
+        "artist": ", ".join(song_dict["artists"]),
+        "artists": song_dict["artists"],
+        "album": song_dict["album"],
+        "year": song_dict["release"],
+        "length": song_dict["duration_seconds"],
+        "platform": song_dict["type"],
+        "track_number": int(song_dict["track_number"]),
+    }
+
+
+class OutputPlanner:
+    """Decides the output files of a run's tracks, before they are downloaded.
+
+    Tracks claim paths in the order they are planned, a name that is already
+    taken by another track gets " (2)", " (3)" and so on, in every output
+    folder alike. Taken means claimed earlier in this run, or an existing file
+    that `owners` (casefolded path -> track key, from the download index)
+    gives to another track. Existing files nobody owns are overwritten as
+    before. Folders are listed once, names compare casefolded since the
+    library may be on a case-insensitive card.
+    """
+
+    def __init__(self, owners: dict = None):
+        self.owners = owners or {}
+        self.lock = threading.Lock()
+        self.claimed = {}
+        self.listings = {}
+
+    def _listing(self, folder: str):
+        names = self.listings.get(folder)
+        if names is None:
+            try:
+                with os.scandir(folder) as entries:
+                    names = {entry.name.casefold() for entry in entries}
+            except OSError:
+                names = set()
+            self.listings[folder] = names
+        return names
+
+    def _taken(self, path: str, key: str):
+        folded = path.casefold()
+        owner = self.claimed.get(folded)
+        if owner is None and os.path.basename(folded) in self._listing(
+            os.path.dirname(path)
+        ):
+            owner = self.owners.get(folded)
+        return owner is not None and owner != key
+
+    def keep(self, key: str, paths: list):
+        """Reserve files a track already has (downloaded earlier)."""
+        with self.lock:
+            for path in paths:
+                self.claimed[os.path.abspath(path).casefold()] = key
+
+    def claim(self, key: str, name: str, targets: list):
+        """Paths for `name` in every (folder, extension) target, reserved for key."""
+        if not name:
+            raise ValueError("The filename template gives this track no name")
+        with self.lock:
+            attempt = 1
+            while True:
+                suffix = f" ({attempt})" if attempt > 1 else ""
+                paths = [
+                    os.path.join(os.path.abspath(folder), f"{name}{suffix}.{ext}")
+                    for folder, ext in targets
+                ]
+                if not any(self._taken(path, key) for path in paths):
+                    break
+                attempt += 1
+            for path in paths:
+                self.claimed[path.casefold()] = key
+        return paths
@@ -1,32 +1,168 @@
 import os
+import threading
 
+from library import LibraryIndex
 
-def update_folder_playlist(folder_path):
-    if not os.path.isdir(folder_path):
+
+def write_playlist_lines(playlist_path: str, lines: list):
+    content = "\n".join(lines) + "\n"
+    try:
+        # Leave an unchanged playlist alone so the folder mtime stays cached
+        with open(playlist_path, "r", encoding="utf-8") as pl:
+            if pl.read() == content:
+                return True
+    except OSError:
+        pass
+    temp_path = playlist_path + ".tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as pl:
+            pl.write(content)
+        os.replace(temp_path, playlist_path)
+        return True
+    except OSError:
         return False
 
-    audio_formats = {".mp3", ".flac", ".ogg", ".m4a"}
-    audio_files = []
 
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in audio_formats:
-                full_path = os.path.join(root, file)
-                rel_path = os.path.relpath(full_path, folder_path)
-                audio_files.append(rel_path)
+def update_folder_playlist(folder_path, index: LibraryIndex = None):
+    if not os.path.isdir(folder_path):
+        return False
+
+    folder_path = os.path.abspath(folder_path)
+    if index is None:
+        # Only this folder, and no index file among the music
+        index = LibraryIndex(folder_path, persist=False).refresh()
+    audio_files = index.audio_files(os.path.relpath(folder_path, index.root))
 
     if not audio_files:
         return False
 
-    audio_files.sort()
     folder_name = os.path.basename(folder_path)
     playlist_path = os.path.join(folder_path, f"{folder_name}.m3u8")
+    return write_playlist_lines(playlist_path, ["#EXTM3U", *audio_files])
+
+
+def regenerate_playlists(root: str):
+    """Rewrite the .m3u8 of every top-level folder from one index refresh."""
+    index = LibraryIndex(root).refresh()
+    written = []
+    for folder in index.folders():
+        if update_folder_playlist(os.path.join(index.root, folder), index):
+            written.append(folder)
+    return written
 
+
+def duration_to_seconds(value):
+    if value is None or value == "":
+        return -1
+    if isinstance(value, (int, float)):
+        return int(value)
+    seconds = 0
     try:
-        with open(playlist_path, "w", encoding="utf-8") as pl:
-            pl.write("#EXTM3U\n")
-            for track in audio_files:
-                pl.write(track + "\n")
-        return True
-    except:
-        return False
+        for part in str(value).split(":"):
+            seconds = seconds * 60 + int(float(part))
+    except ValueError:
+        return -1
+    return seconds
+
+
+class PlaylistWriter:
+    """Keeps a collection's .m3u8 in source order, rewritten as tracks finish.
+
+    Entries come from the metadata we already hold, so the folder is never
+    scanned. Lines of an existing playlist that this run does not touch are
+    kept after the ordered part if their file still exists, unless
+    `keep_previous` is off because the track list is known to be complete.
+    """
+
+    def __init__(self, folder_path: str, keep_previous: bool = True):
+        self.folder_path = folder_path
+        folder_name = os.path.basename(os.path.normpath(folder_path))
+        self.playlist_path = os.path.join(folder_path, f"{folder_name}.m3u8")
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.previous = self._read_existing() if keep_previous else {}
+
+    def _read_existing(self):
+        previous, extinf = {}, None
+        try:
+            with open(self.playlist_path, "r", encoding="utf-8") as pl:
+                for line in pl:
+                    line = line.rstrip("\n")
+                    if line.startswith("#EXTINF"):
+                        extinf = line
+                    elif line and not line.startswith("#"):
+                        if os.path.exists(os.path.join(self.folder_path, line)):
+                            previous[line] = extinf
+                        extinf = None
+        except OSError:
+            pass
+        return previous
+
+    def add(
+        self,
+        position: int,
+        file_path: str,
+        duration=None,
+        title: str = None,
+        write: bool = True,
+    ):
+        rel_path = os.path.relpath(file_path, self.folder_path)
+        with self.lock:
+            self.entries[position] = (rel_path, duration_to_seconds(duration), title)
+            self.previous.pop(rel_path, None)
+            return self._write() if write else True
+
+    def _file_for(self, song_dict: dict):
+        # With extra outputs a track has one file per root, take the one
+        # in this folder, else any under the same root
+        candidates = [song_dict.get("file_path"), *song_dict.get("extra_files", [])]
+        candidates = [os.path.abspath(p) for p in candidates if p]
+        folder = os.path.abspath(self.folder_path)
+        root = os.path.dirname(folder)
+        for path in candidates:
+            if os.path.dirname(path) == folder:
+                return path
+        for path in candidates:
+            if os.path.commonpath([path, root]) == root:
+                return path
+        return None
+
+    def add_track(self, song_dict: dict, write: bool = True):
+        file_path = self._file_for(song_dict)
+        if not file_path:
+            return False
+        artists = ", ".join(song_dict.get("artists") or [])
+        title = song_dict.get("title", "")
+        return self.add(
+            int(song_dict.get("track_number", 0)),
+            file_path,
+            song_dict.get("duration_seconds"),
+            f"{artists} - {title}" if artists else title,
+            write=write,
+        )
+
+    def write(self):
+        with self.lock:
+            return self._write()
+
+    def _write(self):
+        lines = ["#EXTM3U"]
+        for position in sorted(self.entries):
+            rel_path, duration, title = self.entries[position]
+            if title:
+                lines.append(f"#EXTINF:{duration},{title}")
+            lines.append(rel_path)
+        for rel_path, extinf in self.previous.items():
+            if extinf:
+                lines.append(extinf)
+            lines.append(rel_path)
+
+        return write_playlist_lines(self.playlist_path, lines)
+
+
+def collection_writers(folder_name: str, roots: list, keep_previous: bool = True):
+    """One PlaylistWriter for the collection folder in every output root."""
+    return [
+        PlaylistWriter(os.path.join(root, folder_name), keep_previous=keep_previous)
+        for root in roots
+    ]
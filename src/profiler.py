@@ -0,0 +1,135 @@
+import cProfile
+import itertools
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+HOTSPOTS_SHOWN = 8
+
+
+def _safe_label(label: str):
+    return re.sub(r"[^\w.-]+", "_", str(label)).strip("_")[:60] or "job"
+
+
+class JobProfiler:
+    """Wraps QueueSystem jobs in cProfile and tracemalloc (developer mode).
+
+    A job is profiled when it is every `every_n`th job, or, with `slow_seconds`
+    set, every job runs under cProfile and the result is kept only if it ran
+    longer. Memory is traced for the every_n jobs only, tracemalloc slows
+    down everything while it runs. Results go to `out_dir` as
+    `<time>-<label>.pstats` / `.tracemalloc`.
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        every_n: int = 0,
+        slow_seconds: float = 0.0,
+        log: Callable = None,
+    ):
+        self.out_dir = out_dir
+        self.every_n = every_n
+        self.slow_seconds = slow_seconds
+        self.log = log or (lambda message, level="PROFILE": print(message))
+        self.counter = itertools.count(1)
+        # cProfile can only hook one thread at a time on newer Pythons
+        self.cprofile_lock = threading.Lock()
+        self.tracemalloc_lock = threading.Lock()
+        self.tracemalloc_users = 0
+        self.tracemalloc_owned = False
+
+    @property
+    def enabled(self):
+        return self.every_n > 0 or self.slow_seconds > 0
+
+    def wrap(self, job: Callable, label: str):
+        def profiled():
+            sampled = self.every_n > 0 and next(self.counter) % self.every_n == 0
+            if not sampled and self.slow_seconds <= 0:
+                return job()
+            return self._run(job, label, sampled)
+
+        return profiled
+
+    def _tracemalloc_start(self):
+        with self.tracemalloc_lock:
+            if self.tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self.tracemalloc_owned = True
+            self.tracemalloc_users += 1
+
+    def _tracemalloc_stop(self):
+        with self.tracemalloc_lock:
+            self.tracemalloc_users -= 1
+            if self.tracemalloc_users == 0 and self.tracemalloc_owned:
+                tracemalloc.stop()
+                self.tracemalloc_owned = False
+
+    def _run(self, job: Callable, label: str, sampled: bool):
+        profiler = None
+        if self.cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        before = after = None
+        if sampled:
+            self._tracemalloc_start()
+            before = tracemalloc.take_snapshot()
+        started = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            return job()
+        finally:
+            if profiler:
+                profiler.disable()
+                self.cprofile_lock.release()
+            elapsed = time.perf_counter() - started
+            peak = None
+            if sampled:
+                after = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                self._tracemalloc_stop()
+            if sampled or (profiler and elapsed >= self.slow_seconds):
+                try:
+                    self._report(label, elapsed, profiler, before, after, peak)
+                except Exception as e:
+                    self.log(f"Profiling report failed for {label}: {e}", "ERROR")
+
+    def _report(self, label, elapsed, profiler, before, after, peak):
+        os.makedirs(self.out_dir, exist_ok=True)
+        stem = os.path.join(
+            self.out_dir,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{_safe_label(label)}",
+        )
+        lines = [f"Profile of '{label}': {elapsed:.2f}s"]
+        if peak is not None:
+            lines[0] += f", peak traced {peak / 1e6:.1f} MB"
+
+        if profiler:
+            profiler.dump_stats(f"{stem}.pstats")
+            stats = pstats.Stats(profiler)
+            hotspots = sorted(
+                stats.stats.items(), key=lambda item: item[1][2], reverse=True
+            )
+            for (filename, line, name), (_, calls, own, cumulative, _) in hotspots[
+                :HOTSPOTS_SHOWN
+            ]:
+                lines.append(
+                    f"  {own:7.3f}s self {cumulative:7.3f}s cum {calls:>7} calls  "
+                    f"{name} ({os.path.basename(filename)}:{line})"
+                )
+            lines.append(f"  -> {stem}.pstats")
+        else:
+            lines.append("  cProfile busy with another job, memory only")
+
+        if after is not None:
+            after.dump(f"{stem}.tracemalloc")
+            for stat in after.compare_to(before, "lineno")[:3]:
+                lines.append(f"  mem {stat}")
+            lines.append(f"  -> {stem}.tracemalloc")
+
+        self.log("\n".join(lines), "PROFILE")
@@ -0,0 +1,308 @@
+import json
+import threading
+import time
+import uuid
+from typing import Callable, Iterable
+
+DEFAULT_NAMESPACE = "poweramp"
+LEASE_SECONDS = 60  # a job whose worker stops heartbeating goes back after this
+MAX_ATTEMPTS = 3  # leases a job may lose before it fails for good
+SEC_PER_CHECK = 2
+BATCH_TTL = 7 * 24 * 3600  # seconds, for counters and events nobody waits for
+
+# KEYS: pending, jobs, leases, owners, paused  ARGV: now, lease seconds, token
+_CLAIM = """
+if redis.call('exists', KEYS[5]) == 1 then return nil end
+local id = redis.call('rpop', KEYS[1])
+if not id then return nil end
+local payload = redis.call('hget', KEYS[2], id)
+if not payload then return nil end
+redis.call('zadd', KEYS[3], tonumber(ARGV[1]) + tonumber(ARGV[2]), id)
+redis.call('hset', KEYS[4], id, ARGV[3])
+return {id, payload}
+"""
+
+# KEYS: leases, owners  ARGV: id, token, deadline
+_HEARTBEAT = """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[2] then return 0 end
+redis.call('zadd', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+# KEYS: leases, owners, jobs, events, left  ARGV: id, token, event, ttl
+# Only the current lease holder finishes a job, a late duplicate is dropped
+_ACK = """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[2] then return 0 end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+redis.call('rpush', KEYS[4], ARGV[3])
+redis.call('decr', KEYS[5])
+redis.call('expire', KEYS[4], ARGV[4])
+redis.call('expire', KEYS[5], ARGV[4])
+return 1
+"""
+
+# KEYS: leases, owners, jobs, pending, events, left  ARGV: id, now, max attempts, ttl
+# An expired lease goes back to the front of the queue, or fails after max attempts
+_REAP = """
+local deadline = redis.call('zscore', KEYS[1], ARGV[1])
+if not deadline or tonumber(deadline) > tonumber(ARGV[2]) then return 0 end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+local payload = redis.call('hget', KEYS[3], ARGV[1])
+if not payload then return 1 end
+local job = cjson.decode(payload)
+job['attempts'] = (job['attempts'] or 0) + 1
+if job['attempts'] >= tonumber(ARGV[3]) then
+    redis.call('hdel', KEYS[3], ARGV[1])
+    redis.call('rpush', KEYS[5], cjson.encode({
+        job = ARGV[1],
+        error = 'Worker lost ' .. job['attempts'] .. ' times',
+    }))
+    redis.call('decr', KEYS[6])
+    redis.call('expire', KEYS[5], ARGV[4])
+    redis.call('expire', KEYS[6], ARGV[4])
+else
+    redis.call('hset', KEYS[3], ARGV[1], cjson.encode(job))
+    redis.call('rpush', KEYS[4], ARGV[1])
+end
+return 1
+"""
+
+# KEYS: pending, jobs, left  ARGV: batch
+_ABORT = """
+local removed = 0
+for _, id in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+    local payload = redis.call('hget', KEYS[2], id)
+    if payload and cjson.decode(payload)['batch'] == ARGV[1] then
+        redis.call('lrem', KEYS[1], 0, id)
+        redis.call('hdel', KEYS[2], id)
+        removed = removed + 1
+    end
+end
+if removed > 0 then redis.call('decrby', KEYS[3], removed) end
+return removed
+"""
+
+
+class RedisQueueSystem:
+    """QueueSystem drained from a Redis list, so several nodes share the work.
+
+    Jobs are JSON-serializable dicts, every node runs them with `handler(job,
+    callback)`. A claimed job is leased for `lease_seconds` and the lease is
+    renewed by a heartbeat while it runs, if the worker dies the job is
+    queued again for another node. Status updates and the handler's result
+    stream back to the submitting node, which gets them through
+    `on_event(job, event)` while it waits in wait_completion().
+
+    Pause stops claiming on every node of the namespace, running jobs finish.
+    Abort removes the still pending jobs of this node's submissions.
+
+    Scripts get every key they touch in KEYS, and all keys of a namespace
+    share the {namespace} hash tag, so they work on Redis Cluster too.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        handler: Callable,
+        on_event: Callable = None,
+        max_processes: int = 4,
+        namespace: str = DEFAULT_NAMESPACE,
+        lease_seconds: float = LEASE_SECONDS,
+    ):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.redis.ping()
+        self.handler = handler
+        self.on_event = on_event or (lambda job, event: None)
+        self.max_processes = max_processes
+        self.namespace = namespace
+        self.lease_seconds = lease_seconds
+        self.batch = uuid.uuid4().hex
+        self.jobs = {}
+        self.stop_event = threading.Event()
+
+        self.keys = {
+            name: f"{{{namespace}}}:{name}"
+            for name in ("pending", "jobs", "leases", "owners", "paused")
+        }
+        self.batch_prefix = f"{{{namespace}}}:batch:"
+        self._claim = self.redis.register_script(_CLAIM)
+        self._heartbeat = self.redis.register_script(_HEARTBEAT)
+        self._ack = self.redis.register_script(_ACK)
+        self._reap = self.redis.register_script(_REAP)
+        self._abort = self.redis.register_script(_ABORT)
+        for script in (_CLAIM, _HEARTBEAT, _ACK, _REAP, _ABORT):
+            self.redis.script_load(script)
+
+        self.workers: list[threading.Thread] = []
+        self.workers_lock = threading.Lock()
+
+    def _batch_key(self, name: str, batch: str = None):
+        return f"{self.batch_prefix}{batch or self.batch}:{name}"
+
+    def start(self):
+        """Spawn the workers, once. Called on the first submit."""
+        with self.workers_lock:
+            if self.workers:
+                return
+            for i in range(self.max_processes):
+                p = threading.Thread(
+                    target=self._worker, name=f"redis-worker-{i}", daemon=True
+                )
+                p.start()
+                self.workers.append(p)
+
+    def submit_jobs(self, jobs: Iterable[dict]):
+        self.start()
+        pipe = self.redis.pipeline()
+        count = 0
+        for job in jobs:
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = job
+            payload = {"id": job_id, "batch": self.batch, "attempts": 0, "job": job}
+            pipe.hset(self.keys["jobs"], job_id, json.dumps(payload))
+            pipe.lpush(self.keys["pending"], job_id)
+            count += 1
+        if count:
+            pipe.incrby(self._batch_key("left"), count)
+            pipe.expire(self._batch_key("left"), BATCH_TTL)
+            pipe.execute()
+
+    def pause(self):
+        self.redis.set(self.keys["paused"], 1)
+
+    def resume(self):
+        self.redis.delete(self.keys["paused"])
+
+    def abort(self, clear_queue: bool = True):
+        """Removes this node's pending jobs, running ones still finish."""
+        if clear_queue:
+            keys = (self.keys["pending"], self.keys["jobs"], self._batch_key("left"))
+            return self._abort(keys=keys, args=[self.batch])
+        return 0
+
+    def shutdown_graceful(self):
+        """Let workers exit cleanly after finishing current jobs."""
+        self.stop_event.set()
+        for p in self.workers:
+            p.join()
+
+    def wait_completion(self):
+        """Deliver this node's events until every submitted job finished."""
+        if not self.jobs:
+            return
+        events_key = self._batch_key("events")
+        left_key = self._batch_key("left")
+        while True:
+            popped = self.redis.blpop([events_key], timeout=SEC_PER_CHECK)
+            if popped:
+                event = json.loads(popped[1])
+                job = self.jobs.get(event.pop("job"))
+                if job is not None:
+                    self.on_event(job, event)
+                continue
+            if int(self.redis.get(left_key) or 0) <= 0:
+                break
+        self.redis.delete(events_key, left_key)
+
+    # Worker side
+
+    def _publish(self, batch: str, event: dict):
+        key = self._batch_key("events", batch)
+        pipe = self.redis.pipeline()
+        pipe.rpush(key, json.dumps(event, default=str))
+        pipe.expire(key, BATCH_TTL)
+        pipe.execute()
+
+    def _reap_expired(self):
+        now = time.time()
+        keys = [self.keys[name] for name in ("leases", "owners", "jobs", "pending")]
+        for job_id in self.redis.zrangebyscore(self.keys["leases"], "-inf", now):
+            # The script checks the lease again, another node may reap it first
+            payload = self.redis.hget(self.keys["jobs"], job_id)
+            batch = json.loads(payload)["batch"] if payload else self.batch
+            self._reap(
+                keys=keys
+                + [self._batch_key("events", batch), self._batch_key("left", batch)],
+                args=[job_id, now, MAX_ATTEMPTS, BATCH_TTL],
+            )
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            try:
+                self._reap_expired()
+                token = uuid.uuid4().hex
+                claimed = self._claim(
+                    keys=[self.keys[name] for name in self.keys],
+                    args=[time.time(), self.lease_seconds, token],
+                )
+            except Exception as e:
+                print(f"Redis queue error: {e}")
+                self.stop_event.wait(SEC_PER_CHECK)
+                continue
+            if not claimed:
+                self.stop_event.wait(SEC_PER_CHECK)
+                continue
+            self._run(json.loads(claimed[1]), token)
+
+    def _run(self, payload: dict, token: str):
+        job_id, batch = payload["id"], payload["batch"]
+        lost = threading.Event()
+        done = threading.Event()
+
+        def heartbeat():
+            interval = self.lease_seconds / 3
+            deadline = time.time() + self.lease_seconds
+            wait = interval
+            while not done.wait(wait):
+                new_deadline = time.time() + self.lease_seconds
+                try:
+                    renewed = self._heartbeat(
+                        keys=[self.keys["leases"], self.keys["owners"]],
+                        args=[job_id, token, new_deadline],
+                    )
+                except Exception as e:
+                    # Connection trouble, the lease holds until its deadline
+                    print(f"Redis heartbeat error: {e}")
+                    if time.time() >= deadline:
+                        lost.set()
+                        return
+                    wait = min(interval, SEC_PER_CHECK, deadline - time.time())
+                    continue
+                if not renewed:
+                    # Reaped meanwhile, another node has the job now
+                    lost.set()
+                    return
+                deadline, wait = new_deadline, interval
+
+        def callback(state, type="state"):
+            if not lost.is_set():
+                self._publish(batch, {"job": job_id, "state": state, "type": type})
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            event = {"job": job_id, "result": self.handler(payload["job"], callback)}
+        except Exception as e:
+            event = {"job": job_id, "error": str(e)}
+        finally:
+            done.set()
+            beat.join()
+        try:
+            self._ack(
+                keys=[
+                    self.keys["leases"],
+                    self.keys["owners"],
+                    self.keys["jobs"],
+                    self._batch_key("events", batch),
+                    self._batch_key("left", batch),
+                ],
+                args=[job_id, token, json.dumps(event, default=str), BATCH_TTL],
+            )
+        except Exception as e:
+            # The lease runs out and the job is tried again
+            print(f"Redis queue error: {e}")
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from downloader import (
+    PRESET_TAG,
+    add_cover_art,
+    clone_file,
+    copy_audio_tags,
+    quality_map,
+    read_cover_art,
+    read_custom_tags,
+    transcode_audio,
+)
+from library import AUDIO_FORMATS, LibraryIndex
+from metrics import metrics
+from playlist import write_playlist_lines
+
+STATE_FILE = ".reencode_state.json"
+SAVE_INTERVAL = 5  # seconds between state writes
+
+
+def default_destination(root: str, preset: str):
+    root = os.path.normpath(os.path.abspath(root))
+    return f"{root} ({preset})"
+
+
+class LibraryReencoder:
+    """Re-encodes every file of a download root to another quality preset.
+
+    Output mirrors the folder layout under `dest`, with all text tags, the
+    source/preset tags and the cover carried over. One ffmpeg process runs
+    per worker (one per CPU by default). Finished files are recorded in
+    <dest>/.reencode_state.json with the source's mtime and size, so an
+    interrupted run continues where it stopped and later runs only touch
+    files that changed.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        preset: str,
+        dest: str = None,
+        workers: int = None,
+        callback: Callable = None,
+    ):
+        if preset not in quality_map:
+            raise ValueError(f"Invalid preset. Choose from: {list(quality_map.keys())}")
+        self.root = os.path.abspath(root)
+        self.preset = preset
+        self.dest = os.path.abspath(dest or default_destination(root, preset))
+        if os.path.commonpath([self.dest, self.root]) in (self.dest, self.root):
+            raise ValueError("The destination must be outside the library root")
+        self.ext = quality_map[preset]["ext"]
+        self.workers = workers or os.cpu_count() or 1
+        self.callback = callback or (lambda event, **fields: None)
+        self.state_path = os.path.join(self.dest, STATE_FILE)
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.done = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("preset") == self.preset:
+                return data.get("files", {})
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save_state(self):
+        with self.lock:
+            content = json.dumps({"preset": self.preset, "files": self.done})
+            self.last_save = time.time()
+        os.makedirs(self.dest, exist_ok=True)
+        temp_path = f"{self.state_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, self.state_path)
+
+    def target_for(self, rel_path: str):
+        return os.path.join(self.dest, os.path.splitext(rel_path)[0] + "." + self.ext)
+
+    def _up_to_date(self, rel_path: str, stamp: list, target: str):
+        if not os.path.exists(target):
+            return False
+        with self.lock:
+            if self.done.get(rel_path) == stamp:
+                return True
+        # No record (state lost or written before the interruption), trust a
+        # newer target that already carries this preset
+        try:
+            if os.path.getmtime(target) < os.path.getmtime(
+                os.path.join(self.root, rel_path)
+            ):
+                return False
+            return (
+                read_custom_tags(target, (PRESET_TAG,)).get(PRESET_TAG) == self.preset
+            )
+        except Exception:
+            return False
+
+    def _convert(self, rel_path: str):
+        source = os.path.join(self.root, rel_path)
+        target = self.target_for(rel_path)
+        stat = os.stat(source)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        if self._up_to_date(rel_path, stamp, target):
+            return "skipped", 0, 0
+
+        folder = os.path.dirname(target)
+        os.makedirs(folder, exist_ok=True)
+        # transcode_audio drops unusual characters from names, keep it plain
+        stem = f".reencode-{threading.get_ident()}"
+        temp_target = os.path.join(folder, f"{stem}.{self.ext}")
+        cover_path = os.path.join(folder, f"{stem}.cover")
+        try:
+            with metrics.span("reencode", track=rel_path) as span:
+                preset_tag = read_custom_tags(source, (PRESET_TAG,)).get(PRESET_TAG)
+                if preset_tag == self.preset:
+                    # Already in this preset, copying beats a generation loss
+                    clone_file(source, temp_target)
+                else:
+                    name = os.path.splitext(os.path.basename(temp_target))[0]
+                    transcode_audio(
+                        source, folder, name, quality_preset=self.preset, threads=1
+                    )
+                    copy_audio_tags(source, temp_target, {PRESET_TAG: self.preset})
+                    cover = read_cover_art(source)
+                    if cover:
+                        with open(cover_path, "wb") as f:
+                            f.write(cover)
+                        add_cover_art(temp_target, cover_path)
+                span["bytes"] = os.path.getsize(temp_target)
+            os.replace(temp_target, target)
+        finally:
+            for leftover in (temp_target, cover_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        with self.lock:
+            self.done[rel_path] = stamp
+            due = time.time() - self.last_save > SAVE_INTERVAL
+        if due:
+            self._save_state()
+        return "converted", stat.st_size, os.path.getsize(target)
+
+    def _copy_playlists(self, index: LibraryIndex):
+        written = 0
+        for folder in index.folders():
+            playlist = os.path.join(self.root, folder, f"{folder}.m3u8")
+            try:
+                with open(playlist, "r", encoding="utf-8") as pl:
+                    lines = pl.read().splitlines()
+            except OSError:
+                continue
+            for i, line in enumerate(lines):
+                stem, ext = os.path.splitext(line)
+                if not line.startswith("#") and ext.lower() in AUDIO_FORMATS:
+                    lines[i] = f"{stem}.{self.ext}"
+            target = os.path.join(self.dest, folder, f"{folder}.m3u8")
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            written += write_playlist_lines(target, lines)
+        return written
+
+    def run(self):
+        started = time.time()
+        index = LibraryIndex(self.root).refresh()
+        files = index.audio_files()
+        counts = {"converted": 0, "skipped": 0, "failed": 0}
+        bytes_in = bytes_out = 0
+
+        def work(rel_path):
+            try:
+                return rel_path, *self._convert(rel_path), None
+            except Exception as e:
+                return rel_path, "failed", 0, 0, e
+
+        self.callback("start", files=len(files), workers=self.workers, dest=self.dest)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for rel_path, result, size_in, size_out, error in pool.map(work, files):
+                counts[result] += 1
+                bytes_in += size_in
+                bytes_out += size_out
+                if error:
+                    self.callback("error", file=rel_path, error=str(error))
+                else:
+                    self.callback(result, file=rel_path)
+        self._save_state()
+        playlists = self._copy_playlists(index)
+
+        elapsed = time.time() - started
+        return {
+            **counts,
+            "files": len(files),
+            "playlists": playlists,
+            "dest": self.dest,
+            "seconds": round(elapsed, 3),
+            "files_per_minute": (
+                round(counts["converted"] / elapsed * 60, 2) if elapsed else 0
+            ),
+            "mb_in": round(bytes_in / 1e6, 2),
+            "mb_out": round(bytes_out / 1e6, 2),
+        }
@@ -0,0 +1,74 @@
+import math
+import re
+
+REFERENCE_LOUDNESS = -18.0  # LUFS, ReplayGain 2.0
+SILENCE = -70.0  # LUFS, ebur128's floor for gated loudness
+
+TRACK_GAIN = "REPLAYGAIN_TRACK_GAIN"
+TRACK_PEAK = "REPLAYGAIN_TRACK_PEAK"
+ALBUM_GAIN = "REPLAYGAIN_ALBUM_GAIN"
+ALBUM_PEAK = "REPLAYGAIN_ALBUM_PEAK"
+REPLAYGAIN_TAGS = (TRACK_GAIN, TRACK_PEAK, ALBUM_GAIN, ALBUM_PEAK)
+
+# Extra ffmpeg output that measures the decoded audio, summary only
+LOUDNESS_FILTER = "ebur128=peak=true:framelog=quiet"
+
+_integrated_re = re.compile(r"I:\s+(-?[\d.]+|-?inf) LUFS")
+_peak_re = re.compile(r"Peak:\s+(-?[\d.]+|-?inf) dBFS")
+
+
+def parse_ebur128(log: str):
+    """{"integrated": LUFS, "peak": linear true peak} from ffmpeg's log, or None."""
+    integrated = _integrated_re.findall(log)
+    peak = _peak_re.findall(log)
+    if not integrated or not peak:
+        return None
+    # The summary comes last, after any per-frame lines
+    return {
+        "integrated": max(float(integrated[-1]), SILENCE),
+        "peak": 10 ** (float(peak[-1]) / 20),
+    }
+
+
+def _gain(integrated: float):
+    return f"{REFERENCE_LOUDNESS - integrated:+.2f} dB"
+
+
+def track_tags(loudness: dict):
+    return {
+        TRACK_GAIN: _gain(loudness["integrated"]),
+        TRACK_PEAK: f"{loudness['peak']:.6f}",
+    }
+
+
+def loudness_from_tags(tags: dict):
+    """Inverse of track_tags(), for tracks measured in an earlier run."""
+    try:
+        gain = float(tags[TRACK_GAIN].split()[0])
+        return {
+            "integrated": REFERENCE_LOUDNESS - gain,
+            "peak": float(tags[TRACK_PEAK]),
+        }
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def album_tags(measured: list):
+    """Album gain of [(loudness, seconds), ...].
+
+    Loudness is averaged as energy weighted by duration, which is what one
+    measurement over the concatenated tracks gives up to gating. Silent
+    tracks do not pull the album down.
+    """
+    energy = seconds = 0.0
+    for loudness, length in measured:
+        if loudness["integrated"] <= SILENCE:
+            continue
+        length = max(float(length or 0), 1.0)
+        energy += length * 10 ** (loudness["integrated"] / 10)
+        seconds += length
+    integrated = 10 * math.log10(energy / seconds) if seconds else SILENCE
+    return {
+        ALBUM_GAIN: _gain(integrated),
+        ALBUM_PEAK: f"{max(loudness['peak'] for loudness, _ in measured):.6f}",
+    }
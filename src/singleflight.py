@@ -0,0 +1,74 @@
+import threading
+from typing import Callable
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.users = 1
+        # Set once cleanup finished, the key stays taken until then
+        self.closed = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller of a key runs the function, callers arriving while the
+    result is still held wait for it and share it. Every successful acquire()
+    must be paired with a release(), `cleanup(result)` runs after the last one.
+    Callers arriving during cleanup wait for it before running fn again. If
+    the running call fails, one of the waiting callers tries again.
+    """
+
+    def __init__(self, cleanup: Callable = None):
+        self.cleanup = cleanup
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def acquire(self, key, fn: Callable):
+        """Returns (result, shared), shared is False for the caller that ran fn."""
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                closed = flight.closed if flight else None
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = _Flight()
+                elif closed is None:
+                    flight.users += 1
+            if closed is not None:
+                closed.wait()
+                continue
+            if leader:
+                try:
+                    flight.result = fn()
+                except BaseException as e:
+                    flight.error = e
+                    with self.lock:
+                        del self.flights[key]
+                    raise
+                finally:
+                    flight.done.set()
+                return flight.result, False
+            flight.done.wait()
+            if flight.error is None:
+                return flight.result, True
+
+    def release(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None or flight.closed is not None:
+                return
+            flight.users -= 1
+            if flight.users > 0:
+                return
+            flight.closed = threading.Event()
+        try:
+            if self.cleanup:
+                self.cleanup(flight.result)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.closed.set()
@@ -0,0 +1,319 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+SAVE_INTERVAL = 5  # seconds between index writes for cache hits
+PIN_LEASE = 3600  # seconds a process's pin holds if it never unpins (crashed)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive lock on `path` between processes (and threads)."""
+    with open(path, "a+b") as f:
+        try:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return
+        except ImportError:
+            pass
+        import msvcrt
+
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class SourceCache:
+    """Size bounded on-disk cache of downloaded source audio and cover art.
+
+    Entries are keyed "audio:<video id>|<format id>" and "cover:<url hash>" and
+    evicted least recently used first once `max_bytes` is exceeded. Files in
+    use are pinned and never evicted. The index (with the metadata needed to
+    skip the service entirely, and Spotify id -> video id aliases) is kept in
+    <folder>/index.json.
+
+    Several processes (worker processes, or the UI next to a headless run)
+    may use the same folder. Index writes happen under a file lock and merge
+    this process's changes into what is on disk, pins are written into the
+    entries as leases of the pinning process, so no process evicts a file
+    another one is using.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = os.path.abspath(folder)
+        self.index_path = os.path.join(self.folder, INDEX_FILE)
+        self.lock_path = os.path.join(self.folder, LOCK_FILE)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.owner = str(os.getpid())
+        self.entries = {}
+        self.aliases = {}
+        self.pinned = {}
+        # Changes since the last save, merged into the index on disk then
+        self.touched = set()
+        self.removed = set()
+        self.new_aliases = {}
+        self.dirty = False
+        self.last_save = 0.0
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("entries", {}), data.get("aliases", {})
+        except (OSError, ValueError):
+            return {}, {}
+
+    def load(self):
+        entries, aliases = self._read()
+        with self.lock:
+            self.entries, self.aliases = entries, aliases
+
+    def _merge(self, entries: dict, aliases: dict):
+        """This process's changes on top of the index read from disk."""
+        now = time.time()
+        for key in self.removed:
+            entries.pop(key, None)
+        for key in self.touched:
+            mine = self.entries.get(key)
+            if mine is None:
+                continue
+            theirs = entries.get(key)
+            if theirs and theirs["file"] == mine["file"]:
+                mine["last_used"] = max(mine["last_used"], theirs["last_used"])
+            elif not os.path.exists(os.path.join(self.folder, mine["file"])):
+                # Evicted by another process meanwhile
+                continue
+            entries[key] = mine
+        for key, entry in entries.items():
+            pins = {
+                owner: until
+                for owner, until in (entry.get("pins") or {}).items()
+                if owner != self.owner and until > now
+            }
+            if key in self.pinned:
+                pins[self.owner] = now + PIN_LEASE
+            if pins:
+                entry["pins"] = pins
+            else:
+                entry.pop("pins", None)
+        aliases.update(self.new_aliases)
+        self.entries, self.aliases = entries, aliases
+        self.touched, self.removed, self.new_aliases = set(), set(), {}
+
+    def _evict_merged(self):
+        """Keys and files to drop to get under the budget, lock held."""
+        removed = []
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key, entry in sorted(
+            self.entries.items(), key=lambda item: item[1]["last_used"]
+        ):
+            if total <= self.max_bytes:
+                break
+            if key in self.pinned or entry.get("pins"):
+                continue
+            del self.entries[key]
+            total -= entry["size"]
+            removed.append(entry["file"])
+        return removed
+
+    def save(self, evict: bool = False):
+        """Merge into the index on disk (evicting if asked), returns files removed."""
+        os.makedirs(self.folder, exist_ok=True)
+        with file_lock(self.lock_path):
+            entries, aliases = self._read()
+            with self.lock:
+                self._merge(entries, aliases)
+                removed = self._evict_merged() if evict else []
+                content = json.dumps({"entries": self.entries, "aliases": self.aliases})
+                self.dirty = False
+                self.last_save = time.time()
+            temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(temp_path, self.index_path)
+            for name in removed:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+        return removed
+
+    def flush(self):
+        if self.dirty:
+            self.save()
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.entries.values())
+
+    # Lookups pin the returned entry, unpin() it when done with the file
+
+    def _get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.folder, entry["file"])
+            if not os.path.exists(path):
+                del self.entries[key]
+                self.removed.add(key)
+                self.touched.discard(key)
+                self.dirty = True
+                return None
+            entry["last_used"] = time.time()
+            self.touched.add(key)
+            first_pin = key not in self.pinned
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+            self.dirty = True
+            due = time.time() - self.last_save > SAVE_INTERVAL
+        # Other processes must see the pin before they next evict
+        if first_pin or due:
+            self.save()
+        return key, path, entry
+
+    def unpin(self, key: str):
+        with self.lock:
+            count = self.pinned.get(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+            else:
+                self.pinned.pop(key, None)
+                self.dirty = True
+
+    def _put(self, key: str, src: str, meta: dict = None, move: bool = True):
+        """Store a file, returns its cache path (pinned) or None if it does not fit."""
+        size = os.path.getsize(src)
+        if size > self.max_bytes:
+            return None
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        name += os.path.splitext(src)[1]
+        path = os.path.join(self.folder, name)
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if move:
+            shutil.move(src, temp_path)
+        else:
+            shutil.copyfile(src, temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.entries[key] = {
+                "file": name,
+                "size": size,
+                "last_used": time.time(),
+                "meta": meta or {},
+            }
+            self.touched.add(key)
+            self.removed.discard(key)
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+        self.save(evict=True)
+        return path
+
+    def evict(self):
+        return len(self.save(evict=True))
+
+    # Source audio
+
+    def get_audio(self, video_id: str, min_abr: int = 0):
+        """Cached download_youtube() result for a video, or None.
+
+        Any format of at least `min_abr` kbps will do. A source that was the
+        best stream on offer (nothing saved by picking it) does for any.
+        """
+        with self.lock:
+            keys = [
+                key
+                for key, entry in self.entries.items()
+                if key.startswith(f"audio:{video_id}|")
+                and (
+                    not entry["meta"].get("bytes_saved")
+                    or (entry["meta"].get("abr") or 0) >= min_abr
+                )
+            ]
+        for key in keys:
+            hit = self._get(key)
+            if hit:
+                key, path, entry = hit
+                return {**entry["meta"], "file_path": path, "cache_key": key}
+        return None
+
+    def has_audio(self, video_id: str):
+        """Whether some source of the video is cached, without pinning it."""
+        with self.lock:
+            return any(key.startswith(f"audio:{video_id}|") for key in self.entries)
+
+    def put_audio(self, video_id: str, result: dict):
+        """Move a download_youtube() result into the cache, returns the new result."""
+        key = f"audio:{video_id}|{result.get('format_id') or 'best'}"
+        meta = {k: v for k, v in result.items() if k != "file_path"}
+        path = self._put(key, result["file_path"], meta)
+        if path is None:
+            return result
+        return {**result, "file_path": path, "cache_key": key}
+
+    # Cover art, copied out of the cache because callers delete it after use
+
+    def fetch_cover(self, url: str, save_path: str, download):
+        key = f"cover:{hashlib.sha1(url.encode('utf-8')).hexdigest()}"
+        hit = self._get(key)
+        if hit:
+            shutil.copyfile(hit[1], save_path)
+            self.unpin(key)
+            return save_path
+        download(url, save_path)
+        if self._put(key, save_path, move=False):
+            self.unpin(key)
+        return save_path
+
+    # Spotify id -> video id, so a cached track needs no search either
+
+    def video_for(self, source: str):
+        with self.lock:
+            return self.aliases.get(source)
+
+    def add_alias(self, source: str, video_id: str):
+        with self.lock:
+            if self.aliases.get(source) == video_id:
+                return
+            self.aliases[source] = video_id
+            self.new_aliases[source] = video_id
+            self.dirty = True
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_source_cache(folder: str, max_mb: float):
+    """Shared cache for `folder`, None when the budget is 0 (disabled)."""
+    global _cache
+    max_bytes = int(float(max_mb or 0) * 1024 * 1024)
+    with _cache_lock:
+        if max_bytes <= 0:
+            return None
+        if _cache is None or _cache.folder != os.path.abspath(folder):
+            if _cache:
+                _cache.flush()
+            _cache = SourceCache(folder, max_bytes)
+            atexit.register(_cache.flush)
+        elif _cache.max_bytes != max_bytes:
+            _cache.max_bytes = max_bytes
+            _cache.evict()
+        return _cache
@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from download_index import extra_output_files
+from downloader import collection_snapshot, sanitize, source_key
+
+SYNC_FILE = ".sync_state.json"
+REMOVED_DIR = ".removed"
+REMOVED_MODES = ("keep", "move", "delete")
+CHECK_WORKERS = 8
+
+
+def collection_folder(collection: dict):
+    """Folder of a collection's files relative to the root, "." for a track."""
+    if collection.get("item-type") == "playlist" or "tracks" in collection:
+        return sanitize(collection.get("title") or "")
+    return "."
+
+
+def in_folder(rel_path: str, folder: str):
+    return (os.path.dirname(os.path.normpath(rel_path)) or ".") == folder
+
+
+class SyncState:
+    """Last synced state of every subscribed collection.
+
+    Persisted in <root>/.sync_state.json, keyed by link:
+    {"snapshot", "title", "tracks": [source keys in order],
+     "files": {source key: path relative to root}, "synced"}
+    Only files in the collection's own folder are recorded, others may be
+    another collection's.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, SYNC_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def links(self):
+        return list(self.entries)
+
+    def get(self, link: str):
+        return self.entries.get(link)
+
+    def update(self, link: str, collection: dict, snapshot: str = None):
+        tracks = collection.get("tracks") or [collection]
+        folder = collection_folder(collection)
+        files = {}
+        for track in tracks:
+            key = source_key(track)
+            if key and track.get("status") == "done" and track.get("file_path"):
+                rel_path = os.path.relpath(track["file_path"], self.root)
+                if in_folder(rel_path, folder):
+                    files[key] = rel_path
+        with self.lock:
+            self.entries[link] = {
+                "snapshot": snapshot,
+                "title": collection.get("title"),
+                "tracks": [source_key(track) for track in tracks],
+                "files": files,
+                "synced": round(time.time(), 3),
+            }
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.entries, indent=1)
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def check_snapshots(state: SyncState, links: list):
+    """Fetch the change token of every link in parallel.
+
+    Returns {link: (snapshot, unchanged)}, an exception instead of the tuple
+    when the check itself failed.
+    """
+
+    def check(link):
+        try:
+            snapshot = collection_snapshot(link)
+        except Exception as e:
+            return link, e
+        previous = state.get(link)
+        unchanged = bool(snapshot and previous and previous.get("snapshot") == snapshot)
+        return link, (snapshot, unchanged)
+
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as pool:
+        return dict(pool.map(check, links))
+
+
+def diff_collection(previous: dict, collection: dict):
+    """Source keys added to and dropped from a collection since the last sync."""
+    tracks = collection.get("tracks") or [collection]
+    current = [source_key(track) for track in tracks]
+    before = set((previous or {}).get("tracks", []))
+    added = [key for key in current if key not in before]
+    current_set = set(current)
+    removed = [
+        key for key in (previous or {}).get("tracks", []) if key not in current_set
+    ]
+    return added, removed
+
+
+def mark_synced(root: str, previous: dict, collection: dict, added: list, targets):
+    """Set tracks done that were synced before and whose files still exist.
+
+    What is left to download is then only the `added` tracks and those that
+    did not finish last time, whatever the download index says. `targets`
+    are the (root, preset) outputs, every one of them must have its file.
+    Returns how many tracks were set done.
+    """
+    files = (previous or {}).get("files", {})
+    new = set(added)
+    folder = collection_folder(collection)
+    found = 0
+    for track in collection.get("tracks") or [collection]:
+        key = source_key(track)
+        rel_path = files.get(key)
+        if key in new or not rel_path or track.get("status") == "done":
+            continue
+        file_path = os.path.join(root, rel_path)
+        if not os.path.exists(file_path):
+            continue
+        extra_files = extra_output_files(file_path, folder, targets)
+        if extra_files is None:
+            continue
+        track["status"] = "done"
+        track["file_path"] = file_path
+        if extra_files:
+            track["extra_files"] = extra_files
+        found += 1
+    return found
+
+
+def handle_removed(root: str, previous: dict, removed: list, mode: str = "keep"):
+    """Delete or move the files of dropped tracks, returns the paths touched.
+
+    "keep" leaves the files alone, they only disappear from the playlist.
+    "move" puts them under <root>/.removed/ with the same relative path.
+    Files outside the collection's folder are never touched.
+    """
+    if mode not in REMOVED_MODES:
+        raise ValueError(f"Unknown removal mode '{mode}'")
+    touched = []
+    if mode == "keep":
+        return touched
+    files = (previous or {}).get("files", {})
+    folder = sanitize((previous or {}).get("title") or "")
+    for key in removed:
+        rel_path = files.get(key)
+        if not rel_path or not in_folder(rel_path, folder):
+            continue
+        full_path = os.path.join(root, rel_path)
+        if not os.path.exists(full_path):
+            continue
+        if mode == "delete":
+            os.remove(full_path)
+        else:
+            target = os.path.join(root, REMOVED_DIR, rel_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(full_path, target)
+        touched.append(full_path)
+    return touched
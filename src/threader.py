@@ -1,10 +1,25 @@
 import threading
 import queue
 import uuid
-import time
+import multiprocessing
+from multiprocessing import resource_tracker
+import os
+import signal
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Callable, Iterable
 
+from bandwidth import share_bandwidth
+from metrics import metrics
+
 SEC_PER_CHECK = 2
+JOBS_PER_WORKER = 50  # a worker process is replaced after this many jobs
+CRASH_RETRIES = 1  # a crash breaks the whole pool, its other jobs get another go
+SHARED_RESULTS = 1024  # results kept for later jobs with the same key
+# seconds a finished job's last event may take to arrive before it is given up
+EVENT_TIMEOUT = 30
 
 
 def worker_process(job_queue: queue.Queue, pause_event: threading.Event):
@@ -20,6 +35,7 @@ def worker_process(job_queue: queue.Queue, pause_event: threading.Event):
 
         if job is None:
             # shutdown signal
+            job_queue.task_done()
             break
 
         try:
@@ -36,18 +52,28 @@ class QueueSystem:
         self.job_queue = queue.Queue()
         self.pause_event = threading.Event()
         self.pause_event.set()
+        self.max_processes = max_processes
 
         self.workers: list[threading.Thread] = []
-        for _ in range(max_processes):
-            p = threading.Thread(
-                target=worker_process,
-                args=(self.job_queue, self.pause_event),
-                daemon=True,
-            )
-            p.start()
-            self.workers.append(p)
+        self.workers_lock = threading.Lock()
+
+    def start(self):
+        """Spawn the workers, once. Called on the first submit."""
+        with self.workers_lock:
+            if self.workers:
+                return
+            for i in range(self.max_processes):
+                p = threading.Thread(
+                    target=worker_process,
+                    args=(self.job_queue, self.pause_event),
+                    name=f"worker-{i}",
+                    daemon=True,
+                )
+                p.start()
+                self.workers.append(p)
 
     def submit_jobs(self, jobs: Iterable[Callable]):
+        self.start()
         for job in jobs:
             self.job_queue.put(job)
 
@@ -85,3 +111,227 @@ class QueueSystem:
 
     def wait_completion(self):
         self.job_queue.join()
+
+
+# Worker process side of ProcessQueueSystem
+
+_events = None
+
+
+def _init_worker_process(events, share: float):
+    global _events
+    _events = events
+    # Ctrl+C is the parent's to handle, it lets running jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    share_bandwidth(share)
+
+
+def _run_in_process(handler: Callable, job_id: str, job: dict):
+    def callback(state, type="state"):
+        _events.put((job_id, {"state": state, "type": type}))
+
+    try:
+        event = {"result": handler(job, callback)}
+    except Exception as e:
+        event = {"error": str(e)}
+    # One job at a time per process, so every span since the last one is its
+    event["spans"] = list(metrics.spans)
+    event["pid"] = os.getpid()
+    metrics.reset()
+    # Same pipe as the status updates, so the result always comes after them
+    _events.put((job_id, event))
+
+
+def _start_resource_tracker():
+    """Start multiprocessing's resource tracker process, with a real stderr.
+
+    It is handed our stderr, which the UI replaces while it runs with an
+    object that has no file descriptor.
+    """
+    if os.name != "posix":
+        return
+    stderr = sys.stderr
+    sys.stderr = sys.__stderr__ or stderr
+    try:
+        resource_tracker.ensure_running()
+    finally:
+        sys.stderr = stderr
+
+
+class ProcessQueueSystem(QueueSystem):
+    """QueueSystem that runs the jobs in a pool of worker processes.
+
+    Jobs are picklable dicts run as `handler(job, callback)` in a worker
+    process, `handler` must be a module level function. The status updates
+    of the callback and then the handler's result ({"result": ...} or
+    {"error": ...}) come back over one pipe and are delivered to
+    `on_event(job, event)` in this process, the same events
+    RedisQueueSystem delivers. Worker processes are replaced after
+    `jobs_per_worker` jobs to cap memory growth. A crashing process breaks
+    the pool, the jobs running in it are tried again in a new one. Jobs with
+    the same `key(job)` never run at the same time, they could write the
+    same files, and a later one gets the result of the last that finished as
+    job["shared"] (None before the first, and again once wait_completion()
+    ends the run), since worker processes share no memory. The bandwidth and
+    connection budgets are split evenly between the processes.
+
+    Threads of this process hand the jobs over one at a time, so pause,
+    abort and wait_completion behave like QueueSystem's.
+    """
+
+    def __init__(
+        self,
+        handler: Callable,
+        on_event: Callable = None,
+        max_processes: int = 4,
+        jobs_per_worker: int = JOBS_PER_WORKER,
+        key: Callable = None,
+    ):
+        super().__init__(max_processes)
+        self.handler = handler
+        self.on_event = on_event or (lambda job, event: None)
+        self.jobs_per_worker = max(int(jobs_per_worker or JOBS_PER_WORKER), 1)
+        self.key = key
+        self.key_locks = {}
+        self.results = OrderedDict()
+
+        # spawn, forking a process with running threads is not safe
+        self.context = multiprocessing.get_context("spawn")
+        # Created with the first worker processes
+        self.events = None
+        self.listener = None
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self.pool_lock:
+            if self.listener is None:
+                _start_resource_tracker()
+                self.events = self.context.Queue()
+                self.listener = threading.Thread(
+                    target=self._listen, name="process-events", daemon=True
+                )
+                self.listener.start()
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.max_processes,
+                    mp_context=self.context,
+                    initializer=_init_worker_process,
+                    initargs=(self.events, 1 / self.max_processes),
+                    max_tasks_per_child=self.jobs_per_worker,
+                )
+            return self.pool
+
+    def _replace_pool(self, broken):
+        with self.pool_lock:
+            if self.pool is broken:
+                self.pool = None
+        broken.shutdown(wait=False)
+
+    def submit_jobs(self, jobs: Iterable[dict]):
+        super().submit_jobs(lambda job=job: self._dispatch(job) for job in jobs)
+
+    def _dispatch(self, job: dict):
+        job_id = uuid.uuid4().hex
+        finished = threading.Event()
+        with self.running_lock:
+            self.running[job_id] = (job, finished)
+        key = self.key(job) if self.key else None
+        key_lock = threading.Lock()
+        if key is not None:
+            with self.running_lock:
+                # [lock, dispatchers holding or waiting for it]
+                entry = self.key_locks.setdefault(key, [key_lock, 0])
+                entry[1] += 1
+                key_lock = entry[0]
+        try:
+            with key_lock:
+                with self.running_lock:
+                    shared = self.results.get(key) if key is not None else None
+                sent = {**job, "shared": shared} if key is not None else job
+                for attempt in range(CRASH_RETRIES + 1):
+                    pool = self._get_pool()
+                    try:
+                        pool.submit(
+                            _run_in_process, self.handler, job_id, sent
+                        ).result()
+                        break
+                    except BrokenProcessPool:
+                        self._replace_pool(pool)
+                else:
+                    self._finish(job_id, {"error": "Worker process crashed"})
+                    return
+                # The worker returned, so its last event is at most in flight.
+                # It is lost if the process died before the queue sent it
+                if not finished.wait(EVENT_TIMEOUT):
+                    self._finish(job_id, {"error": "Worker process result lost"})
+        finally:
+            with self.running_lock:
+                self.running.pop(job_id, None)
+                if key is not None:
+                    entry = self.key_locks[key]
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.key_locks[key]
+
+    def _finish(self, job_id: str, event: dict):
+        with self.running_lock:
+            job, finished = self.running.get(job_id, (None, None))
+        if job is None:
+            return
+        key = self.key(job) if self.key else None
+        if key is not None and "result" in event:
+            with self.running_lock:
+                self.results[key] = event["result"]
+                self.results.move_to_end(key)
+                while len(self.results) > SHARED_RESULTS:
+                    self.results.popitem(last=False)
+        try:
+            self.on_event(job, event)
+        finally:
+            finished.set()
+
+    def _listen(self):
+        while True:
+            item = self.events.get()
+            if item is None:
+                break
+            job_id, event = item
+            if "state" in event:
+                with self.running_lock:
+                    job = self.running.get(job_id, (None, None))[0]
+                if job is not None:
+                    self.on_event(job, event)
+                continue
+            worker = f"process-{event.pop('pid')}"
+            for span in event.pop("spans"):
+                metrics.record(
+                    span["stage"],
+                    span["seconds"],
+                    track=span["track"],
+                    nbytes=span["bytes"],
+                    ok=span["ok"],
+                    worker=worker,
+                )
+            self._finish(job_id, event)
+
+    def wait_completion(self):
+        super().wait_completion()
+        # The next jobs are another run, these files may change meanwhile
+        with self.running_lock:
+            self.results.clear()
+
+    def shutdown_graceful(self):
+        """Let workers exit cleanly after finishing current jobs."""
+        super().shutdown_graceful()
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=True)
+        with self.pool_lock:
+            listener, self.listener = self.listener, None
+        if listener:
+            self.events.put(None)
+            listener.join()
@@ -4,6 +4,7 @@ from pathlib import Path
 
 from rich.text import Text
 from rich.markup import escape
+from textual import events
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal
 from textual.widgets import (
@@ -21,13 +22,32 @@ from textual.widgets import (
     Switch,
 )
 
-from consts import CONFIG_FILE
+from consts import CONFIG_FILE, METRICS_DIR, PROFILE_DIR
 from downloader import *
+from metrics import metrics
+from profiler import JobProfiler
+from download_index import open_download_index
 from playlist import *
 from threader import *
 import threading
 
 
+class LinkInput(Input):
+    """Input that keeps every link of a multi-line paste, not just the first line."""
+
+    def _on_paste(self, event: events.Paste):
+        if not event.text or len(event.text.strip().splitlines()) < 2:
+            return
+        # Replaces Input's handler, which keeps the first line only
+        event.prevent_default()
+        event.stop()
+        text = " ".join(split_links(event.text))
+        if self.selection.is_empty:
+            self.insert_text_at_cursor(text)
+        else:
+            self.replace(text, *self.selection)
+
+
 class MusicDownloaderApp(App):
     CSS = """
         Screen { layout: vertical; }
@@ -41,6 +61,7 @@ class MusicDownloaderApp(App):
         .status_bar { height: auto; layout: horizontal; align: left middle; margin: 1 0; }
         #overall_progress { width: 1fr; margin-left: 2; }
         #switch_dev { margin-bottom: 1; }
+        #switch_replaygain { margin-bottom: 1; }
         """
 
     TITLE = "Music Downloader"
@@ -58,6 +79,11 @@ class MusicDownloaderApp(App):
         self.log_history = []
 
         self.expanded_folders = set()
+        self.playlist_writers = {}
+        self.download_index = None
+        # Normalized links of the queued collections, for bulk import
+        self.queued_links = set()
+        self.analyze_lock = threading.Lock()
 
         # Config defaults
         self.cfg_path = str(Path.home() / "MusicDownloader")
@@ -67,6 +93,13 @@ class MusicDownloaderApp(App):
         self.cfg_max_parallel = "1"
         self.cfg_dev_mode = False
         self.cfg_template = "$artist$ - $title$"
+        self.cfg_profile_every = "0"
+        self.cfg_profile_slow = "0"
+        self.cfg_source_cache_mb = "0"
+        self.cfg_replaygain = False
+        self.cfg_bandwidth_kbps = "0"
+        self.cfg_queue_backend = "threads"
+        self.cfg_jobs_per_worker = JOBS_PER_WORKER
 
         self.quality_map = {
             "MP3 128kbps": {"format": "mp3", "bitrate": "128K"},
@@ -78,14 +111,24 @@ class MusicDownloaderApp(App):
         }
         self.load_settings()
 
-        self.thread_system = QueueSystem(max_processes=int(self.cfg_max_parallel))
+        if self.cfg_queue_backend == "processes":
+            self.thread_system = ProcessQueueSystem(
+                run_track_job,
+                on_event=self._process_event,
+                max_processes=int(self.cfg_max_parallel),
+                jobs_per_worker=self.cfg_jobs_per_worker,
+                key=lambda job: source_key(job["song"]),
+            )
+        else:
+            self.thread_system = QueueSystem(max_processes=int(self.cfg_max_parallel))
 
     def compose(self) -> ComposeResult:
         yield Header()
         with TabbedContent():
             with TabPane("Queue & Download", id="tab_queue"):
-                yield Input(
-                    placeholder="Paste a link or search query...", id="link_entry"
+                yield LinkInput(
+                    placeholder="Paste links, a search query or a links file path...",
+                    id="link_entry",
                 )
                 with Horizontal(classes="controls"):
                     yield Button("Add", id="btn_add", variant="primary")
@@ -102,6 +145,11 @@ class MusicDownloaderApp(App):
                     yield Button("Copy Log to Clipboard", id="btn_copy_log")
                     yield Button("Clear Log", id="btn_clear_log", variant="error")
                 yield RichLog(id="full_log", markup=True)
+            with TabPane("Stats", id="tab_stats"):
+                with Horizontal(classes="controls"):
+                    yield Button("Export Metrics", id="btn_export_metrics")
+                    yield Button("Reset", id="btn_reset_metrics", variant="error")
+                yield DataTable(id="stats_table")
             with TabPane("Settings", id="tab_settings"):
                 yield Label("Download Root Folder:", classes="settings_field")
                 yield Input(
@@ -143,20 +191,93 @@ class MusicDownloaderApp(App):
                     classes="settings_field",
                     type="integer",
                 )
+                yield Label(
+                    "Run downloads in (applies after a restart):",
+                    classes="settings_field",
+                )
+                yield Select(
+                    [("Threads", "threads"), ("Separate processes", "processes")],
+                    value=self.cfg_queue_backend,
+                    id="select_backend",
+                    allow_blank=False,
+                    classes="settings_field",
+                )
+                yield Label(
+                    "Source audio cache size in MB (0 = off):", classes="settings_field"
+                )
+                yield Input(
+                    value=self.cfg_source_cache_mb,
+                    id="input_source_cache",
+                    classes="settings_field",
+                    type="integer",
+                )
+                yield Label(
+                    "Bandwidth limit in kbit/s, shared by all downloads (0 = off):",
+                    classes="settings_field",
+                )
+                yield Input(
+                    value=self.cfg_bandwidth_kbps,
+                    id="input_bandwidth",
+                    classes="settings_field",
+                    type="integer",
+                )
+                yield Label(
+                    "Write ReplayGain tags (measured while transcoding):",
+                    classes="settings_field",
+                )
+                yield Switch(value=self.cfg_replaygain, id="switch_replaygain")
                 yield Label("Developer options:", classes="settings_field")
                 yield Switch(value=self.cfg_dev_mode, id="switch_dev")
+                yield Label(
+                    "Profile every Nth job (0 = off):",
+                    id="lbl_profile_every",
+                    classes="settings_field dev_only",
+                )
+                yield Input(
+                    value=self.cfg_profile_every,
+                    id="input_profile_every",
+                    classes="settings_field dev_only",
+                    type="integer",
+                )
+                yield Label(
+                    "Profile jobs slower than seconds (0 = off):",
+                    id="lbl_profile_slow",
+                    classes="settings_field dev_only",
+                )
+                yield Input(
+                    value=self.cfg_profile_slow,
+                    id="input_profile_slow",
+                    classes="settings_field dev_only",
+                    type="number",
+                )
                 yield Button("Save Settings", id="btn_save", variant="primary")
         yield Footer()
 
     def on_mount(self):
-        table = self.query_one(DataTable)
+        table = self.query_one("#queue_table", DataTable)
         table.cursor_type = "row"
         table.add_columns("ID", "Status", "Name", "Folder")
+        stats = self.query_one("#stats_table", DataTable)
+        stats.add_columns(
+            "Stage",
+            "Count",
+            "Mean (s)",
+            "p50 (s)",
+            "p95 (s)",
+            "Max (s)",
+            "MB",
+            "Errors",
+        )
+        self.stats_version = -1
+        self.set_interval(2, self._refresh_stats)
         self.query_one("#btn_copy_log").display = self.cfg_dev_mode
         self.query_one("#btn_clear_log").display = self.cfg_dev_mode
         self.query_one("#lbl_template").display = self.cfg_dev_mode
         self.query_one("#template").display = self.cfg_dev_mode
+        for widget in self.query(".dev_only"):
+            widget.display = self.cfg_dev_mode
         self.log_msg("Application started.", "SYSTEM")
+        prefetch_ffmpeg_path()
 
     def action_paste_link(self):
         try:
@@ -165,7 +286,10 @@ class MusicDownloaderApp(App):
             content = pyperclip.paste()
             if content:
                 inp = self.query_one("#link_entry", Input)
-                inp.value = content.strip()
+                if len(content.strip().splitlines()) > 1:
+                    inp.value = " ".join(split_links(content))
+                else:
+                    inp.value = content.strip()
                 inp.focus()
                 self.notify("Link pasted!")
         except:
@@ -192,6 +316,8 @@ class MusicDownloaderApp(App):
             self.query_one("#btn_clear_log").display = event.value
             self.query_one("#lbl_template").display = event.value
             self.query_one("#template").display = event.value
+            for widget in self.query(".dev_only"):
+                widget.display = event.value
 
     def on_button_pressed(self, event: Button.Pressed):
         btn_id = event.button.id
@@ -211,6 +337,11 @@ class MusicDownloaderApp(App):
             self.copy_log_to_clipboard()
         elif btn_id == "btn_clear_log":
             self.clear_log()
+        elif btn_id == "btn_export_metrics":
+            self.export_metrics()
+        elif btn_id == "btn_reset_metrics":
+            metrics.reset()
+            self._refresh_stats()
 
     def load_settings(self):
         if os.path.exists(CONFIG_FILE):
@@ -226,6 +357,15 @@ class MusicDownloaderApp(App):
                         "filename_template", "$artist$ - $title$"
                     )
                     self.cfg_dev_mode = data.get("dev_mode", False)
+                    self.cfg_profile_every = data.get("profile_every", "0")
+                    self.cfg_profile_slow = data.get("profile_slow_seconds", "0")
+                    self.cfg_source_cache_mb = data.get("source_cache_mb", "0")
+                    self.cfg_replaygain = data.get("replaygain", False)
+                    self.cfg_bandwidth_kbps = str(data.get("bandwidth_kbps", "0"))
+                    self.cfg_queue_backend = data.get("queue_backend", "threads")
+                    self.cfg_jobs_per_worker = int(
+                        data.get("jobs_per_worker") or JOBS_PER_WORKER
+                    )
             except:
                 pass
 
@@ -236,12 +376,40 @@ class MusicDownloaderApp(App):
         self.cfg_quality = self.query_one("#select_quality", Select).value
         self.cfg_template = self.query_one("#template", Input).value
         self.cfg_dev_mode = self.query_one("#switch_dev", Switch).value
+        self.cfg_replaygain = self.query_one("#switch_replaygain", Switch).value
+        self.cfg_queue_backend = self.query_one("#select_backend", Select).value
         try:
             val = int(self.query_one("#input_parallel", Input).value)
             self.cfg_max_parallel = str(max(1, min(20, val)))
         except ValueError:
             self.cfg_max_parallel = "1"
-        data = {
+        try:
+            val = int(self.query_one("#input_profile_every", Input).value)
+            self.cfg_profile_every = str(max(0, val))
+        except ValueError:
+            self.cfg_profile_every = "0"
+        try:
+            val = float(self.query_one("#input_profile_slow", Input).value)
+            self.cfg_profile_slow = str(max(0.0, val))
+        except ValueError:
+            self.cfg_profile_slow = "0"
+        try:
+            val = int(self.query_one("#input_source_cache", Input).value)
+            self.cfg_source_cache_mb = str(max(0, val))
+        except ValueError:
+            self.cfg_source_cache_mb = "0"
+        try:
+            val = int(self.query_one("#input_bandwidth", Input).value)
+            self.cfg_bandwidth_kbps = str(max(0, val))
+        except ValueError:
+            self.cfg_bandwidth_kbps = "0"
+        # Keys without a field here (extra_outputs, ...) are kept as they are
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data |= {
             "path": self.cfg_path,
             "sp_id": self.cfg_sp_id,
             "sp_sec": self.cfg_sp_sec,
@@ -249,9 +417,17 @@ class MusicDownloaderApp(App):
             "max_parallel": self.cfg_max_parallel,
             "filename_template": self.cfg_template,
             "dev_mode": self.cfg_dev_mode,
+            "profile_every": self.cfg_profile_every,
+            "profile_slow_seconds": self.cfg_profile_slow,
+            "source_cache_mb": self.cfg_source_cache_mb,
+            "replaygain": self.cfg_replaygain,
+            "bandwidth_kbps": self.cfg_bandwidth_kbps,
+            "queue_backend": self.cfg_queue_backend,
         }
         with open(CONFIG_FILE, "w") as f:
             json.dump(data, f, indent=4)
+        # Running downloads slow down or speed up right away
+        configure_bandwidth(data)
         self.notify("Settings saved!")
 
     def copy_log_to_clipboard(self):
@@ -274,6 +450,51 @@ class MusicDownloaderApp(App):
         self.query_one("#full_log", RichLog).clear()
         self.notify("Log cleared!")
 
+    def export_metrics(self):
+        try:
+            paths = metrics.export(METRICS_DIR)
+            self.log_msg(f"Metrics exported: {', '.join(paths)}", "SYSTEM")
+            if threading.get_ident() == self._thread_id:
+                self.notify("Metrics exported!")
+            else:
+                self.call_from_thread(self.notify, "Metrics exported!")
+        except Exception as e:
+            self.log_msg(f"Metrics export failed: {e}", "ERROR")
+
+    def _refresh_stats(self):
+        if metrics.version == self.stats_version:
+            return
+        self.stats_version = metrics.version
+        stage_order = [
+            "analyze",
+            "search",
+            "fetch",
+            "verify",
+            "transcode",
+            "tagging",
+            "cover",
+        ]
+        summary = metrics.summary()
+        table = self.query_one("#stats_table", DataTable)
+        table.clear()
+        for stage in sorted(
+            summary,
+            key=lambda s: (
+                stage_order.index(s) if s in stage_order else len(stage_order)
+            ),
+        ):
+            row = summary[stage]
+            table.add_row(
+                stage,
+                str(row["count"]),
+                f"{row['mean']:.2f}",
+                f"{row['p50']:.2f}",
+                f"{row['p95']:.2f}",
+                f"{row['max']:.2f}",
+                f"{row['bytes'] / 1_000_000:.1f}",
+                str(row["errors"]),
+            )
+
     def log_msg(self, message, level="INFO"):
         ts = datetime.datetime.now().strftime("%H:%M:%S")
         color = "white"
@@ -287,6 +508,8 @@ class MusicDownloaderApp(App):
             color = "blue"
         elif level == "DEBUG":
             color = "purple"
+        elif level == "PROFILE":
+            color = "cyan"
         self.log_history.append(f"[{ts}] [{level}] {str(message)}")
         msg = Text.from_markup(
             f"[{color}][{ts}] [{level}] {escape(str(message))}[/{color}]"
@@ -339,7 +562,7 @@ class MusicDownloaderApp(App):
             self.log_msg(f"Progress bar error: {e}", "ERROR")
 
     def _refresh_table(self):
-        table = self.query_one(DataTable)
+        table = self.query_one("#queue_table", DataTable)
         table.clear()
 
         status_map = {
@@ -415,17 +638,71 @@ class MusicDownloaderApp(App):
         if self.is_downloading:
             return
         self.download_queue.clear()
+        self.queued_links.clear()
         self.expanded_folders.clear()
+        self.playlist_writers.clear()
         self.refresh_queue_ui()
 
     def add_to_queue_thread(self):
         link = self.query_one("#link_entry", Input).value.strip()
         if not link:
             return
+        links_file = os.path.expanduser(link)
+        if os.path.isfile(links_file):
+            try:
+                with open(links_file, "r", encoding="utf-8") as f:
+                    links = split_links(f.read())
+            except (OSError, UnicodeDecodeError) as e:
+                self.notify(f"Could not read {escape(link)}: {e}", severity="error")
+                return
+        else:
+            links = split_links(link)
+            if len(links) < 2 or not all(
+                l.startswith(("http://", "https://")) for l in links
+            ):
+                links = None
         self.query_one("#btn_add", Button).disabled = True
-        threading.Thread(target=self.process_input, args=(link,), daemon=True).start()
+        if links is None:
+            target, args = self.process_input, (link,)
+        else:
+            target, args = self.process_links, (links,)
+        threading.Thread(target=target, args=args, daemon=True).start()
         self.query_one("#link_entry", Input).value = ""
 
+    def process_links(self, links):
+        """Bulk import, collections are queued as their analysis finishes."""
+        with self.analyze_lock:
+            new_links = [l for l in links if l not in self.queued_links]
+            self.queued_links.update(new_links)
+        skipped = len(links) - len(new_links)
+        self.log_msg(
+            f"Analyzing {len(new_links)} links ({skipped} already queued)",
+            "ANALYZER",
+        )
+        failed = []
+
+        def on_result(link, result_dict, error):
+            if error:
+                failed.append(link)
+                with self.analyze_lock:
+                    self.queued_links.discard(link)
+                self.log_msg(f"Error: {link}: {error}", "ERROR")
+                return
+            self.download_queue.append(result_dict)
+            self.log_msg(f"Queued: {result_dict.get('title')}", "ANALYZER")
+            self.refresh_queue_ui()
+
+        analyze_links(new_links, on_result)
+        added = len(new_links) - len(failed)
+        self.notify(
+            f"Added {added} of {len(links)} links",
+            severity="error" if failed else "information",
+        )
+        self.refresh_queue_ui()
+        self.call_from_thread(
+            lambda: setattr(self.query_one("#btn_add", Button), "disabled", False)
+        )
+
     def process_input(self, link):
         self.log_msg(f"Analyzing: {link}", "ANALYZER")
         domain = link.removeprefix("https://").removeprefix("http://").split("/")[0]
@@ -433,11 +710,13 @@ class MusicDownloaderApp(App):
             if "youtube.com" in domain or "youtu.be" in domain:
                 result_dict = youtube_get_initial(link.split("&si=")[0])
                 self.download_queue.append(result_dict)
+                self.queued_links.add(normalize_link(link))
             elif "soundcloud.com" in domain:
                 self.notify("We are working on this platform", severity="warning")
             elif "spotify.com" in domain:
                 result_dict = spotify_get_initial(link)
                 self.download_queue.append(result_dict)
+                self.queued_links.add(normalize_link(link))
             elif "cigoria.eu" in domain:
                 self.notify("Creators: Zeti_1223 and SkyFonix")
             else:
@@ -490,9 +769,10 @@ class MusicDownloaderApp(App):
                 state, queue_num, queue_sub_num, type
             )
             folder_name = sanitize(self.download_queue[queue_num]["title"])
+            song_dict = self.download_queue[queue_num]["tracks"][queue_sub_num]
             try:
                 download_single(
-                    song_dict=self.download_queue[queue_num]["tracks"][queue_sub_num],
+                    song_dict=song_dict,
                     folder_name=folder_name,
                     callback=callback,
                 )
@@ -500,69 +780,185 @@ class MusicDownloaderApp(App):
                 self.log_msg(f"Download failed: {e}", "ERROR")
                 self.change_state("error", queue_num, queue_sub_num)
                 raise e
+            self.download_index.add(song_dict, self.cfg_quality, song_dict["file_path"])
+            for writer in self.playlist_writers.get(queue_num, []):
+                if not writer.add_track(song_dict):
+                    self.log_msg(f"Could not update {writer.playlist_path}", "WARNING")
         else:
             self.change_state("downloading", queue_num, queue_sub_num)
             callback = lambda state, type="status": self.change_state(
                 state, queue_num, queue_sub_num, type
             )
+            song_dict = self.download_queue[queue_num]
             try:
-                download_single(
-                    song_dict=self.download_queue[queue_num], callback=callback
-                )
+                download_single(song_dict=song_dict, callback=callback)
             except Exception as e:
                 self.log_msg(f"Download failed: {e}", "ERROR")
                 self.change_state("error", queue_num, queue_sub_num)
                 raise e
+            self.download_index.add(song_dict, self.cfg_quality, song_dict["file_path"])
 
-    def _generate_playlists(self):
+    def _process_event(self, job, event):
+        """Applies what a worker process reported for a track job."""
+        queue_num, queue_sub_num = job["queue"], job["track"]
+        if "state" in event:
+            self.change_state(event["state"], queue_num, queue_sub_num, event["type"])
+            return
+        if queue_sub_num is not None:
+            song_dict = self.download_queue[queue_num]["tracks"][queue_sub_num]
+        else:
+            song_dict = self.download_queue[queue_num]
+        if "error" in event:
+            self.log_msg(f"Download failed: {event['error']}", "ERROR")
+            self.change_state("error", queue_num, queue_sub_num)
+            return
+        song_dict.update(event["result"])
+        self.download_index.add(song_dict, self.cfg_quality, song_dict["file_path"])
+        for writer in self.playlist_writers.get(queue_num, []):
+            if not writer.add_track(song_dict):
+                self.log_msg(f"Could not update {writer.playlist_path}", "WARNING")
+
+    def _process_job(self, queue_num, queue_sub_num):
+        """A queued track as a job for the worker processes."""
+        if queue_sub_num is not None:
+            song_dict = self.download_queue[queue_num]["tracks"][queue_sub_num]
+            folder_name = sanitize(self.download_queue[queue_num]["title"])
+        else:
+            song_dict = self.download_queue[queue_num]
+            folder_name = None
+        return {
+            "queue": queue_num,
+            "track": queue_sub_num,
+            "song": song_dict,
+            "folder": folder_name,
+        }
+
+    def _download_path(self):
         try:
             with open(CONFIG_FILE, "r") as f:
                 config = json.load(f)
-                download_path = config.get("path", self.cfg_path)
+                return config.get("path", self.cfg_path)
+        except Exception:
+            return self.cfg_path
+
+    def _output_roots(self):
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                targets = output_targets(json.load(f))
+            return list(dict.fromkeys(root for root, _ in targets))
         except Exception:
-            download_path = self.cfg_path
+            return [self.cfg_path]
+
+    def _open_playlist_writers(self):
+        roots = self._output_roots()
+        for queue_num, item in enumerate(self.download_queue):
+            if (
+                item.get("item-type") != "playlist"
+                or queue_num in self.playlist_writers
+            ):
+                continue
+            writers = collection_writers(sanitize(item["title"]), roots)
+            for writer in writers:
+                for track in item["tracks"]:
+                    if track.get("status") == "done":
+                        writer.add_track(track, write=False)
+            self.playlist_writers[queue_num] = writers
 
+    def _write_album_gain(self):
         for item in self.download_queue:
-            if item.get("item-type") == "playlist":
-                folder_name = sanitize(item["title"])
-                full_path = os.path.join(download_path, folder_name)
-
-                if os.path.isdir(full_path):
-                    self.log_msg(f"Updating playlist for: {folder_name}", "INFO")
-                    if update_folder_playlist(full_path):
-                        self.log_msg(f"Playlist generated: {folder_name}", "SUCCESS")
-                    else:
-                        self.log_msg(
-                            f"No audio files found for playlist: {folder_name}",
-                            "WARNING",
-                        )
+            if item.get("item-type") != "playlist":
+                continue
+            try:
+                if write_album_gain(item["tracks"], sanitize(item["title"])):
+                    self.log_msg(f"Album gain written: {item['title']}", "SUCCESS")
+            except Exception as e:
+                self.log_msg(f"Album gain failed for {item['title']}: {e}", "ERROR")
+
+    def _generate_playlists(self):
+        # Playlists are written as each track finishes, this only reports on them
+        for queue_num, writers in self.playlist_writers.items():
+            writer = writers[0]
+            folder_name = os.path.basename(writer.folder_path)
+            if writer.entries:
+                self.log_msg(f"Playlist generated: {folder_name}", "SUCCESS")
+            else:
+                self.log_msg(
+                    f"No audio files found for playlist: {folder_name}",
+                    "WARNING",
+                )
 
     def start_downloads(self):
+        threading.Thread(target=self._run_downloads, daemon=True).start()
+
+    def _mark_existing(self):
+        download_path = os.path.abspath(self._download_path())
+        if self.download_index is None or self.download_index.root != download_path:
+            self.log_msg("Loading library index...", "SYSTEM")
+            self.download_index = open_download_index(download_path)
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                targets = output_targets(json.load(f))
+        except Exception:
+            targets = [(download_path, self.cfg_quality)]
+        found = self.download_index.mark_existing(self.download_queue, targets)
+        if found:
+            self.log_msg(f"{found} tracks are already in the library", "INFO")
+            self.refresh_queue_ui()
 
-        job_queue = []
+    def _run_downloads(self):
+        self._mark_existing()
+        plan_outputs(self.download_queue, self.download_index)
+
+        targets = []
+        job_titles = []
+        songs = []
 
         for queue_num, data in enumerate(self.download_queue):
             if data["item-type"] == "track":
                 if data["status"] == "waiting":
-                    job_queue.append(
-                        lambda q_num=queue_num: self._download_wrapper(q_num, None)
-                    )
-                self.log_msg(len(job_queue), "DEBUG")
+                    targets.append((queue_num, None))
+                    job_titles.append(data["title"])
+                    songs.append(data)
+                self.log_msg(len(targets), "DEBUG")
             if data["item-type"] == "playlist":
                 for queue_sub_num, data2 in enumerate(data["tracks"]):
                     if data2["status"] == "waiting" or data2["status"] == "error":
-                        job_queue.append(
-                            lambda q_num=queue_num, q_s_num=queue_sub_num: self._download_wrapper(
-                                q_num, q_s_num
-                            )
-                        )
+                        targets.append((queue_num, queue_sub_num))
+                        job_titles.append(data2["title"])
+                        songs.append(data2)
+        job_queue = [
+            lambda target=target: self._download_wrapper(*target) for target in targets
+        ]
         self.log_msg(job_queue, "DEBUG")
+        if not isinstance(self.thread_system, ProcessQueueSystem):
+            # Downloads in this process use the extractions made meanwhile
+            prefetch_extraction(songs)
+        profiler = JobProfiler(
+            PROFILE_DIR,
+            every_n=int(self.cfg_profile_every or 0),
+            slow_seconds=float(self.cfg_profile_slow or 0),
+            log=self.log_msg,
+        )
+        if isinstance(self.thread_system, ProcessQueueSystem):
+            # Same tracks, handed to the worker processes as plain data
+            job_queue = [self._process_job(*target) for target in targets]
+            if self.cfg_dev_mode and profiler.enabled:
+                self.log_msg(
+                    "Profiling is not supported with the processes backend",
+                    "WARNING",
+                )
+        elif self.cfg_dev_mode:
+            if profiler.enabled:
+                job_queue = [
+                    profiler.wrap(job, title)
+                    for job, title in zip(job_queue, job_titles)
+                ]
+                self.log_msg(f"Profiling enabled, output in {PROFILE_DIR}", "PROFILE")
+        self._open_playlist_writers()
         self.thread_system.submit_jobs(job_queue)
         self.log_msg("Starting job queue", "INFO")
 
-        def run_after():
-            self.thread_system.wait_completion()
-            self._generate_playlists()
-
-        t = threading.Thread(target=run_after)
-        t.start()
+        self.thread_system.wait_completion()
+        self.download_index.flush()
+        self._write_album_gain()
+        self._generate_playlists()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other flat, as when run from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
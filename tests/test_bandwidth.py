@@ -0,0 +1,152 @@
+import datetime
+
+import pytest
+
+import bandwidth
+from bandwidth import BandwidthGovernor, ConnectionBudget, parse_schedule
+
+
+class FakeClock:
+    """Stands in for the time module, sleeping only moves the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.on_sleep = None
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        if self.on_sleep:
+            self.on_sleep()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bandwidth, "time", clock)
+    return clock
+
+
+def governor(kbps=0, schedule=None):
+    g = BandwidthGovernor()
+    g.configure(kbps, schedule)
+    return g
+
+
+def test_unlimited_never_waits(clock):
+    g = governor(0)
+    assert g.consume(10**9) == 0.0
+    assert clock.sleeps == []
+
+
+def test_waits_for_the_bytes_over_the_rate(clock):
+    g = governor(8)  # 1000 bytes/s
+    assert g.consume(500) == pytest.approx(0.5)
+    assert g.consume(1000) == pytest.approx(1.0)
+    assert g.waited == pytest.approx(1.5)
+    # Long waits are cut into short sleeps, so a new limit applies soon
+    assert max(clock.sleeps) <= bandwidth.MAX_SLEEP
+
+
+def test_idle_time_allows_one_second_of_burst(clock):
+    g = governor(8)
+    clock.now += 60
+    assert g.consume(1000) == 0.0
+    assert g.consume(250) == pytest.approx(0.25)
+
+
+def test_share_splits_the_rate(clock):
+    g = governor(8)
+    g.share = 0.5
+    assert g.consume(500) == pytest.approx(1.0)
+
+
+def test_lifting_the_limit_ends_the_wait(clock):
+    g = governor(8)
+    clock.on_sleep = lambda: g.configure(0)
+    waited = g.consume(10000)
+    assert waited == pytest.approx(bandwidth.MAX_SLEEP)
+    assert g.tokens == 0.0
+
+
+def test_nothing_to_consume(clock):
+    assert governor(8).consume(0) == 0.0
+
+
+def test_parse_schedule():
+    assert parse_schedule(
+        [
+            {"start": "08:30", "end": "17:00", "kbps": 500},
+            {"start": "23:00", "end": "06:00", "kbps": "100"},
+        ]
+    ) == [(510, 1020, 500.0), (1380, 360, 100.0)]
+    assert parse_schedule(None) == []
+
+
+@pytest.mark.parametrize(
+    "hour, minute, kbps",
+    [(12, 0, 500), (8, 29, 0), (17, 0, 0), (23, 30, 100), (3, 0, 100), (6, 0, 0)],
+)
+def test_schedule_windows(hour, minute, kbps):
+    g = governor(
+        0,
+        [
+            {"start": "08:30", "end": "17:00", "kbps": 500},
+            {"start": "23:00", "end": "06:00", "kbps": 100},
+        ],
+    )
+    now = datetime.datetime(2024, 1, 1, hour, minute)
+    assert g.current_kbps(now) == kbps
+
+
+def test_progress_hook_charges_what_arrived(clock, monkeypatch):
+    g = governor(8)
+    charged = []
+    monkeypatch.setattr(g, "consume", charged.append)
+    hook = g.progress_hook()
+    hook({"status": "downloading", "tmpfilename": "a.part", "downloaded_bytes": 100})
+    hook({"status": "downloading", "tmpfilename": "a.part", "downloaded_bytes": 300})
+    hook({"status": "downloading", "tmpfilename": "b.part", "downloaded_bytes": 50})
+    # A restarted download counts from zero again
+    hook({"status": "downloading", "tmpfilename": "a.part", "downloaded_bytes": 40})
+    hook({"status": "finished", "tmpfilename": "a.part", "downloaded_bytes": 999})
+    assert charged == [100, 200, 50, 40]
+
+
+def test_connections_granted_within_the_limit():
+    budget = ConnectionBudget(limit=8)
+    with budget.reserve(5) as first:
+        assert first == 5
+        with budget.reserve(5) as second:
+            assert second == 3
+            assert budget.used == 8
+        assert budget.used == 5
+    assert budget.used == 0
+
+
+def test_an_empty_budget_still_grants_one():
+    budget = ConnectionBudget(limit=2)
+    with budget.reserve(2):
+        with budget.reserve(4) as granted:
+            assert granted == 1
+            assert budget.used == 3
+    assert budget.used == 0
+
+
+def test_connections_released_on_error():
+    budget = ConnectionBudget(limit=4)
+    with pytest.raises(RuntimeError):
+        with budget.reserve(3):
+            raise RuntimeError
+    assert budget.used == 0
+
+
+def test_connection_share():
+    budget = ConnectionBudget(limit=16)
+    budget.share = 0.25
+    with budget.reserve(10) as granted:
+        assert granted == 4
@@ -0,0 +1,169 @@
+import json
+
+import pytest
+
+import downloader
+import matching
+from matching import (
+    MIN_SCORE,
+    best_candidate,
+    candidate_duration,
+    duration_tolerance,
+    normalize,
+    score_candidate,
+    similarity,
+)
+
+SONG = {
+    "title": "Bohemian Rhapsody - Remastered 2011",
+    "artists": ["Queen"],
+    "duration_seconds": 354,
+}
+
+
+def candidate(video_id="v1", title="Bohemian Rhapsody", artist="Queen", **fields):
+    return {
+        "videoId": video_id,
+        "title": title,
+        "artists": [{"name": artist}],
+        "duration_seconds": 354,
+        "resultType": "song",
+        **fields,
+    }
+
+
+def test_normalize():
+    assert normalize("Beyoncé feat. Jay-Z") == "beyonce"
+    assert normalize("Don't  Stop (Remix)!") == "don t stop remix"
+    assert normalize(None) == ""
+
+
+def test_similarity_ignores_extra_words_in_found():
+    assert similarity("Song", "Song (Official Video)") == 1.0
+    assert similarity("Song", "") == 0.0
+    assert similarity("Yesterday", "Tomorrow") < 0.5
+
+
+def test_candidate_duration():
+    assert candidate_duration({"duration_seconds": 200}) == 200.0
+    assert candidate_duration({"duration": "1:02:03"}) == 3723.0
+    assert candidate_duration({"duration": "n/a"}) is None
+    assert candidate_duration({}) is None
+
+
+def test_duration_tolerance_is_10s_or_10_percent():
+    assert duration_tolerance(60) == 10
+    assert duration_tolerance(354) == pytest.approx(35.4)
+
+
+def test_exact_match_scores_1():
+    scored = score_candidate(SONG, candidate(duration="5:54", duration_seconds=None))
+    assert scored["rejected"] is None
+    assert scored["score"] == 1.0
+
+
+@pytest.mark.parametrize(
+    "length, seconds, rejected",
+    [(60, 70, False), (60, 71, True), (354, 389, False), (354, 390, True)],
+)
+def test_duration_out_of_tolerance_is_rejected(length, seconds, rejected):
+    song = {**SONG, "duration_seconds": length}
+    scored = score_candidate(song, candidate(duration_seconds=seconds))
+    assert bool(scored["rejected"]) == rejected
+    if rejected:
+        assert scored["rejected"].startswith("duration off by")
+
+
+def test_other_artist_is_rejected():
+    scored = score_candidate(SONG, candidate(artist="Some Cover Band"))
+    assert scored["parts"]["artist"] < matching.MIN_ARTIST
+    assert scored["rejected"] == "different artist"
+
+
+def test_low_score_is_rejected():
+    scored = score_candidate(
+        SONG, candidate(title="Completely Different", duration_seconds=384)
+    )
+    assert scored["score"] < MIN_SCORE
+    assert scored["rejected"] == "score too low"
+
+
+@pytest.mark.parametrize(
+    "song_seconds, found_seconds", [(0, 354), (None, 354), (354, None)]
+)
+def test_unknown_duration_is_left_out_of_the_score(song_seconds, found_seconds):
+    # A small title mismatch still passes, the score is not capped by the
+    # missing duration part
+    song = {**SONG, "duration_seconds": song_seconds}
+    scored = score_candidate(
+        song, candidate(title="Bohemian Rapsody", duration_seconds=found_seconds)
+    )
+    assert "duration" not in scored["parts"]
+    assert scored["rejected"] is None
+    assert scored["score"] > 0.9
+
+
+def test_unknown_duration_still_rejects_other_artists():
+    song = {**SONG, "duration_seconds": 0}
+    scored = score_candidate(song, candidate(artist="Some Cover Band"))
+    assert scored["rejected"] == "different artist"
+
+
+def test_best_candidate():
+    candidates = [
+        candidate("cover", artist="Some Cover Band"),
+        candidate("video", resultType="video"),
+        candidate("song"),
+        {"title": "No video id"},
+    ]
+    best, scored = best_candidate(SONG, candidates)
+    assert best["videoId"] == "song"
+    assert [s["videoId"] for s in scored] == ["cover", "video", "song"]
+
+
+def test_best_candidate_none_when_all_rejected():
+    best, scored = best_candidate(SONG, [candidate(duration_seconds=500)])
+    assert best is None
+    assert len(scored) == 1
+
+
+@pytest.fixture
+def search_env(tmp_path, monkeypatch):
+    """search_spotify_track() with fake search results and a temp download root."""
+    ytmusicapi = pytest.importorskip("ytmusicapi")
+    work = tmp_path / "work"
+    work.mkdir()
+    (tmp_path / "config.json").write_text(
+        json.dumps({"path": str(tmp_path / "library")})
+    )
+    monkeypatch.chdir(work)
+    monkeypatch.setattr(downloader, "check_network", lambda: True)
+    results = {}
+    searched = []
+
+    class FakeYTMusic:
+        def search(self, query, filter=None, limit=None):
+            searched.append(filter)
+            return results.get(filter, [])
+
+    monkeypatch.setattr(ytmusicapi, "YTMusic", FakeYTMusic)
+    return results, searched, tmp_path / "library" / matching.AUDIT_FILE
+
+
+def test_search_falls_back_to_videos(search_env):
+    results, searched, audit = search_env
+    results["songs"] = [candidate("cover", artist="Some Cover Band")]
+    results["videos"] = [candidate("video", resultType="video")]
+    assert downloader.search_spotify_track(dict(SONG)) == "video"
+    assert searched == ["songs", "videos"]
+    entry = json.loads(audit.read_text().splitlines()[-1])
+    assert entry["chosen"] == "video"
+    assert len(entry["searches"]) == 2
+
+
+def test_search_without_a_match_raises(search_env):
+    results, _, audit = search_env
+    results["songs"] = [candidate(duration_seconds=500)]
+    with pytest.raises(ValueError):
+        downloader.search_spotify_track(dict(SONG))
+    assert json.loads(audit.read_text())["chosen"] is None
@@ -0,0 +1,142 @@
+import os
+
+import pytest
+
+from output_paths import (
+    FilenameTemplate,
+    OutputPlanner,
+    clean_filename,
+    compile_template,
+    template_data,
+)
+
+DATA = {"artist": "Queen", "title": "Song"}
+
+
+def test_clean_filename():
+    assert clean_filename(" AC/DC: Back? ") == "ACDC Back"
+    assert clean_filename("Café - Ünïcode_1.0") == "Café - Ünïcode_1.0"
+
+
+@pytest.mark.parametrize(
+    "template, name",
+    [
+        ("$artist$ - $title$", "Queen - Song"),
+        # Braces and brackets are literals, cleaned out like any other
+        ("{$artist$}", "Queen"),
+        ("[$artist$] {$title$} 100%", "Queen Song 100"),
+        # A field left open at the end is dropped
+        ("$artist$ - $title", "Queen -"),
+        ("a$artist$$title$", "aQueenSong"),
+        # $$ is an empty field name, which has no value
+        ("$$x", "x"),
+        ("$missing$ - $title$", "- Song"),
+    ],
+)
+def test_template_render(template, name):
+    assert FilenameTemplate(template).render(DATA) == name
+
+
+def test_template_other_magic_char():
+    template = FilenameTemplate("%artist% - %title% $x$", magic_char="%")
+    assert template.render(DATA) == "Queen - Song x"
+
+
+def test_compile_template_is_cached():
+    assert compile_template("$title$") is compile_template("$title$")
+    assert compile_template("$title$") is not compile_template("$title$", "%")
+
+
+def test_needs_source():
+    template = FilenameTemplate("$artist$ - $album$")
+    assert template.needs_source({"type": "youtube"})
+    assert not template.needs_source({"type": "spotify"})
+    assert not FilenameTemplate("$title$").needs_source({"type": "youtube"})
+
+
+def test_template_data():
+    song = {
+        "title": "Song",
+        "artists": ["A", "B"],
+        "album": "Album",
+        "release": 2020,
+        "duration_seconds": 200,
+        "type": "spotify",
+        "track_number": "3",
+    }
+    data = template_data(song)
+    assert data["artist"] == "A, B"
+    assert data["track_number"] == 3
+    assert data["year"] == 2020
+
+
+@pytest.fixture
+def targets(tmp_path):
+    return [(str(tmp_path / "mp3"), "mp3"), (str(tmp_path / "flac"), "flac")]
+
+
+def paths(folder_ext, name):
+    return [os.path.join(folder, f"{name}.{ext}") for folder, ext in folder_ext]
+
+
+def test_claim_gives_every_target_the_same_name(targets):
+    planner = OutputPlanner()
+    assert planner.claim("a", "Song", targets) == paths(targets, "Song")
+
+
+def test_collisions_get_numbered_suffixes(targets):
+    planner = OutputPlanner()
+    assert planner.claim("a", "Song", targets) == paths(targets, "Song")
+    assert planner.claim("b", "Song", targets) == paths(targets, "Song (2)")
+    assert planner.claim("c", "Song", targets) == paths(targets, "Song (3)")
+    # The same track again (a duplicate in the queue) shares its paths
+    assert planner.claim("a", "Song", targets) == paths(targets, "Song")
+
+
+def test_collisions_compare_casefolded(targets):
+    planner = OutputPlanner()
+    planner.claim("a", "Song", targets)
+    assert planner.claim("b", "SONG", targets) == paths(targets, "SONG (2)")
+
+
+def test_collision_in_any_target_moves_all(targets):
+    flac_only = OutputPlanner()
+    flac_only.claim("a", "Song", targets[1:])
+    assert flac_only.claim("b", "Song", targets) == paths(targets, "Song (2)")
+
+
+def test_existing_files_by_owner(targets):
+    os.makedirs(targets[0][0])
+    existing = os.path.join(targets[0][0], "Song.mp3")
+    open(existing, "wb").close()
+    open(os.path.join(targets[0][0], "Other.mp3"), "wb").close()
+    owners = {existing.casefold(): "a"}
+
+    # A rerun of the owner gets its file back, others go around it
+    assert OutputPlanner(owners).claim("a", "Song", targets) == paths(targets, "Song")
+    assert OutputPlanner(owners).claim("b", "Song", targets) == paths(
+        targets, "Song (2)"
+    )
+    # A file nobody owns is overwritten
+    assert OutputPlanner(owners).claim("b", "Other", targets) == paths(targets, "Other")
+
+
+def test_owner_match_is_casefolded(targets):
+    os.makedirs(targets[0][0])
+    open(os.path.join(targets[0][0], "song.mp3"), "wb").close()
+    owners = {os.path.join(targets[0][0], "song.mp3").casefold(): "a"}
+    assert OutputPlanner(owners).claim("b", "Song", targets) == paths(
+        targets, "Song (2)"
+    )
+
+
+def test_keep_reserves_finished_files(targets):
+    planner = OutputPlanner()
+    planner.keep("a", paths(targets, "Song"))
+    assert planner.claim("b", "Song", targets) == paths(targets, "Song (2)")
+    assert planner.claim("a", "Song", targets) == paths(targets, "Song")
+
+
+def test_claim_without_a_name_fails(targets):
+    with pytest.raises(ValueError):
+        OutputPlanner().claim("a", "", targets)
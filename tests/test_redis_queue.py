@@ -0,0 +1,245 @@
+"""RedisQueueSystem against the Redis server at REDIS_URL, or fakeredis.
+
+Without REDIS_URL every test gets an in-process fakeredis server (its Lua
+scripts need lupa), skipped when those are not installed. Every test uses its
+own namespace and removes its keys afterwards.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+import redis_queue
+from redis_queue import RedisQueueSystem
+
+REDIS_URL = os.environ.get("REDIS_URL")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    redis = pytest.importorskip("redis")
+    if REDIS_URL:
+        client = redis.Redis.from_url(REDIS_URL)
+        try:
+            client.ping()
+        except redis.ConnectionError:
+            pytest.skip(f"No Redis server at {REDIS_URL}")
+        return client
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    # Every queue of the test connects to the same fake server
+    monkeypatch.setattr(
+        redis.Redis,
+        "from_url",
+        classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server)),
+    )
+    return fakeredis.FakeRedis(server=server)
+
+
+@pytest.fixture
+def namespace(client):
+    namespace = f"test-{uuid.uuid4().hex}"
+    yield namespace
+    keys = list(client.scan_iter(match=f"{{{namespace}}}:*"))
+    if keys:
+        client.delete(*keys)
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(redis_queue, "SEC_PER_CHECK", 0.1)
+
+
+def make_queue(namespace, handler=None, events=None, **kwargs):
+    def on_event(job, event):
+        events.append((job["n"], event))
+
+    return RedisQueueSystem(
+        REDIS_URL or "redis://fakeredis",
+        handler or (lambda job, callback: None),
+        on_event=on_event if events is not None else None,
+        namespace=namespace,
+        **kwargs,
+    )
+
+
+def double(job, callback):
+    callback("working")
+    return job["n"] * 2
+
+
+def finish(queue, timeout=10):
+    """wait_completion() with a deadline, so a broken queue fails the test."""
+    thread = threading.Thread(target=queue.wait_completion, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "wait_completion() did not return"
+
+
+def test_jobs_run_and_report_back(namespace):
+    events = []
+    queue = make_queue(namespace, double, events, max_processes=2)
+    try:
+        queue.submit_jobs({"n": n} for n in range(5))
+        finish(queue)
+    finally:
+        queue.shutdown_graceful()
+    results = {n: event["result"] for n, event in events if "result" in event}
+    assert results == {n: n * 2 for n in range(5)}
+    states = [n for n, event in events if event.get("state") == "working"]
+    assert sorted(states) == list(range(5))
+
+
+def test_lost_lease_is_run_by_another_node(namespace):
+    events = []
+    submitter = make_queue(namespace, events=events, max_processes=0)
+    submitter.submit_jobs([{"n": 7}])
+    # A node claims the job and dies without a heartbeat
+    dead = make_queue(namespace, max_processes=0)
+    claimed = dead._claim(
+        keys=[dead.keys[name] for name in dead.keys],
+        args=[time.time(), 0.1, "dead-node"],
+    )
+    assert claimed
+    time.sleep(0.2)
+    worker = make_queue(namespace, double, max_processes=1)
+    try:
+        worker.start()
+        finish(submitter)
+    finally:
+        worker.shutdown_graceful()
+    assert (7, {"result": 14}) in events
+
+
+def test_job_fails_after_max_attempts(namespace, monkeypatch):
+    events = []
+    submitter = make_queue(namespace, events=events, max_processes=0)
+    submitter.submit_jobs([{"n": 1}])
+    node = make_queue(namespace, max_processes=0)
+    for _ in range(redis_queue.MAX_ATTEMPTS):
+        assert node._claim(
+            keys=[node.keys[name] for name in node.keys],
+            args=[time.time() - 1, 0, uuid.uuid4().hex],
+        )
+        node._reap_expired()
+    finish(submitter)
+    assert events == [(1, {"error": f"Worker lost {redis_queue.MAX_ATTEMPTS} times"})]
+
+
+def test_late_ack_of_a_lost_lease_is_dropped(namespace):
+    events = []
+    submitter = make_queue(namespace, events=events, max_processes=0)
+    submitter.submit_jobs([{"n": 3}])
+    node = make_queue(namespace, max_processes=0)
+    keys = [node.keys[name] for name in node.keys]
+    node._claim(keys=keys, args=[time.time() - 1, 0, "first"])
+    node._reap_expired()
+    payload = node._claim(keys=keys, args=[time.time(), 60, "second"])
+    job_id = payload[0].decode()
+    ack_keys = [
+        node.keys["leases"],
+        node.keys["owners"],
+        node.keys["jobs"],
+        node._batch_key("events", submitter.batch),
+        node._batch_key("left", submitter.batch),
+    ]
+    assert not node._ack(keys=ack_keys, args=[job_id, "first", "{}", 60])
+    assert node._ack(
+        keys=ack_keys,
+        args=[job_id, "second", f'{{"job": "{job_id}", "result": 6}}', 60],
+    )
+    finish(submitter)
+    assert events == [(3, {"result": 6})]
+
+
+def test_pause_and_abort(namespace):
+    events = []
+    queue = make_queue(namespace, double, events, max_processes=1)
+    try:
+        queue.pause()
+        queue.submit_jobs({"n": n} for n in range(3))
+        time.sleep(0.3)
+        assert not events
+        assert queue.abort() == 3
+        queue.resume()
+        finish(queue)
+    finally:
+        queue.shutdown_graceful()
+    assert not events
+
+
+def test_keys_share_one_hash_slot(namespace, client):
+    queue = make_queue(namespace, double, [], max_processes=1)
+    try:
+        queue.submit_jobs([{"n": 1}])
+        finish(queue)
+        queue.pause()
+    finally:
+        queue.shutdown_graceful()
+    keys = [key.decode() for key in client.scan_iter(match="*")]
+    ours = [key for key in keys if namespace in key]
+    assert ours
+    assert all(key.startswith(f"{{{namespace}}}:") for key in ours)
+
+
+def flaky_heartbeat(queue, failures):
+    """Makes the first `failures` lease renewals raise ConnectionError."""
+    import redis
+
+    renew = queue._heartbeat
+    calls = []
+
+    def heartbeat(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= failures:
+            raise redis.ConnectionError("connection reset")
+        return renew(**kwargs)
+
+    queue._heartbeat = heartbeat
+    return calls
+
+
+def test_heartbeat_survives_connection_errors(namespace):
+    events = []
+
+    def slow(job, callback):
+        time.sleep(1.2)
+        callback("late")
+        return job["n"]
+
+    queue = make_queue(namespace, slow, events, max_processes=1, lease_seconds=0.6)
+    calls = flaky_heartbeat(queue, failures=2)
+    try:
+        queue.submit_jobs([{"n": 5}])
+        finish(queue)
+    finally:
+        queue.shutdown_graceful()
+    assert len(calls) > 2
+    assert events == [(5, {"state": "late", "type": "state"}), (5, {"result": 5})]
+
+
+def test_heartbeat_gives_up_at_the_lease_deadline(namespace):
+    events = []
+    started = threading.Event()
+
+    def slow(job, callback):
+        started.set()
+        time.sleep(1)
+        callback("late")
+        return job["n"]
+
+    queue = make_queue(namespace, slow, events, max_processes=1, lease_seconds=0.3)
+    flaky_heartbeat(queue, failures=1000)
+    try:
+        queue.submit_jobs([{"n": 5}])
+        assert started.wait(5)
+        # The job's updates are dropped once its lease is lost
+        time.sleep(1.2)
+        assert not events
+        queue.abort()
+    finally:
+        queue.stop_event.set()
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+import pytest
+
+import downloader
+from singleflight import SingleFlight
+
+WORKERS = 5
+
+
+def run_together(fn, count=WORKERS):
+    """Call fn() from `count` threads at once, returns results or exceptions."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def call(i):
+        barrier.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def slow(value, calls, delay=0.2):
+    def fn():
+        calls.append(value)
+        time.sleep(delay)
+        return value
+
+    return fn
+
+
+def test_concurrent_calls_run_once_and_share():
+    flights = SingleFlight()
+    calls = []
+
+    def acquire():
+        try:
+            return flights.acquire("k", slow("result", calls))
+        finally:
+            flights.release("k")
+
+    results = run_together(acquire)
+    assert calls == ["result"]
+    assert sorted(shared for _, shared in results) == [False] + [True] * (WORKERS - 1)
+    assert {result for result, _ in results} == {"result"}
+    assert not flights.flights
+
+
+def test_different_keys_run_separately():
+    flights = SingleFlight()
+    calls = []
+    for key in ("a", "b"):
+        flights.acquire(key, slow(key, calls, 0))
+    assert calls == ["a", "b"]
+
+
+def test_a_waiter_retries_when_the_leader_fails():
+    flights = SingleFlight()
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(len(calls))
+            first = len(calls) == 1
+        time.sleep(0.2)
+        if first:
+            raise RuntimeError("leader failed")
+        return "second try"
+
+    def acquire():
+        result = flights.acquire("k", fn)
+        flights.release("k")
+        return result
+
+    results = run_together(acquire)
+    errors = [r for r in results if isinstance(r, Exception)]
+    assert [str(e) for e in errors] == ["leader failed"]
+    assert calls == [0, 1]
+    assert sum(r == ("second try", False) for r in results) == 1
+    assert sum(r == ("second try", True) for r in results) == WORKERS - 2
+    assert not flights.flights
+
+
+def test_cleanup_runs_once_after_the_last_release():
+    cleaned = []
+    flights = SingleFlight(cleanup=cleaned.append)
+    flights.acquire("k", lambda: "result")
+    flights.acquire("k", lambda: "unused")
+    flights.release("k")
+    assert cleaned == []
+    flights.release("k")
+    assert cleaned == ["result"]
+    flights.release("k")
+    assert cleaned == ["result"]
+
+
+def test_new_caller_waits_for_cleanup():
+    events = []
+
+    def cleanup(result):
+        events.append(("cleanup start", result))
+        time.sleep(0.2)
+        events.append(("cleanup end", result))
+
+    flights = SingleFlight(cleanup=cleanup)
+    flights.acquire("k", lambda: 1)
+    releasing = threading.Thread(target=flights.release, args=("k",))
+    releasing.start()
+    time.sleep(0.05)
+    result = flights.acquire("k", lambda: events.append(("run", 2)) or 2)
+    releasing.join()
+    assert result == (2, False)
+    assert events == [("cleanup start", 1), ("cleanup end", 1), ("run", 2)]
+
+
+@pytest.fixture
+def fake_fetch(tmp_path, monkeypatch):
+    """acquire_source() with a fetch that writes a file and counts its calls."""
+    calls = []
+
+    def fetch_source(youtube_id, presets=None):
+        calls.append(youtube_id)
+        time.sleep(0.2)
+        path = tmp_path / f"{youtube_id}.m4a"
+        path.write_bytes(b"audio")
+        return {"file_path": str(path), "id": youtube_id}
+
+    monkeypatch.setattr(downloader, "fetch_source", fetch_source)
+    return calls
+
+
+def test_identical_source_jobs_download_once(fake_fetch):
+    def job():
+        source = downloader.acquire_source("vid00000001")
+        time.sleep(0.1)
+        return source
+
+    sources = run_together(job)
+    assert fake_fetch == ["vid00000001"]
+    paths = {source["file_path"] for source in sources}
+    assert len(paths) == 1
+    path = paths.pop()
+    # The source stays until every job released it
+    for _ in range(WORKERS - 1):
+        downloader.release_source("vid00000001")
+        assert open(path, "rb").read() == b"audio"
+    downloader.release_source("vid00000001")
+    assert not os.path.exists(path)
+
+
+def test_failed_source_download_is_tried_again(monkeypatch, tmp_path):
+    calls = []
+
+    def fetch_source(youtube_id, presets=None):
+        calls.append(youtube_id)
+        time.sleep(0.1)
+        if len(calls) == 1:
+            raise ConnectionError("dropped")
+        path = tmp_path / "source.m4a"
+        path.write_bytes(b"audio")
+        return {"file_path": str(path)}
+
+    monkeypatch.setattr(downloader, "fetch_source", fetch_source)
+    results = run_together(lambda: downloader.acquire_source("vid00000002"), 3)
+    assert len(calls) == 2
+    assert sum(isinstance(r, ConnectionError) for r in results) == 1
+    for result in results:
+        if not isinstance(result, Exception):
+            downloader.release_source("vid00000002")
+    assert not downloader.source_flights.flights
@@ -0,0 +1,334 @@
+"""Offline end-to-end throughput benchmark.
+
+Drives download_single through QueueSystem against local fakes of YouTube Music,
+Spotify and the media servers (see fake_services.py), so nothing leaves the
+machine. Every scenario runs in its own process and the report is JSON:
+
+    python tools/benchmark.py --workers 1,2,4 --presets "MP3 128kbps,FLAC" \\
+        --sizes 10 --source youtube --output bench.json --baseline old.json
+
+Long sources over throttled connections (hour-long DJ sets, fetched as range
+fragments over several connections), compared at 1 and 16 connections:
+
+    python tools/benchmark.py --workers 2 --presets "MP3 128kbps" --sizes 2 \\
+        --durations 3600 --connection-kbps 8000 --max-connections 1,16
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOOLS_DIR = os.path.abspath(os.path.dirname(__file__))
+SRC_DIR = os.path.abspath(os.path.join(TOOLS_DIR, "..", "src"))
+
+
+def percentiles(values: list):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": round(pick(0.50), 4),
+        "p90": round(pick(0.90), 4),
+        "p99": round(pick(0.99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def directory_size(path: str):
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+class DiskSampler(threading.Thread):
+    def __init__(self, path: str, interval: float = 0.02):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.high_water = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.high_water = max(self.high_water, directory_size(self.path))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.high_water = max(self.high_water, directory_size(self.path))
+
+
+def run_scenario(scenario: dict):
+    root = tempfile.mkdtemp(prefix="pdt-bench-")
+    cwd = os.getcwd()
+    try:
+        return _run_scenario(scenario, root)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _run_scenario(scenario: dict, root: str):
+    work = os.path.join(root, "work")
+    os.makedirs(work)
+    with open(os.path.join(root, "config.json"), "w") as f:
+        json.dump(
+            {
+                "path": os.path.join(root, "library"),
+                "sp_id": "bench",
+                "sp_sec": "bench",
+                "quality": scenario["preset"],
+                "max_parallel": str(scenario["workers"]),
+                "filename_template": "$artist$ - $title$",
+                "dev_mode": False,
+                "max_connections": scenario.get("max_connections") or 16,
+            },
+            f,
+        )
+    # downloader reads ../config.json and writes .TEMP relative to the cwd
+    os.chdir(work)
+    sys.path[:0] = [SRC_DIR, TOOLS_DIR]
+
+    import fake_services
+
+    from downloader import get_ffmpeg_path
+
+    catalog = fake_services.FakeCatalog(
+        get_ffmpeg_path(),
+        scenario["size"],
+        durations=scenario.get("durations") or fake_services.DEFAULT_DURATIONS,
+    )
+    server = fake_services.MediaServer(
+        catalog, connection_kbps=scenario.get("connection_kbps", 0)
+    ).start()
+    fake_services.install(catalog, extract_delay=scenario.get("extract_delay", 0))
+
+    from downloader import TEMP_DIR, download_single, get_initial, sanitize
+    from metrics import metrics
+    from threader import QueueSystem
+
+    if scenario["source"] == "spotify":
+        link = f"https://open.spotify.com/playlist/{catalog.spotify_playlist_id}"
+    else:
+        link = f"https://music.youtube.com/playlist?list={catalog.youtube_playlist_id}"
+
+    analyze_started = time.perf_counter()
+    collection = get_initial(link)
+    analyze_seconds = time.perf_counter() - analyze_started
+    folder_name = sanitize(collection["title"])
+
+    lock = threading.Lock()
+    transitions = {}
+    failures = []
+
+    def job(index, track):
+        def callback(state, type="state"):
+            if type != "log":
+                with lock:
+                    transitions[index].append((state, time.perf_counter()))
+
+        with lock:
+            transitions[index] = [("downloading", time.perf_counter())]
+        try:
+            download_single(track, folder_name=folder_name, callback=callback)
+        except Exception as e:
+            failures.append(f"{track['title']}: {e}")
+            raise
+        finally:
+            with lock:
+                transitions[index].append(("end", time.perf_counter()))
+
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    sampler = DiskSampler(TEMP_DIR)
+    sampler.start()
+    queue_system = QueueSystem(max_processes=scenario["workers"])
+    started = time.perf_counter()
+    queue_system.submit_jobs(
+        [
+            lambda i=i, t=t: job(i, t)
+            for i, t in enumerate(collection.get("tracks", [collection]))
+        ]
+    )
+    queue_system.wait_completion()
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+    server.stop()
+
+    statuses = {}
+    track_seconds = []
+    for steps in transitions.values():
+        track_seconds.append(steps[-1][1] - steps[0][1])
+        for (state, at), (_, until) in zip(steps, steps[1:]):
+            if state not in ("end", "done"):
+                statuses.setdefault(state, []).append(until - at)
+
+    done = len(transitions) - len(failures)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        **scenario,
+        "tracks": done,
+        "failed": len(failures),
+        "errors": failures[:5],
+        "seconds": round(elapsed, 3),
+        "analyze_seconds": round(analyze_seconds, 3),
+        "tracks_per_minute": round(done / elapsed * 60, 2) if elapsed else 0,
+        "track_seconds": percentiles(track_seconds),
+        "status_seconds": {k: percentiles(v) for k, v in statuses.items()},
+        "stage_seconds": metrics.summary(),
+        "bytes_served": server.bytes_served,
+        "http_requests": server.requests,
+        "max_open_connections": server.max_open,
+        "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(child_usage.ru_maxrss / 1024, 1),
+        "temp_disk_high_water_bytes": sampler.high_water,
+    }
+
+
+def scenario_key(scenario: dict):
+    key = f"{scenario['source']}|{scenario['preset']}|w{scenario['workers']}|n{scenario['size']}"
+    if scenario.get("connection_kbps"):
+        key += f"|{scenario['connection_kbps']}kbps"
+    if scenario.get("max_connections"):
+        key += f"|c{scenario['max_connections']}"
+    if scenario.get("extract_delay"):
+        key += f"|x{scenario['extract_delay']}s"
+    if scenario.get("durations"):
+        key += f"|d{'-'.join(str(d) for d in scenario['durations'])}"
+    return key
+
+
+def compare(report: dict, baseline: dict):
+    previous = {scenario_key(s): s for s in baseline.get("scenarios", [])}
+    comparison = []
+    for scenario in report["scenarios"]:
+        old = previous.get(scenario_key(scenario))
+        if not old or not old.get("tracks_per_minute"):
+            continue
+        change = scenario["tracks_per_minute"] / old["tracks_per_minute"] - 1
+        comparison.append(
+            {
+                "scenario": scenario_key(scenario),
+                "tracks_per_minute": scenario["tracks_per_minute"],
+                "baseline_tracks_per_minute": old["tracks_per_minute"],
+                "change_percent": round(change * 100, 1),
+            }
+        )
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--presets", default="MP3 128kbps,FLAC")
+    parser.add_argument("--sizes", default="10")
+    parser.add_argument("--source", default="youtube", choices=["youtube", "spotify"])
+    parser.add_argument(
+        "--extract-delay",
+        type=float,
+        default=0.0,
+        help="seconds added to every yt-dlp extraction to mimic page/player latency",
+    )
+    parser.add_argument(
+        "--durations",
+        default="183,214,247",
+        help="comma separated source lengths in seconds, cycled over the tracks",
+    )
+    parser.add_argument(
+        "--connection-kbps",
+        type=float,
+        default=0,
+        help="throttle every media server connection to this many kbit/s",
+    )
+    parser.add_argument(
+        "--max-connections",
+        default="0",
+        help="comma separated connection budgets to compare (0 = the default)",
+    )
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against an earlier report")
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_scenario(json.loads(args.single))))
+        return
+
+    scenarios = [
+        {
+            "source": args.source,
+            "preset": preset,
+            "workers": int(workers),
+            "size": int(size),
+            "extract_delay": args.extract_delay,
+            "durations": [int(d) for d in args.durations.split(",")],
+            "connection_kbps": args.connection_kbps,
+            "max_connections": int(connections),
+        }
+        for preset, workers, size, connections in itertools.product(
+            args.presets.split(","),
+            args.workers.split(","),
+            args.sizes.split(","),
+            args.max_connections.split(","),
+        )
+    ]
+
+    results = []
+    for scenario in scenarios:
+        print(f"running {scenario_key(scenario)}", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, __file__, "--single", json.dumps(scenario)],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            results.append({**scenario, "error": proc.stderr.strip()[-2000:]})
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "scenarios": results,
+    }
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["comparison"] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Import-time regression check.
+
+Runs `python -X importtime -c "import <module>"` from src/ and fails when one of
+the service packages is imported at startup or the cumulative import time of the
+entry module goes over the budget.
+
+    python tools/check_importtime.py [--module ui] [--budget-ms 400] [--top 15]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# These are loaded on first use and must never show up at launch
+LAZY_MODULES = (
+    "yt_dlp",
+    "ytmusicapi",
+    "spotipy",
+    "mutagen",
+    "ping3",
+    "imageio_ffmpeg",
+    "requests",
+)
+
+
+def measure(module: str):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        rows.append(
+            {
+                "module": name.strip(),
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+            }
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="ui")
+    parser.add_argument("--budget-ms", type=float, default=400)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    args = parser.parse_args()
+
+    rows = measure(args.module)
+    total_ms = (
+        next((r["cumulative_us"] for r in rows if r["module"] == args.module), 0) / 1000
+    )
+    eager = sorted(
+        {
+            r["module"].split(".")[0]
+            for r in rows
+            if r["module"].split(".")[0] in LAZY_MODULES
+        }
+    )
+    top = sorted(rows, key=lambda r: r["self_us"], reverse=True)[: args.top]
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "module": args.module,
+                    "total_ms": total_ms,
+                    "budget_ms": args.budget_ms,
+                    "eager_service_modules": eager,
+                    "top_self": top,
+                },
+                indent=4,
+            )
+        )
+    else:
+        print(f"import {args.module}: {total_ms:.1f} ms (budget {args.budget_ms} ms)")
+        for r in top:
+            print(f"  {r['self_us'] / 1000:8.1f} ms  {r['module']}")
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported at launch: {', '.join(eager)}", file=sys.stderr)
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: {total_ms:.1f} ms is over budget", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""Local stand-ins for YouTube Music, Spotify and the YouTube media servers.
+
+Used by the benchmark so that the real download pipeline (yt-dlp's downloader,
+ffmpeg, mutagen) can run without touching the network. Call `install()` after
+`src/` is on sys.path and before anything in downloader is used.
+"""
+
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_DURATIONS = (183, 214, 247)
+# YouTube's "dashy" formats are cut into range requests of this size
+FRAGMENT_SIZE = 10 << 20
+
+
+def synthesize(ffmpeg_path: str, duration: int, ext: str):
+    """Encode a sine tone of `duration` seconds, returns the file bytes."""
+    codec = {
+        "webm": ["-c:a", "libopus", "-b:a", "160k", "-f", "webm"],
+        "m4a": ["-c:a", "aac", "-b:a", "128k", "-f", "mp4"],
+    }[ext]
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, f"tone.{ext}")
+        subprocess.run(
+            [
+                ffmpeg_path,
+                "-v",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"sine=frequency=440:sample_rate=48000:duration={duration}",
+                *codec,
+                out,
+            ],
+            check=True,
+        )
+        with open(out, "rb") as f:
+            return f.read()
+
+
+def synthesize_cover(ffmpeg_path: str):
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "cover.png")
+        subprocess.run(
+            [
+                ffmpeg_path,
+                "-v",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                "color=c=0x3060a0:s=600x600",
+                "-frames:v",
+                "1",
+                out,
+            ],
+            check=True,
+        )
+        with open(out, "rb") as f:
+            return f.read()
+
+
+class FakeCatalog:
+    """A deterministic set of tracks shared by every fake service."""
+
+    def __init__(self, ffmpeg_path: str, size: int, durations=DEFAULT_DURATIONS):
+        self.media = {}
+        for duration in sorted(set(durations)):
+            for ext in ("webm", "m4a"):
+                self.media[(duration, ext)] = synthesize(ffmpeg_path, duration, ext)
+        self.cover = synthesize_cover(ffmpeg_path)
+        self.base_url = None
+
+        self.tracks = []
+        for i in range(size):
+            self.tracks.append(
+                {
+                    "video_id": f"bench{i:06d}",
+                    "spotify_id": f"sp{i:020d}",
+                    "isrc": f"QZBEN{i:07d}",
+                    "title": f"Bench Song {i}",
+                    "artist": f"Bench Artist {i % 7}",
+                    "album": f"Bench Album {i % 3}",
+                    "duration": durations[i % len(durations)],
+                }
+            )
+        self.by_video_id = {t["video_id"]: t for t in self.tracks}
+        self.by_spotify_id = {t["spotify_id"]: t for t in self.tracks}
+        self.youtube_playlist_id = "PL" + hashlib.md5(b"bench").hexdigest()
+        self.spotify_playlist_id = "benchplaylist" + "0" * 9
+        self.spotify_album_id = "benchalbum" + "0" * 12
+
+    def media_url(self, video_id: str, ext: str):
+        return f"{self.base_url}/audio/{video_id}.{ext}"
+
+    def cover_url(self, video_id: str):
+        return f"{self.base_url}/cover/{video_id}.png"
+
+    def media_bytes(self, video_id: str, ext: str):
+        return self.media[(self.by_video_id[video_id]["duration"], ext)]
+
+
+class MediaServer:
+    """Threaded HTTP server with Range support serving the catalog's media.
+
+    Like googlevideo it also takes a "range=a-b" query parameter, and with
+    `connection_kbps` every connection is throttled to that rate.
+    """
+
+    def __init__(self, catalog: FakeCatalog, connection_kbps: float = 0):
+        self.catalog = catalog
+        self.bytes_served = 0
+        self.requests = 0
+        self.max_open = 0
+        self.open = 0
+        self.lock = threading.Lock()
+        server = self
+
+        def send(wfile, chunk: bytes):
+            if not connection_kbps:
+                wfile.write(chunk)
+                return
+            rate = connection_kbps * 1000 / 8
+            started = time.monotonic()
+            for offset in range(0, len(chunk), 64 << 10):
+                wfile.write(chunk[offset : offset + (64 << 10)])
+                ahead = (offset + (64 << 10)) / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                match = re.match(r"^/(audio|cover)/([\w-]+)\.(\w+)", self.path)
+                try:
+                    if match.group(1) == "cover":
+                        body, content_type = catalog.cover, "image/png"
+                    else:
+                        body = catalog.media_bytes(match.group(2), match.group(3))
+                        content_type = f"audio/{match.group(3)}"
+                except (AttributeError, KeyError):
+                    self.send_error(404)
+                    return
+
+                start, end = 0, len(body) - 1
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                ranged = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+                if "range" in query:
+                    first, last = query["range"][0].split("-")
+                    start, end = int(first), min(end, int(last))
+                    self.send_response(200)
+                elif ranged:
+                    if ranged.group(1):
+                        start = int(ranged.group(1))
+                        if ranged.group(2):
+                            end = min(end, int(ranged.group(2)))
+                    elif ranged.group(2):
+                        start = max(0, len(body) - int(ranged.group(2)))
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(body)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range", f"bytes {start}-{end}/{len(body)}"
+                    )
+                else:
+                    self.send_response(200)
+                chunk = body[start : end + 1]
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(chunk)))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                with server.lock:
+                    server.open += 1
+                    server.max_open = max(server.max_open, server.open)
+                try:
+                    send(self.wfile, chunk)
+                finally:
+                    with server.lock:
+                        server.open -= 1
+                        server.bytes_served += len(chunk)
+                        server.requests += 1
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        catalog.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+def _search_result(catalog: FakeCatalog, track: dict):
+    return {
+        "resultType": "song",
+        "videoId": track["video_id"],
+        "title": track["title"],
+        "artists": [{"name": track["artist"]}],
+        "album": {"name": track["album"]},
+        "duration": f"{track['duration'] // 60}:{track['duration'] % 60:02d}",
+        "duration_seconds": track["duration"],
+        "thumbnails": [{"url": catalog.cover_url(track["video_id"])}],
+    }
+
+
+def make_ytmusicapi(catalog: FakeCatalog):
+    module = types.ModuleType("ytmusicapi")
+
+    class YTMusic:
+        def search(self, query, filter=None, limit=20, **kwargs):
+            query = query.lower()
+            hits = [
+                t
+                for t in catalog.tracks
+                if t["title"].lower() in query or t["isrc"].lower() == query
+            ]
+            return [_search_result(catalog, t) for t in hits][:limit]
+
+        def get_song(self, videoId, **kwargs):
+            track = catalog.by_video_id[videoId]
+            return {
+                "videoDetails": {
+                    "videoId": videoId,
+                    "title": track["title"],
+                    "author": track["artist"],
+                    "lengthSeconds": str(track["duration"]),
+                    "thumbnail": {"thumbnails": [{"url": catalog.cover_url(videoId)}]},
+                }
+            }
+
+        def get_playlist(self, playlistId, limit=100, **kwargs):
+            return {
+                "id": playlistId,
+                "title": "Bench YouTube Playlist",
+                "tracks": [_search_result(catalog, t) for t in catalog.tracks],
+            }
+
+    module.YTMusic = YTMusic
+    return module
+
+
+def make_spotipy(catalog: FakeCatalog):
+    module = types.ModuleType("spotipy")
+    oauth2 = types.ModuleType("spotipy.oauth2")
+
+    class SpotifyClientCredentials:
+        def __init__(self, client_id=None, client_secret=None, **kwargs):
+            pass
+
+    def track_object(track: dict, number: int):
+        return {
+            "id": track["spotify_id"],
+            "name": track["title"],
+            "artists": [{"name": track["artist"]}],
+            "duration_ms": track["duration"] * 1000,
+            "track_number": number,
+            "external_ids": {"isrc": track["isrc"]},
+            "album": {
+                "name": track["album"],
+                "release_date": "2024-01-01",
+                "images": [{"url": catalog.cover_url(track["video_id"])}],
+            },
+        }
+
+    class Spotify:
+        page_size = 100
+
+        def __init__(self, client_credentials_manager=None, **kwargs):
+            pass
+
+        def _page(self, offset: int):
+            items = [
+                {"track": track_object(t, i + 1)} for i, t in enumerate(catalog.tracks)
+            ]
+            end = offset + self.page_size
+            return {
+                "items": items[offset:end],
+                "next": end if end < len(items) else None,
+            }
+
+        def playlist(self, playlist_id, fields=None, **kwargs):
+            return {
+                "id": playlist_id,
+                "name": "Bench Spotify Playlist",
+                "snapshot_id": "bench-snapshot",
+                "images": [{"url": catalog.cover_url(catalog.tracks[0]["video_id"])}],
+            }
+
+        def playlist_items(self, playlist_id, **kwargs):
+            return self._page(0)
+
+        def next(self, result):
+            return self._page(result["next"]) if result["next"] else None
+
+        def album(self, album_id, **kwargs):
+            simplified = []
+            for i, t in enumerate(catalog.tracks):
+                item = track_object(t, i + 1)
+                del item["album"], item["external_ids"]
+                simplified.append(item)
+            return {
+                "id": album_id,
+                "name": "Bench Spotify Album",
+                "release_date": "2024-01-01",
+                "images": [{"url": catalog.cover_url(catalog.tracks[0]["video_id"])}],
+                "tracks": {"items": simplified, "next": None},
+            }
+
+        def track(self, track_id, **kwargs):
+            return track_object(catalog.by_spotify_id[track_id], 1)
+
+        def tracks(self, tracks, **kwargs):
+            return {
+                "tracks": [
+                    track_object(catalog.by_spotify_id[i], n + 1)
+                    for n, i in enumerate(tracks)
+                ]
+            }
+
+    oauth2.SpotifyClientCredentials = SpotifyClientCredentials
+    module.Spotify = Spotify
+    module.oauth2 = oauth2
+    return module, oauth2
+
+
+def make_youtube_dl(catalog: FakeCatalog, extract_delay: float = 0.0):
+    """A real yt_dlp.YoutubeDL whose only extractor answers from the catalog."""
+    import time
+
+    import yt_dlp
+    from yt_dlp.extractor.common import InfoExtractor
+    from yt_dlp.utils import LazyList
+
+    class BenchIE(InfoExtractor):
+        IE_NAME = "bench"
+        _VALID_URL = r"https?://music\.youtube\.com/watch\?v=(?P<id>[\w-]{11})"
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            track = catalog.by_video_id[video_id]
+            if extract_delay:
+                time.sleep(extract_delay)
+            formats = [
+                {
+                    "format_id": "140",
+                    "url": catalog.media_url(video_id, "m4a"),
+                    "ext": "m4a",
+                    "acodec": "mp4a.40.2",
+                    "vcodec": "none",
+                    "abr": 128,
+                    "filesize": len(catalog.media_bytes(video_id, "m4a")),
+                },
+                {
+                    "format_id": "251",
+                    "url": catalog.media_url(video_id, "webm"),
+                    "ext": "webm",
+                    "acodec": "opus",
+                    "vcodec": "none",
+                    "abr": 160,
+                    "filesize": len(catalog.media_bytes(video_id, "webm")),
+                },
+            ]
+            # Same as the youtube extractor with formats=dashy: range fragments
+            args = self._downloader.params.get("extractor_args", {}).get("youtube", {})
+            if "dashy" in args.get("formats", []):
+                for f in formats:
+                    f["protocol"] = "http_dash_segments"
+                    # A LazyList over a generator, as yt-dlp's own extractor
+                    # gives, which cannot be deepcopied
+                    f["fragments"] = LazyList(
+                        {"url": f"{url}?range={start}-{start + FRAGMENT_SIZE - 1}"}
+                        for url, size in [(f["url"], f["filesize"])]
+                        for start in range(0, size, FRAGMENT_SIZE)
+                    )
+            return {
+                "id": video_id,
+                "title": track["title"],
+                "artists": [track["artist"]],
+                "uploader": track["artist"],
+                "album": track["album"],
+                "release_year": 2024,
+                "duration": track["duration"],
+                "thumbnail": catalog.cover_url(video_id),
+                "thumbnails": [{"url": catalog.cover_url(video_id)}],
+                "formats": formats,
+            }
+
+    class BenchYoutubeDL(yt_dlp.YoutubeDL):
+        def __init__(self, params=None, auto_init=True):
+            super().__init__(params, auto_init=False)
+            self.add_info_extractor(BenchIE())
+
+    return BenchYoutubeDL
+
+
+def install(catalog: FakeCatalog, extract_delay: float = 0.0):
+    """Route downloader's service calls to the fakes."""
+    spotipy, oauth2 = make_spotipy(catalog)
+    sys.modules["ytmusicapi"] = make_ytmusicapi(catalog)
+    sys.modules["spotipy"] = spotipy
+    sys.modules["spotipy.oauth2"] = oauth2
+
+    import yt_dlp
+
+    yt_dlp.YoutubeDL = make_youtube_dl(catalog, extract_delay)
+
+    import downloader
+
+    downloader.check_network = lambda: True